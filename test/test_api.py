@@ -127,6 +127,21 @@ class with_http_bridge(basebridge):
             callback=write_request_bridge(wsgitester.put)
         )
 
+        resp.add_callback(
+            responses.GET, uri + '/cache/refresh-log',
+            callback=partial(read_request_bridge, wsgitester)
+        )
+
+        resp.add_callback(
+            responses.GET, uri + '/cache/refresh-plan',
+            callback=partial(read_request_bridge, wsgitester)
+        )
+
+        resp.add_callback(
+            responses.POST, uri + '/series/batch',
+            callback=write_request_bridge(wsgitester.post)
+        )
+
 
 tsx = make_tsx(
     'http://test.me',
@@ -741,6 +756,237 @@ def test_find_bypolicy(tsx):
     assert names == ['find.constant']
 
 
+def test_get_batch(engine, tsx, tsa3):
+    tsx.update(
+        'batch-base',
+        genserie(utcdt(2022, 1, 1), 'd', 5, [1.]),
+        'Babar',
+        insertion_date=utcdt(2022, 1, 1)
+    )
+    tsx.update(
+        'batch-naive',
+        genserie(datetime(2022, 1, 1), 'd', 5, [3.]),
+        'Babar',
+        insertion_date=utcdt(2022, 1, 1)
+    )
+    for name, formula in (
+            ('batch-cached', '(+ 1 (series "batch-base"))'),
+            ('batch-cached-naive', '(* 2 (series "batch-naive"))'),
+            ('batch-uncached', '(+ 2 (series "batch-base"))')):
+        tsx.register_formula(name, formula)
+
+    tsx.new_cache_policy(
+        'batch-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *'
+    )
+    tsx.set_cache_policy('batch-policy', ['batch-cached', 'batch-cached-naive'])
+    for name in ('batch-cached', 'batch-cached-naive'):
+        cache.refresh_series(
+            engine, tsa3, name,
+            final_revdate=utcdt(2022, 1, 1, 12)
+        )
+        assert tsx.has_cache(name)
+
+    names = [
+        'batch-cached', 'batch-base', 'batch-cached-naive',
+        'batch-uncached', 'no-such-series'
+    ]
+    series = tsx.get_batch(names)
+    assert list(series) == names
+    assert series['no-such-series'] is None
+    for name in names[:-1]:
+        assert series[name].equals(tsx.get(name))
+    assert series['batch-cached'].tolist() == [2.] * 5
+    assert series['batch-cached-naive'].tolist() == [6.] * 5
+
+    series = tsx.get_batch(
+        names[:-1],
+        from_value_date=datetime(2022, 1, 2),
+        to_value_date=datetime(2022, 1, 3)
+    )
+    for name, ts in series.items():
+        assert len(ts) == 2
+        assert ts.equals(
+            tsx.get(
+                name,
+                from_value_date=datetime(2022, 1, 2),
+                to_value_date=datetime(2022, 1, 3)
+            )
+        )
+
+    # only the misses go through get
+    tsh = tsa3.tsh
+    with patch.object(tsh, 'get', wraps=tsh.get) as get:
+        tsh.get_batch(engine, names)
+    assert {call.args[1] for call in get.call_args_list} == {
+        'batch-base', 'batch-uncached', 'no-such-series'
+    }
+
+
+def test_cache_refresh_log(engine, tsx, tsa3):
+    tsh = tsa3.tsh
+    for day in (1, 2):
+        tsx.update(
+            'log-base',
+            genserie(utcdt(2022, 1, day), 'd', 5, [float(day)]),
+            'Babar',
+            insertion_date=utcdt(2022, 1, day)
+        )
+    names = ['log-formula', 'log-failing']
+    for name in names:
+        tsx.register_formula(name, '(+ 1 (series "log-base"))')
+        tsh.invalidate_cache(engine, name)
+    tsx.new_cache_policy(
+        'log-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *'
+    )
+    tsx.set_cache_policy('log-policy', names)
+    with engine.begin() as cn:
+        cn.execute('delete from tsh.cache_refresh_log')
+
+    cache.refresh_series(
+        engine, tsa3, 'log-formula',
+        final_revdate=utcdt(2022, 1, 3)
+    )
+    with patch.object(cache, '_insertion_dates', side_effect=Exception('boom')):
+        with pytest.raises(Exception):
+            cache.refresh_series(
+                engine, tsa3, 'log-failing',
+                final_revdate=utcdt(2022, 1, 3)
+            )
+
+    log = tsx.cache_refresh_log(names=names)
+    assert [entry['name'] for entry in log] == ['log-failing', 'log-formula']
+    failed, done = log
+    assert failed['outcome'] == 'failed'
+    assert failed['error'] == 'boom'
+    assert failed['revisions'] == 1
+
+    assert done['outcome'] == 'done'
+    assert done['error'] is None
+    assert done['revisions'] == 2
+    assert done['points'] == 11
+    assert isinstance(done['started'], pd.Timestamp)
+    assert done['started'].tzinfo is not None
+    assert done['wall_time'] >= (
+        done['idates_time'] + done['eval_time'] + done['write_time']
+    )
+    assert done['eval_time'] > 0
+    assert done['write_time'] > 0
+
+    assert len(tsx.cache_refresh_log(policyname='log-policy')) == 2
+    assert len(tsx.cache_refresh_log(policyname='batch-policy')) == 0
+    assert tsx.cache_refresh_log(limit=1) == [failed]
+    assert tsx.cache_refresh_log(
+        from_date=done['started'] + pd.Timedelta(days=1)
+    ) == []
+    assert len(tsx.cache_refresh_log(to_date=done['started'])) == 1
+
+    tsx.delete_cache_policy('log-policy')
+
+
+def test_cache_refresh_plan(engine, tsx, tsa3):
+    tsh = tsa3.tsh
+    for day in (1, 2, 5):
+        tsx.update(
+            'plan-base',
+            genserie(utcdt(2022, 1, day), 'd', 3, [float(day)]),
+            'Babar',
+            insertion_date=utcdt(2022, 1, day)
+        )
+    tsx.register_formula('plan-a', '(+ 1 (series "plan-base"))')
+    tsx.register_formula('plan-b', '(* 2 (series "plan-a"))')
+    for name in ('plan-a', 'plan-b'):
+        tsh.invalidate_cache(engine, name)
+    tsx.new_cache_policy(
+        'plan-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *'
+    )
+    tsx.set_cache_policy('plan-policy', ['plan-b', 'plan-a'])
+    with engine.begin() as cn:
+        cn.execute('delete from tsh.cache_refresh_log')
+
+    plan = tsx.cache_refresh_plan('plan-policy', final_revdate=utcdt(2022, 1, 10))
+    assert plan == [{
+        'name': 'plan-a',
+        'cached': False,
+        'from': pd.Timestamp('2022-1-1', tz='utc'),
+        'to': pd.Timestamp('2022-1-10', tz='utc'),
+        'revdates': 10,
+        'reduced': 3,
+        'components': 1,
+        'idates': 3,
+        'estimate': None
+    }, {
+        'name': 'plan-b',
+        'cached': False,
+        'from': pd.Timestamp('2022-1-1', tz='utc'),
+        'to': pd.Timestamp('2022-1-10', tz='utc'),
+        'revdates': 10,
+        'reduced': 3,
+        'components': 1,
+        'idates': 3,
+        'estimate': None
+    }]
+    assert not tsx.has_cache('plan-a')
+
+    cache.refresh_series(
+        engine, tsa3, 'plan-a',
+        final_revdate=utcdt(2022, 1, 3)
+    )
+    nlogs = len(tsx.cache_refresh_log())
+    hist = tsh.cache.history(engine, 'plan-a')
+
+    # the refresh resumes at the checkpoint, estimates come from
+    # the refresh log (all the series for those never refreshed)
+    plan = tsx.cache_refresh_plan('plan-policy', final_revdate=utcdt(2022, 1, 10))
+    a, b = plan
+    assert a['cached']
+    assert a['from'] == pd.Timestamp('2022-1-2', tz='utc')
+    assert (a['revdates'], a['reduced'], a['idates']) == (9, 2, 2)
+    assert a['estimate'] > 0
+    assert b['estimate'] > 0
+
+    # a new revdate rule
+    a, _ = tsx.cache_refresh_plan(
+        'plan-policy',
+        revdate_rule='0 */6 * * *',
+        final_revdate=utcdt(2022, 1, 10)
+    )
+    assert (a['revdates'], a['reduced']) == (33, 2)
+
+    # nothing was written
+    assert len(tsx.cache_refresh_log()) == nlogs
+    assert list(tsh.cache.history(engine, 'plan-a')) == list(hist)
+
+    # a policy to be created
+    with pytest.raises(ValueError):
+        tsx.cache_refresh_plan('plan-new-policy')
+    plan = tsx.cache_refresh_plan(
+        'plan-new-policy',
+        names=['plan-b'],
+        initial_revdate='(date "2022-1-4")',
+        revdate_rule='0 12 * * *',
+        final_revdate=utcdt(2022, 1, 10)
+    )
+    assert [(step['name'], step['revdates'], step['reduced'])
+            for step in plan] == [('plan-b', 6, 0)]
+
+    tsx.delete_cache_policy('plan-policy')
+
+
 def test_cache(engine, tsx, tsa3):
     with engine.begin() as cn:
         cn.execute('delete from "tsh".cache_policy')
@@ -1,8 +1,17 @@
-from functools import cmp_to_key
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import (
+    cmp_to_key,
+    partial
+)
+import threading
+import time
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 import pytest
+from sqlalchemy import event
 
 from rework import api
 from tshistory.testutil import (
@@ -10,9 +19,16 @@ from tshistory.testutil import (
     assert_hist,
     utcdt
 )
+from tshistory_xl.tsio import timeseries as xlts
 
 from tshistory_refinery import cache
-from tshistory_refinery.helper import comparator, reduce_frequency
+from tshistory_refinery.helper import (
+    comparator,
+    dependency_graph,
+    dependency_levels,
+    reduce_frequency,
+    topological_sort
+)
 
 
 def test_invalid_cache():
@@ -798,9 +814,11 @@ def test_cache_coherency(engine, tsa):
         'ground-formula',
         '(+ 1 (series "ground-3"))'
     )
-    assert not tsh.cache.exists(engine, 'invalidate-me')
+    assert tsh.cache.exists(engine, 'invalidate-me')
+    assert tsh.cache.summary(engine, 'invalidate-me')['outdated']
 
-    # here we see the truth -- the cache has been proeprly wiped
+    # here we see the truth -- the outdated cache is patched with a
+    # live evaluation over the policy window
     assert_df("""
 2022-01-01 00:00:00+00:00    2.0
 2022-01-02 00:00:00+00:00    3.0
@@ -951,6 +969,106 @@ def test_formula_order(engine, tsh):
         'dep-top'
     ]
 
+    with engine.begin() as cn:
+        graph = dependency_graph(cn, tsh, ['dep-top'])
+    assert graph == {
+        'dep-bottom': set(),
+        'dep-middle-left': {'dep-bottom'},
+        'dep-middle-right': {'dep-bottom'},
+        'dep-top': {'dep-middle-left', 'dep-middle-right'}
+    }
+    assert topological_sort(graph) == names
+
+    with engine.begin() as cn:
+        fullgraph = dependency_graph(cn, tsh)
+    for name, needs in graph.items():
+        assert fullgraph[name] == needs
+
+    assert dependency_levels(graph, reversed(names)) == [
+        ['dep-bottom'],
+        ['dep-middle-left', 'dep-middle-right'],
+        ['dep-top']
+    ]
+    # levels are computed within the provided set
+    # (but still through the formulas outside of it)
+    assert dependency_levels(graph, ['dep-top', 'dep-bottom']) == [
+        ['dep-bottom'],
+        ['dep-top']
+    ]
+    assert dependency_levels(graph, ['dep-top', 'dep-middle-left']) == [
+        ['dep-middle-left'],
+        ['dep-top']
+    ]
+
+    # dynamic dependencies
+    tsh.register_formula(
+        engine,
+        'dep-find',
+        '(add (findseries (by.name "dep-middle")))'
+    )
+    with engine.begin() as cn:
+        graph = dependency_graph(cn, tsh, ['dep-find'])
+    assert graph == {
+        'dep-bottom': set(),
+        'dep-find': {'dep-middle-left', 'dep-middle-right'},
+        'dep-middle-left': {'dep-bottom'},
+        'dep-middle-right': {'dep-bottom'}
+    }
+
+
+def test_fetch_concurrently():
+    spans = {}
+
+    def slow(value, delay=.3):
+        start = time.monotonic()
+        time.sleep(delay)
+        spans[value] = start, time.monotonic()
+        return [value]
+
+    results = cache._fetch_concurrently(
+        {name: partial(slow, name) for name in 'abcd'},
+        workers=4
+    )
+    assert results == {'a': ['a'], 'b': ['b'], 'c': ['c'], 'd': ['d']}
+    # the sources are fetched at the same time
+    starts, ends = zip(*spans.values())
+    assert max(starts) < min(ends)
+
+    with pytest.raises(TimeoutError) as err:
+        cache._fetch_concurrently(
+            {
+                'fast': partial(slow, 'fast', .1),
+                'hanging': partial(slow, 'hanging', 5)
+            },
+            timeout=.5
+        )
+    assert str(err.value) == 'no insertion dates after 0.5s from: hanging'
+
+    def broken():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        cache._fetch_concurrently({'broken': broken})
+
+
+def test_topological_sort():
+    assert topological_sort({}) == []
+    assert topological_sort({
+        'c': {'a', 'b'},
+        'b': {'a'},
+        'a': set(),
+        'd': set()
+    }) == ['a', 'd', 'b', 'c']
+
+    with pytest.raises(ValueError) as err:
+        topological_sort({
+            'a': {'b'},
+            'b': {'a'},
+            'c': set()
+        })
+    assert err.value.args[0] == "dependency cycle among ['a', 'b']"
+
+
 def test_formula_order_two_series(engine, tsh):
     ts = pd.Series(
         [1, 2, 3],
@@ -1064,6 +1182,294 @@ def test_refresh_policy(engine, tsa):
         assert not tsa.has_cache(name)
 
 
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_refresh_policy_parallel(engine, tsa, pool):
+    tsh = tsa.tsh
+    with engine.begin() as cn:
+        cn.execute(f'delete from "{tsh.namespace}".cache_policy')
+
+    for i in range(5):
+        ts = pd.Series(
+            [i] * 3,
+            index=pd.date_range(
+                utcdt(2022, 1, 1 + i),
+                freq='d',
+                periods=3
+            )
+        )
+        tsa.update(
+            f'ground-par-{pool}',
+            ts,
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i+1}', tz='utc')
+        )
+
+    tsa.register_formula(
+        f'par-base-{pool}',
+        f'(series "ground-par-{pool}")'
+    )
+    for i in range(4):
+        tsa.register_formula(
+            f'par-{i}-{pool}',
+            f'(+ {i} (series "par-base-{pool}"))'
+        )
+    tsa.register_formula(
+        f'par-top-{pool}',
+        f'(add (series "par-0-{pool}") (series "par-3-{pool}"))'
+    )
+
+    names = [
+        f'par-top-{pool}',
+        f'par-base-{pool}',
+    ] + [f'par-{i}-{pool}' for i in range(4)]
+
+    tsa.new_cache_policy(
+        f'test-refresh-parallel-{pool}',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 1)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy(f'test-refresh-parallel-{pool}', names)
+
+    cache.refresh_policy(
+        tsa,
+        f'test-refresh-parallel-{pool}',
+        final_revdate=pd.Timestamp('2022-1-10', tz='utc'),
+        workers=3,
+        pool=pool
+    )
+
+    for name in names:
+        assert tsa.has_cache(name)
+
+    # the top formula was computed over the cached dependencies
+    assert_df("""
+2022-01-01 00:00:00+00:00     3.0
+2022-01-02 00:00:00+00:00     5.0
+2022-01-03 00:00:00+00:00     7.0
+2022-01-04 00:00:00+00:00     9.0
+2022-01-05 00:00:00+00:00    11.0
+2022-01-06 00:00:00+00:00    11.0
+""", tsh.cache.get(engine, f'par-top-{pool}'))
+
+    tsa.delete_cache_policy(f'test-refresh-parallel-{pool}')
+
+
+def test_refresh_policy_rework(engine, tsa):
+    tsh = tsa.tsh
+    with engine.begin() as cn:
+        cn.execute(f'delete from "{tsh.namespace}".cache_policy')
+
+    tsa.update(
+        'ground-fan',
+        pd.Series(
+            [1., 2., 3.],
+            index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.register_formula('fan-base', '(series "ground-fan")')
+    for i in range(3):
+        tsa.register_formula(f'fan-{i}', f'(+ {i} (series "fan-base"))')
+    tsa.register_formula(
+        'fan-top',
+        '(add (series "fan-0") (series "fan-2"))'
+    )
+    names = ['fan-top', 'fan-base', 'fan-0', 'fan-1', 'fan-2']
+
+    tsa.new_cache_policy(
+        'test-refresh-fan',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 1)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('test-refresh-fan', names)
+
+    # the per series tasks are run by a thread pool standing
+    # for the rework workers
+    class fakeworkers:
+
+        def __init__(self):
+            self.pool = ThreadPoolExecutor(4)
+            self.scheduled = []
+
+        def schedule(self, engine, opname, domain=None, inputdata=None):
+            assert opname == 'refresh_formula_cache_series'
+            assert domain == 'timeseries'
+            self.scheduled.append(inputdata['name'])
+            future = self.pool.submit(
+                cache._refresh_series_safely,
+                tsa,
+                inputdata['name'],
+                inputdata['final_revdate'],
+                inputdata['checkhash'],
+                inputdata['incremental']
+            )
+            return fakeworkers.task(future)
+
+        class task:
+
+            def __init__(self, future):
+                self.future = future
+
+            def join(self):
+                self.future.result()
+
+            @property
+            def state(self):
+                return 'failed' if self.future.result() is False else 'done'
+
+            @property
+            def output(self):
+                # see the `refresh_formula_cache_series` task
+                return 'skipped' if self.future.result() is None else None
+
+    workers = fakeworkers()
+    with patch.object(cache.rapi, 'schedule', workers.schedule):
+        cache.refresh_policy(
+            tsa,
+            'test-refresh-fan',
+            final_revdate=pd.Timestamp('2022-1-10', tz='utc'),
+            pool='rework'
+        )
+    # fan-out by dependency level
+    assert workers.scheduled[0] == 'fan-base'
+    assert sorted(workers.scheduled[1:4]) == ['fan-0', 'fan-1', 'fan-2']
+    assert workers.scheduled[4] == 'fan-top'
+    for name in names:
+        assert tsa.has_cache(name)
+    assert tsh.cache.get(engine, 'fan-top').tolist() == [4., 6., 8.]
+
+    # fan-in: the failures are aggregated
+    refresh_series = cache.refresh_series
+
+    def crashing_refresh(engine, tsa, name, **kw):
+        if name in ('fan-1', 'fan-top'):
+            raise Exception('boom')
+        return refresh_series(engine, tsa, name, **kw)
+
+    workers = fakeworkers()
+    with patch.object(cache.rapi, 'schedule', workers.schedule):
+        with patch.object(cache, 'refresh_series', crashing_refresh):
+            with pytest.raises(Exception) as err:
+                cache.refresh_policy(
+                    tsa,
+                    'test-refresh-fan',
+                    final_revdate=pd.Timestamp('2022-1-11', tz='utc'),
+                    pool='rework'
+                )
+    assert str(err.value) == (
+        "failed series on refresh: ['fan-1', 'fan-top']"
+    )
+    assert len(workers.scheduled) == 5
+
+    tsa.delete_cache_policy('test-refresh-fan')
+
+
+def test_refresh_policy_cooperative(engine, tsa):
+    tsh = tsa.tsh
+    with engine.begin() as cn:
+        cn.execute(f'delete from "{tsh.namespace}".cache_policy')
+
+    tsa.update(
+        'ground-coop',
+        pd.Series(
+            [1., 2., 3.],
+            index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.register_formula('coop-base', '(series "ground-coop")')
+    tsa.register_formula('coop-middle', '(+ 1 (series "coop-base"))')
+    for i in range(4):
+        tsa.register_formula(f'coop-{i}', f'(+ {i} (series "coop-middle"))')
+    names = ['coop-base', 'coop-middle'] + [f'coop-{i}' for i in range(4)]
+
+    tsa.new_cache_policy(
+        'test-refresh-coop',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 1)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('test-refresh-coop', names)
+
+    # the non blocking lock
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with cache.series_refresh_lock(engine, 'coop-base', tsh.namespace):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    with cache.series_refresh_lock(
+            engine, 'coop-base', tsh.namespace, wait=False) as mine:
+        assert not mine
+    release.set()
+    thread.join()
+    with cache.series_refresh_lock(
+            engine, 'coop-base', tsh.namespace, wait=False) as mine:
+        assert mine
+        # reentrant
+        with cache.series_refresh_lock(engine, 'coop-base', tsh.namespace):
+            pass
+
+    # two nodes drain the policy
+    refreshed = []
+    refresh_series = cache.refresh_series
+
+    def tracing_refresh(engine, tsa, name, **kw):
+        start = time.monotonic()
+        refresh_series(engine, tsa, name, **kw)
+        refreshed.append(
+            (name, threading.current_thread().name, start, time.monotonic())
+        )
+        time.sleep(.2)
+
+    def node():
+        cache.refresh_policy_cooperative(
+            tsa,
+            'test-refresh-coop',
+            final_revdate=pd.Timestamp('2022-1-10', tz='utc'),
+            poll=.05
+        )
+
+    with patch.object(cache, 'refresh_series', tracing_refresh):
+        nodes = [
+            threading.Thread(target=node, name=f'node-{i}')
+            for i in range(2)
+        ]
+        for thread in nodes:
+            thread.start()
+        for thread in nodes:
+            thread.join()
+
+    # each series was refreshed once, after its dependencies
+    assert sorted(name for name, *_ in refreshed) == sorted(names)
+    times = {name: (start, end) for name, _, start, end in refreshed}
+    assert times['coop-base'][1] <= times['coop-middle'][0]
+    for i in range(4):
+        assert times['coop-middle'][1] <= times[f'coop-{i}'][0]
+    # and the work was shared
+    assert len({node for _, node, *_ in refreshed}) == 2
+    for name in names:
+        assert tsa.has_cache(name)
+    assert tsh.cache.get(engine, 'coop-3').tolist() == [5., 6., 7.]
+
+    tsa.delete_cache_policy('test-refresh-coop')
+
+
 def test_cache_refresh_series_now(engine, tsa):
     tsh = tsa.tsh
 
@@ -1366,6 +1772,51 @@ def test_reduce_cron():
     ] == reduce_frequency(cronlist, idates_overlap_both)
 
 
+def test_reduce_cron_bench():
+    # a minutely revdate rule over two years
+    cronlist = pd.date_range(
+        utcdt(2020, 1, 1),
+        freq='min',
+        periods=10 ** 6
+    ).to_pydatetime()
+    # an hourly upstream
+    idates = list(
+        pd.date_range(utcdt(2020, 1, 1, 0, 0, 30), freq='h', periods=16000)
+    )
+
+    class counting:
+
+        def __init__(self, items):
+            self.items = iter(items)
+            self.count = 0
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            item = next(self.items)
+            self.count += 1
+            return item
+
+    tempo = counting(cronlist)
+    t0 = time.perf_counter()
+    reduced = reduce_frequency(tempo, idates)
+    elapsed = time.perf_counter() - t0
+    print(f'reduce 10^6 cron dates / {len(idates)} idates: {elapsed:.3}s')
+    assert len(reduced) == len(idates)
+    assert reduced[:2] == [utcdt(2020, 1, 1, 0, 1), utcdt(2020, 1, 1, 1, 1)]
+    # the cron stream is not consumed past the last insertion date
+    # (but for the end of its block)
+    lastidx = cronlist.searchsorted(idates[-1])
+    assert lastidx < tempo.count <= lastidx + 4096
+    assert tempo.count < len(cronlist)
+
+    tempo = counting(cronlist)
+    reduced = reduce_frequency(tempo, idates[:10])
+    assert len(reduced) == 10
+    assert tempo.count == 4096
+
+
 def test_values_marker_origin_and_cache(engine, tsa):
     ts = pd.Series(
         [1.] * 3,
@@ -1715,62 +2166,548 @@ def test_refresh_using_middle_cache(engine, tsa):
     assert len(tsa.get('cache-top', nocache=True)) == 2
 
 
-def test_interaction_hijack_and_cache(engine, tsa):
-    """
-    Since both the cache and the hijack_formula
-    use the .exanded_formula with stopnames, this test checks
-    if no bad interaction occured between the twos.
+def test_refresh_insertion_dates(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(4):
+        tsa.update(
+            'union-idates-a',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(utcdt(2022, 1, 1 + i), freq='d', periods=3)
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1}', tz='utc')
+        )
+        tsa.update(
+            'union-idates-b',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(utcdt(2022, 1, 1 + i), freq='d', periods=3)
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1} 12:00', tz='utc')
+        )
+    tsa.register_formula(
+        'union-idates-cached', '(* 2 (series "union-idates-b"))'
+    )
+    tsa.register_formula(
+        'union-idates-top',
+        '(add (series "union-idates-a") (series "union-idates-cached"))'
+    )
+    tsa.new_cache_policy(
+        'union-idates-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('union-idates-policy', ['union-idates-cached'])
+    cache.refresh_policy(
+        tsa,
+        'union-idates-policy',
+        final_revdate=pd.Timestamp('2022-1-5', tz='utc')
+    )
 
-    We build a dependency formula tree as follow
-    A -> B -> C
-    with B cached and C hijacked by a group.
-    We want to make sure that the expanded formula used in the hijacking
-    can reach C without being stoped at B
-    """
+    def baseline(component, **bounds):
+        return sorted(
+            set(tsh.insertion_dates(engine, 'union-idates-a', **bounds)) |
+            set(component(engine, 'union-idates-cached', **bounds))
+        )
 
-    ts = pd.Series(
-        [1., 2., 3.],
-        index=pd.date_range(
-            pd.Timestamp('2022-1-1'),
-            freq='d', periods=3
+    bounds = {
+        'from_insertion_date': pd.Timestamp('2022-1-2', tz='utc'),
+        'to_insertion_date': pd.Timestamp('2022-1-3 12:00', tz='utc')
+    }
+    # the cached component revisions are used
+    cacheidates = tsh.cache.insertion_dates(engine, 'union-idates-cached')
+    assert cacheidates != tsh.insertion_dates(engine, 'union-idates-b')
+    for kw in ({}, bounds):
+        assert cache._insertion_dates(
+            tsa, 'union-idates-top', **kw
+        ) == baseline(tsh.cache.insertion_dates, **kw)
+
+    # an outdated cache has the revisions of its formula
+    tsa.register_formula(
+        'union-idates-cached', '(* 3 (series "union-idates-b"))'
+    )
+    assert tsh.cache.summary(engine, 'union-idates-cached')['outdated']
+    for kw in ({}, bounds):
+        idates = cache._insertion_dates(tsa, 'union-idates-top', **kw)
+        assert idates == baseline(tsh.insertion_dates, **kw)
+        assert idates == sorted(
+            set(tsh.insertion_dates(engine, 'union-idates-a', **kw)) |
+            set(tsh.insertion_dates(engine, 'union-idates-b', **kw))
         )
-    )
 
-    group = pd.DataFrame(
-        [[0, 1, 2], [1, 2, 3], [2, 3, 4]],
-        index=pd.date_range(
-            pd.Timestamp('2022-1-1'),
-            freq='d', periods=3
+
+def test_batched_refresh(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(10):
+        tsa.update(
+            'batch-base',
+            pd.Series(
+                [i, i + .5, i + 1, i + 1.5],
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=4
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1} 12:00', tz='utc')
+        )
+    # a point erasure
+    tsa.update(
+        'batch-base',
+        pd.Series(
+            [np.nan],
+            index=[pd.Timestamp('2022-1-12', tz='utc')]
         ),
-        columns=['a', 'b', 'c']
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-12', tz='utc')
+    )
+    tsa.update(
+        'batch-other',
+        pd.Series(
+            [1.] * 20,
+            index=pd.date_range(
+                pd.Timestamp('2022-1-1', tz='utc'),
+                freq='d',
+                periods=20
+            )
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-5', tz='utc')
     )
 
-    tsa.update('ts-c', ts, 'oim', insertion_date=pd.Timestamp('2022-1-1', tz='UTC'))
-    tsa.register_formula('ts-b', """(series "ts-c")""")
-    tsa.register_formula('ts-a', """(series "ts-b")""")
+    tsa.new_cache_policy(
+        'batch-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -2)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 */6 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.register_formula(
+        'batch-middle',
+        '(+ 1 (series "batch-base"))'
+    )
+    tsa.set_cache_policy('batch-policy', ['batch-middle'])
+    cache.refresh_series(
+        engine,
+        tsa,
+        'batch-middle',
+        final_revdate=pd.Timestamp('2022-1-6', tz='utc')
+    )
 
-    assert_df("""
-2022-01-01    1.0
-2022-01-02    2.0
-2022-01-03    3.0
-    """, tsa.get('ts-a'))
+    for mode in ('batched', 'unbatched'):
+        tsa.register_formula(
+            f'batch-top-{mode}',
+            '(add (series "batch-middle") '
+            '     (series "batch-base") '
+            '     (series "batch-other" #:fill 0))'
+        )
+        tsa.set_cache_policy('batch-policy', [f'batch-top-{mode}'])
+        for final in ('2022-1-3', '2022-1-15'):
+            cache.refresh_series(
+                engine,
+                tsa,
+                f'batch-top-{mode}',
+                final_revdate=pd.Timestamp(final, tz='utc'),
+                batched=mode == 'batched'
+            )
 
-    tsa.group_replace('group-y', group, 'oim')
-    binding = pd.DataFrame(
-        [['ts-c', 'group-y', 'whatever']],
-        columns=['series', 'group', 'family']
-    )
+    batched = tsh.cache.history(engine, 'batch-top-batched')
+    unbatched = tsh.cache.history(engine, 'batch-top-unbatched')
+    assert len(batched) == len(unbatched) == 9
+    for idate, ts in batched.items():
+        assert ts.equals(unbatched[idate])
 
-    tsa.register_formula_bindings(
-        'hijacked-formula',
-        'ts-a',
-        bindings=binding,
-    )
+    # the state of a component before the refreshed range is read once
+    reads = []
+    get = xlts.get
 
-    df = tsa.group_get('hijacked-formula')
+    def countingget(self, cn, name, **kw):
+        reads.append(name)
+        return get(self, cn, name, **kw)
 
-    assert_df("""
-              a    b    c
+    revdates = [
+        pd.Timestamp(f'2022-1-{day}', tz='utc')
+        for day in (5, 8, 13)
+    ]
+    with engine.begin() as cn:
+        expected = [
+            tsh.get(cn, 'batch-base', revision_date=revdate)
+            for revdate in revdates
+        ]
+        with patch.object(xlts, 'get', countingget):
+            history = cache._component_history(
+                cn, tsh, 'batch-base',
+                pd.Timestamp('2022-1-5', tz='utc'),
+                pd.Timestamp('2022-1-15', tz='utc')
+            )
+            for revdate, ts in zip(revdates, expected):
+                assert history.get(revdate).equals(ts)
+    assert reads == ['batch-base']
+
+
+def test_incremental_refresh(engine, tsa):
+    tsh = tsa.tsh
+    assert cache.is_pointwise(['add', ['series', 'a'], ['series', 'b']])
+    assert cache.is_pointwise(['series', 'a', 'fill', 0])
+    assert not cache.is_pointwise(['series', 'a', 'fill', 'ffill'])
+    assert not cache.is_pointwise(['resample', ['series', 'a'], 'D'])
+
+    for i in range(10):
+        tsa.update(
+            'incr-base',
+            pd.Series(
+                [i, i + .5, i + 1, i + 1.5],
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=4
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1} 12:00', tz='utc')
+        )
+    # a change in the past, out of the look window
+    tsa.update(
+        'incr-base',
+        pd.Series(
+            [42.],
+            index=[pd.Timestamp('2022-1-2', tz='utc')]
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-11 3:00', tz='utc')
+    )
+    tsa.update(
+        'incr-other',
+        pd.Series(
+            [1.] * 20,
+            index=pd.date_range(
+                pd.Timestamp('2022-1-1', tz='utc'),
+                freq='d',
+                periods=20
+            )
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-5', tz='utc')
+    )
+
+    tsa.new_cache_policy(
+        'incr-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -2)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 */6 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    for mode in ('full', 'incremental'):
+        tsa.register_formula(
+            f'incr-{mode}',
+            '(add (* 2 (series "incr-base")) '
+            '     (series "incr-other" #:fill 0))'
+        )
+        tsa.set_cache_policy('incr-policy', [f'incr-{mode}'])
+        for final in ('2022-1-3', '2022-1-15'):
+            cache.refresh_series(
+                engine,
+                tsa,
+                f'incr-{mode}',
+                final_revdate=pd.Timestamp(final, tz='utc'),
+                incremental=mode != 'full'
+            )
+
+    full = tsh.cache.history(engine, 'incr-full')
+    incremental = tsh.cache.history(engine, 'incr-incremental')
+    assert len(full) == len(incremental) == 10
+    for idate, ts in full.items():
+        assert ts.equals(incremental[idate])
+
+    # the out of window change did not leak in the cache
+    assert full[max(full)][pd.Timestamp('2022-1-2', tz='utc')] == 2
+
+
+def test_resumable_refresh(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(10):
+        tsa.update(
+            'resume-base',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=3
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1} 12:00', tz='utc')
+        )
+
+    tsa.new_cache_policy(
+        'resume-policy',
+        initial_revdate='(date "2022-1-2")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 */6 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    for name in ('resume-ref', 'resume-crash'):
+        tsa.register_formula(
+            name,
+            '(+ 1 (series "resume-base"))'
+        )
+    tsa.set_cache_policy('resume-policy', ['resume-ref', 'resume-crash'])
+
+    # the initial full horizon import
+    for name in ('resume-ref', 'resume-crash'):
+        cache.refresh_series(
+            engine, tsa, name,
+            final_revdate=pd.Timestamp('2022-1-2 1:00', tz='utc')
+        )
+        assert len(tsh.cache.insertion_dates(engine, name)) == 1
+
+    final = pd.Timestamp('2022-1-15', tz='utc')
+    cache.refresh_series(engine, tsa, 'resume-ref', final_revdate=final)
+
+    # the process dies while computing the third chunk
+    evaluations = []
+    formula_evaluator = cache.formula_evaluator
+
+    class crash(Exception):
+        pass
+
+    @contextmanager
+    def crashing_evaluator(*args, **kw):
+        with formula_evaluator(*args, **kw) as evaluate:
+            def crashing(revdate, fromdate, todate):
+                evaluations.append(revdate)
+                if len(evaluations) == 5:
+                    raise crash()
+                return evaluate(revdate, fromdate, todate)
+            yield crashing
+
+    with patch.object(cache, 'formula_evaluator', crashing_evaluator):
+        with pytest.raises(crash):
+            cache.refresh_series(
+                engine, tsa, 'resume-crash',
+                final_revdate=final,
+                chunksize=2
+            )
+
+    # two chunks made it
+    assert len(tsh.cache.insertion_dates(engine, 'resume-crash')) == 5
+    with engine.begin() as cn:
+        checkpoint = cache.refresh_checkpoint(cn, 'resume-crash', tsh.namespace)
+    assert checkpoint == evaluations[3]
+
+    # the next run resumes from there
+    cache.refresh_series(engine, tsa, 'resume-crash', final_revdate=final)
+    ref = tsh.cache.history(engine, 'resume-ref')
+    resumed = tsh.cache.history(engine, 'resume-crash')
+    assert list(ref) == list(resumed)
+    for idate, ts in ref.items():
+        assert ts.values.tolist() == resumed[idate].values.tolist()
+
+    with engine.begin() as cn:
+        assert cache.refresh_checkpoint(cn, 'resume-crash', tsh.namespace) > checkpoint
+    # the checkpoint goes away with the cache
+    tsh.invalidate_cache(engine, 'resume-crash')
+    with engine.begin() as cn:
+        assert cache.refresh_checkpoint(cn, 'resume-crash', tsh.namespace) is None
+
+
+def test_name_stopper_prefetch(engine, tsa):
+    tsh = tsa.tsh
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+    )
+    for idx in range(20):
+        tsa.update(
+            f'stop-base-{idx}', ts, 'Babar',
+            insertion_date=utcdt(2022, 1, 1)
+        )
+    tsa.register_formula(
+        'stop-cached',
+        '(add (series "stop-base-0") (series "stop-base-1"))'
+    )
+    tsa.new_cache_policy(
+        'stop-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -2)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('stop-policy', ['stop-cached'])
+    cache.refresh_series(
+        engine, tsa, 'stop-cached',
+        final_revdate=utcdt(2022, 1, 2)
+    )
+    tsa.register_formula(
+        'stop-wide',
+        '(add (series "stop-cached") ' + ' '.join(
+            f'(series "stop-base-{idx}")'
+            for idx in range(20)
+        ) + ')'
+    )
+
+    queries = []
+
+    def count(conn, cursor, statement, *a):
+        if 'cache".registry' in statement:
+            queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        with engine.begin() as cn:
+            tree = tsh._expanded_formula(
+                cn, tsh.formula(cn, 'stop-wide'), qargs={}
+            )
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    # the cached formula is not expanded
+    assert tree[1] == ['series', 'stop-cached']
+    assert len(queries) == 1
+
+
+def test_read_cache(engine, tsa):
+    tsh = tsa.tsh
+    tsa.update(
+        'rc-base',
+        pd.Series(
+            [1., 2., 3.],
+            index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+        ),
+        'Babar',
+        insertion_date=utcdt(2022, 1, 1)
+    )
+    tsa.register_formula('rc-formula', '(+ 1 (series "rc-base"))')
+    tsa.new_cache_policy(
+        'rc-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -2)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('rc-policy', ['rc-formula'])
+    cache.refresh_series(
+        engine, tsa, 'rc-formula',
+        final_revdate=utcdt(2022, 1, 1, 12)
+    )
+
+    queries = []
+
+    def count(conn, cursor, statement, *a):
+        # the series data reads (snapshots or head)
+        if (f'"{tsh.cache.namespace}.' in statement or
+            f'"{tsh.cache.namespace}".head' in statement):
+            queries.append(statement)
+
+    def wait_for(condition):
+        for _ in range(50):
+            if condition():
+                return
+            time.sleep(.1)
+        raise AssertionError('timeout')
+
+    tsh.enable_read_cache(engine, maxitems=10)
+    event.listen(tsa.engine, 'before_cursor_execute', count)
+    try:
+        wait_for(tsh.readcache.listening.is_set)
+        ts = tsa.get('rc-formula')
+        assert ts.tolist() == [2., 3., 4.]
+        assert len(queries)
+        queries.clear()
+
+        # served from memory
+        ts[:] = 0  # mutating the result does no harm
+        assert tsa.get('rc-formula').tolist() == [2., 3., 4.]
+        assert not queries
+        # a different query
+        assert tsa.get(
+            'rc-formula', from_value_date=utcdt(2022, 1, 2)
+        ).tolist() == [3., 4.]
+        assert len(queries)
+
+        # a cache write invalidates the series reads
+        tsh.cache.update(
+            engine,
+            pd.Series([42.], index=[utcdt(2022, 1, 3)]),
+            'rc-formula',
+            'Babar',
+            insertion_date=pd.Timestamp.utcnow()
+        )
+        wait_for(lambda: not tsh.readcache.items)
+        assert tsa.get('rc-formula').tolist() == [2., 3., 42.]
+    finally:
+        event.remove(tsa.engine, 'before_cursor_execute', count)
+        tsh.disable_read_cache()
+
+
+def test_interaction_hijack_and_cache(engine, tsa):
+    """
+    Since both the cache and the hijack_formula
+    use the .exanded_formula with stopnames, this test checks
+    if no bad interaction occured between the twos.
+
+    We build a dependency formula tree as follow
+    A -> B -> C
+    with B cached and C hijacked by a group.
+    We want to make sure that the expanded formula used in the hijacking
+    can reach C without being stoped at B
+    """
+
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(
+            pd.Timestamp('2022-1-1'),
+            freq='d', periods=3
+        )
+    )
+
+    group = pd.DataFrame(
+        [[0, 1, 2], [1, 2, 3], [2, 3, 4]],
+        index=pd.date_range(
+            pd.Timestamp('2022-1-1'),
+            freq='d', periods=3
+        ),
+        columns=['a', 'b', 'c']
+    )
+
+    tsa.update('ts-c', ts, 'oim', insertion_date=pd.Timestamp('2022-1-1', tz='UTC'))
+    tsa.register_formula('ts-b', """(series "ts-c")""")
+    tsa.register_formula('ts-a', """(series "ts-b")""")
+
+    assert_df("""
+2022-01-01    1.0
+2022-01-02    2.0
+2022-01-03    3.0
+    """, tsa.get('ts-a'))
+
+    tsa.group_replace('group-y', group, 'oim')
+    binding = pd.DataFrame(
+        [['ts-c', 'group-y', 'whatever']],
+        columns=['series', 'group', 'family']
+    )
+
+    tsa.register_formula_bindings(
+        'hijacked-formula',
+        'ts-a',
+        bindings=binding,
+    )
+
+    df = tsa.group_get('hijacked-formula')
+
+    assert_df("""
+              a    b    c
 2022-01-01  0.0  1.0  2.0
 2022-01-02  1.0  2.0  3.0
 2022-01-03  2.0  3.0  4.0
@@ -2089,3 +3026,962 @@ def test_cache_slice(tsa):
         tsa.get(formula_name),
         tsa.get(formula_name, nocache=True)
     )
+
+
+def test_policy_staleness(engine, tsa):
+    tsh = tsa.tsh
+    policy = {
+        'revdate_rule': '0 0 * * *',
+        'schedule_rule': '0 1 * * *'
+    }
+    # the next revision is due on the 16th, the refresh after it
+    # would run on the 16th at 1:00 -- one more and it is stale
+    assert cache.stale_after(
+        policy, pd.Timestamp('2022-1-15', tz='utc')
+    ) == pd.Timestamp('2022-1-17 1:00', tz='utc')
+    assert cache.stale_after(
+        policy, pd.Timestamp('2022-1-15 12:00', tz='utc')
+    ) == pd.Timestamp('2022-1-17 1:00', tz='utc')
+
+    for i in range(5):
+        tsa.update(
+            'stale-base',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=3
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1} 12:00', tz='utc')
+        )
+
+    tsa.new_cache_policy(
+        'stale-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 1 * * *',
+    )
+    tsa.register_formula(
+        'stale-formula',
+        '(+ 1 (series "stale-base"))'
+    )
+    tsa.set_cache_policy('stale-policy', ['stale-formula'])
+
+    cache.refresh_series(
+        engine, tsa, 'stale-formula',
+        final_revdate=pd.Timestamp('2022-1-15', tz='utc')
+    )
+    # the last revision is from the 6th, but the refresh saw
+    # everything up to the 15th
+    assert tsh.cache.insertion_dates(engine, 'stale-formula')[-1] == (
+        pd.Timestamp('2022-1-6', tz='utc')
+    )
+    with engine.begin() as cn:
+        assert cache.series_stale_after(
+            cn, 'stale-formula', tsh.namespace
+        ) == pd.Timestamp('2022-1-17 1:00', tz='utc')
+
+    calls = []
+    _get_live = tsh._get_live
+
+    def get_live(*args):
+        calls.append(args[1])
+        return _get_live(*args)
+
+    with patch.object(tsh, '_get_live', get_live):
+        tsa.get('stale-formula')
+        assert calls == ['stale-formula']
+
+        # a quiet series refreshed up to now is not stale
+        cache.refresh_series(engine, tsa, 'stale-formula')
+        tsa.get('stale-formula')
+        assert calls == ['stale-formula']
+
+    # editing the policy updates the expectation
+    tsa.edit_cache_policy(
+        'stale-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 1 * *',
+        schedule_rule='0 1 * * *',
+    )
+    with engine.begin() as cn:
+        watermark = cn.execute(
+            f'select cp.watermark '
+            f'from "{tsh.namespace}".cache_refresh_checkpoint as cp, '
+            f'     "{tsh.namespace}-cache".registry as r '
+            f'where cp.series_id = r.id and '
+            f'      r.name = \'stale-formula\''
+        ).scalar()
+        assert watermark > pd.Timestamp('2022-1-15', tz='utc')
+        assert cache.series_stale_after(
+            cn, 'stale-formula', tsh.namespace
+        ) == cache.stale_after(
+            {'revdate_rule': '0 0 1 * *', 'schedule_rule': '0 1 * * *'},
+            watermark
+        )
+
+
+def test_live_overlaps_cache_read(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(3):
+        tsa.update(
+            'overlap-base',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=3
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1}', tz='utc')
+        )
+
+    tsa.new_cache_policy(
+        'overlap-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 1 * * *',
+    )
+    tsa.register_formula(
+        'overlap-formula',
+        '(+ 1 (series "overlap-base"))'
+    )
+    tsa.set_cache_policy('overlap-policy', ['overlap-formula'])
+    cache.refresh_series(
+        engine, tsa, 'overlap-formula',
+        final_revdate=pd.Timestamp('2022-1-2 1:00', tz='utc')
+    )
+    assert len(tsh.cache.insertion_dates(engine, 'overlap-formula')) == 2
+
+    # the cache is stale: each side waits for the other one to start
+    reading = threading.Event()
+    evaluating = threading.Event()
+    connections = []
+    _cached_read = tsh._cached_read
+    _live_tail = tsh._live_tail
+
+    def cached_read(cn, name, kw):
+        connections.append(cn)
+        reading.set()
+        assert evaluating.wait(5)
+        return _cached_read(cn, name, kw)
+
+    def live_tail(engine, name, kw):
+        evaluating.set()
+        assert reading.wait(5)
+        return _live_tail(engine, name, kw)
+
+    with patch.object(tsh, '_cached_read', cached_read), \
+         patch.object(tsh, '_live_tail', live_tail):
+        ts = tsa.get('overlap-formula')
+
+    assert len(connections) == 1
+    assert ts.equals(tsa.get('overlap-formula', nocache=True))
+
+
+def test_live_sees_transaction_writes(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(2):
+        tsa.update(
+            'txlive-base',
+            pd.Series(
+                [1.] * 3,
+                index=pd.date_range(
+                    utcdt(2022, 1, 1 + i), freq='d', periods=3
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1}', tz='utc')
+        )
+    tsa.new_cache_policy(
+        'txlive-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 1 * * *',
+    )
+    tsa.register_formula('txlive-formula', '(+ 1 (series "txlive-base"))')
+    tsa.set_cache_policy('txlive-policy', ['txlive-formula'])
+    cache.refresh_series(
+        engine, tsa, 'txlive-formula',
+        final_revdate=pd.Timestamp('2022-1-2 1:00', tz='utc')
+    )
+
+    # the cache is stale: the live part of a read within a transaction
+    # sees its pending writes
+    with engine.begin() as cn:
+        tsh.update(
+            cn,
+            pd.Series([42.], index=[utcdt(2022, 1, 4)]),
+            'txlive-base',
+            'Babar',
+            insertion_date=pd.Timestamp('2022-1-3', tz='utc')
+        )
+        ts = tsh.get(cn, 'txlive-formula')
+    assert ts.tolist() == [2., 2., 2., 43.]
+
+
+def test_live_single_flight(engine, tsa):
+    tsa.update(
+        'sf-base',
+        pd.Series(
+            [1., 2., 3.],
+            index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+        ),
+        'Babar'
+    )
+    tsa.register_formula('sf-formula', '(+ 1 (series "sf-base"))')
+
+    evaluations = []
+    release = threading.Event()
+    get = xlts.get
+
+    def slowget(self, cn, name, **kw):
+        if name == 'sf-formula':
+            evaluations.append(kw)
+            assert release.wait(5)
+        return get(self, cn, name, **kw)
+
+    results = []
+    with patch.object(xlts, 'get', slowget):
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(tsa.get('sf-formula'))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        # let them all reach the in-flight evaluation
+        time.sleep(.5)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert len(evaluations) == 1
+    assert len(results) == 5
+    for ts in results:
+        assert ts.tolist() == [2., 3., 4.]
+    # not shared objects
+    assert len({id(ts) for ts in results}) == 5
+
+    # different bounds, different evaluations
+    evaluations.clear()
+    release.clear()
+    with patch.object(xlts, 'get', slowget):
+        release.set()
+        tsa.get('sf-formula')
+        tsa.get('sf-formula', from_value_date=utcdt(2022, 1, 2))
+    assert len(evaluations) == 2
+
+    # a read within a transaction does not join an evaluation running
+    # on another connection: it sees its pending writes
+    reading = threading.Event()
+    release.clear()
+
+    def blockedget(self, cn, name, **kw):
+        if name == 'sf-formula' and threading.current_thread() is reader:
+            reading.set()
+            assert release.wait(5)
+        return get(self, cn, name, **kw)
+
+    with patch.object(xlts, 'get', blockedget):
+        reader = threading.Thread(
+            target=lambda: tsa.tsh.get(engine, 'sf-formula')
+        )
+        reader.start()
+        assert reading.wait(5)
+        with engine.begin() as cn:
+            tsa.tsh.update(
+                cn,
+                pd.Series([41.], index=[utcdt(2022, 1, 1)]),
+                'sf-base',
+                'Babar'
+            )
+            ts = tsa.tsh.get(cn, 'sf-formula')
+        release.set()
+        reader.join()
+    assert ts.tolist() == [42., 3., 4.]
+
+
+def test_shadow_rebuild(engine, tsa):
+    tsh = tsa.tsh
+    for i in range(6):
+        tsa.update(
+            'shadow-base',
+            pd.Series(
+                [i] * 3,
+                index=pd.date_range(
+                    pd.Timestamp(f'2022-1-{i + 1}', tz='utc'),
+                    freq='d',
+                    periods=3
+                )
+            ),
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i + 1}', tz='utc')
+        )
+
+    tsa.new_cache_policy(
+        'shadow-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -1)',
+        look_after='(shifted now #:days 3)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 1 * * *',
+    )
+    tsa.register_formula('shadow-formula', '(+ 1 (series "shadow-base"))')
+    tsa.register_formula('shadow-ref', '(+ 2 (series "shadow-base"))')
+    tsa.set_cache_policy('shadow-policy', ['shadow-formula', 'shadow-ref'])
+    final = pd.Timestamp('2022-1-6', tz='utc')
+    for name in ('shadow-formula', 'shadow-ref'):
+        cache.refresh_series(engine, tsa, name, final_revdate=final)
+    old = tsh.cache.history(engine, 'shadow-formula')
+
+    # the formula changes: the cache is kept, flagged as outdated
+    tsa.register_formula('shadow-formula', '(+ 2 (series "shadow-base"))')
+    assert tsh.cache.summary(engine, 'shadow-formula')['outdated']
+    shadow = cache.shadow_name('shadow-formula')
+    assert not tsh.cache.exists(engine, shadow)
+    # live over the policy window, the rest is from the old cache
+    ts = tsa.get('shadow-formula')
+    live = tsa.get('shadow-formula', nocache=True)
+    assert ts['2022-1-5':].equals(live['2022-1-5':])
+    assert ts[:'2022-1-4'].tolist() == [1., 2., 3., 4.]
+
+    # an interrupted rebuild leaves the outdated cache untouched
+    formula_evaluator = cache.formula_evaluator
+
+    class crash(Exception):
+        pass
+
+    @contextmanager
+    def crashing_evaluator(*args, **kw):
+        with formula_evaluator(*args, **kw) as evaluate:
+            def crashing(revdate, fromdate, todate):
+                if revdate > pd.Timestamp('2022-1-3', tz='utc'):
+                    raise crash()
+                return evaluate(revdate, fromdate, todate)
+            yield crashing
+
+    with patch.object(cache, 'formula_evaluator', crashing_evaluator):
+        with pytest.raises(crash):
+            cache.refresh_series(
+                engine, tsa, 'shadow-formula',
+                final_revdate=final,
+                chunksize=1
+            )
+    assert tsh.cache.exists(engine, shadow)
+    assert tsh.cache.summary(engine, 'shadow-formula')['outdated']
+    hist = tsh.cache.history(engine, 'shadow-formula')
+    assert list(hist) == list(old)
+
+    # the resumed rebuild is swapped in
+    cache.refresh_series(engine, tsa, 'shadow-formula', final_revdate=final)
+    assert not tsh.cache.exists(engine, shadow)
+    assert not tsh.cache.summary(engine, 'shadow-formula')['outdated']
+    ref = tsh.cache.history(engine, 'shadow-ref')
+    rebuilt = tsh.cache.history(engine, 'shadow-formula')
+    assert list(ref) == list(rebuilt)
+    for idate, ts in ref.items():
+        assert ts.values.tolist() == rebuilt[idate].values.tolist()
+    with engine.begin() as cn:
+        assert cache.series_stale_after(
+            cn, 'shadow-formula', tsh.namespace
+        ) is not None
+
+    # a new edit drops an ongoing rebuild
+    tsa.register_formula('shadow-formula', '(+ 3 (series "shadow-base"))')
+    with patch.object(cache, 'formula_evaluator', crashing_evaluator):
+        with pytest.raises(crash):
+            cache.refresh_series(
+                engine, tsa, 'shadow-formula',
+                final_revdate=final,
+                chunksize=1
+            )
+    assert tsh.cache.exists(engine, shadow)
+    tsa.register_formula('shadow-formula', '(+ 4 (series "shadow-base"))')
+    assert not tsh.cache.exists(engine, shadow)
+    assert tsh.cache.summary(engine, 'shadow-formula')['outdated']
+
+
+def test_dirty_refresh(engine, tsa):
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    for i in range(5):
+        ts = pd.Series(
+            [i] * 3,
+            index=pd.date_range(
+                utcdt(2022, 1, 1 + i),
+                freq='d',
+                periods=3
+            )
+        )
+        tsa.update(
+            'dirty-base',
+            ts,
+            'Babar',
+            insertion_date=pd.Timestamp(f'2022-1-{i+1}', tz='utc')
+        )
+    tsa.register_formula('dirty-f1', '(series "dirty-base")')
+    tsa.register_formula('dirty-f2', '(* 2 (series "dirty-f1"))')
+    tsa.register_formula(
+        'dirty-now',
+        '(slice (series "dirty-base") #:fromdate (shifted (now) #:days -10000))'
+    )
+
+    tsa.new_cache_policy(
+        'dirty-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    names = ['dirty-f1', 'dirty-f2', 'dirty-now']
+    tsa.set_cache_policy('dirty-policy', names)
+    with engine.begin() as cn:
+        assert cache.dirty_series(cn, names, ns) == set(names)
+
+    refreshed = []
+    refresh_series = cache.refresh_series
+
+    def tracing_refresh(engine, tsa, name, **kw):
+        refreshed.append(name)
+        return refresh_series(engine, tsa, name, **kw)
+
+    with patch.object(cache, 'refresh_series', tracing_refresh):
+        cache.refresh_policy(
+            tsa,
+            'dirty-policy',
+            final_revdate=pd.Timestamp('2022-1-5', tz='utc'),
+            dirty_only=True
+        )
+    # uncached series are always built
+    assert sorted(refreshed) == names
+
+    with engine.begin() as cn:
+        # the inputs of a formula depending on the time stay unknown
+        assert cache.dirty_series(cn, names, ns) == {'dirty-now'}
+        inputs = cn.execute(
+            f'select f.name, r.name '
+            f'from "{ns}".cache_input as ci, '
+            f'     "{ns}".registry as f, '
+            f'     "{ns}".registry as r '
+            f'where ci.series_id = f.id and ci.input_id = r.id and '
+            f'      f.name like \'dirty-%%\' '
+            f'order by f.name'
+        ).fetchall()
+        # the refresh reads the cached formulas
+        assert inputs == [
+            ('dirty-f1', 'dirty-base'),
+            ('dirty-f2', 'dirty-f1')
+        ]
+
+    # nothing was written upstream: the clean series are skipped
+    # but their watermark moves forward
+    refreshed.clear()
+    with patch.object(cache, 'refresh_series', tracing_refresh):
+        cache.refresh_policy(
+            tsa,
+            'dirty-policy',
+            final_revdate=pd.Timestamp('2022-1-6', tz='utc'),
+            dirty_only=True
+        )
+    assert refreshed == ['dirty-now']
+    with engine.begin() as cn:
+        assert cn.execute(
+            f'select cp.watermark '
+            f'from "{ns}".cache_refresh_checkpoint as cp, '
+            f'     "{ns}-cache".registry as r '
+            f'where cp.series_id = r.id and r.name = \'dirty-f2\''
+        ).scalar() == pd.Timestamp('2022-1-6', tz='utc')
+
+    # an upstream write flags its dependents
+    # (and the refresh of their caches flags theirs)
+    tsa.update(
+        'dirty-base',
+        pd.Series(
+            [5.] * 3,
+            index=pd.date_range(utcdt(2022, 1, 6), freq='d', periods=3)
+        ),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-6', tz='utc')
+    )
+    with engine.begin() as cn:
+        assert cache.dirty_series(cn, names, ns) == {'dirty-f1', 'dirty-now'}
+
+    refreshed.clear()
+    with patch.object(cache, 'refresh_series', tracing_refresh):
+        cache.refresh_policy(
+            tsa,
+            'dirty-policy',
+            final_revdate=pd.Timestamp('2022-1-7', tz='utc'),
+            dirty_only=True
+        )
+    assert sorted(refreshed) == names
+    assert tsh.cache.summary(engine, 'dirty-f2')['last_idate'] == (
+        pd.Timestamp('2022-1-6', tz='utc')
+    )
+    assert tsa.get('dirty-f2')['2022-1-6':].tolist() == [10., 10., 10.]
+
+    # a failed refresh leaves the series dirty
+    def crashing_refresh(engine, tsa, name, **kw):
+        raise Exception('boom')
+
+    tsa.update(
+        'dirty-base',
+        pd.Series([6.], index=[utcdt(2022, 1, 9)]),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-8', tz='utc')
+    )
+    with patch.object(cache, 'refresh_series', crashing_refresh):
+        with pytest.raises(Exception):
+            cache.refresh_policy(
+                tsa,
+                'dirty-policy',
+                final_revdate=pd.Timestamp('2022-1-9', tz='utc'),
+                dirty_only=True
+            )
+    with engine.begin() as cn:
+        # dirty-f2 waits for a new dirty-f1 cache revision
+        assert cache.dirty_series(cn, names, ns) == {'dirty-f1', 'dirty-now'}
+
+
+def test_dirty_between_revdates(engine, tsa):
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    ts = pd.Series(
+        [1.] * 3,
+        index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+    )
+    tsa.update(
+        'between-base', ts, 'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.register_formula('between-f', '(* 2 (series "between-base"))')
+    tsa.new_cache_policy(
+        'between-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('between-policy', ['between-f'])
+    cache.refresh_policy(
+        tsa,
+        'between-policy',
+        final_revdate=pd.Timestamp('2022-1-5', tz='utc'),
+        dirty_only=True
+    )
+    with engine.begin() as cn:
+        assert not cache.dirty_series(cn, ['between-f'], ns)
+
+    # a write landing between two revision dates ...
+    tsa.update(
+        'between-base',
+        pd.Series([3.], index=[utcdt(2022, 1, 4)]),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-5 10:00', tz='utc')
+    )
+    with engine.begin() as cn:
+        assert cache.dirty_series(cn, ['between-f'], ns) == {'between-f'}
+
+    # ... is not seen by a refresh before the next one
+    cache.refresh_policy(
+        tsa,
+        'between-policy',
+        final_revdate=pd.Timestamp('2022-1-5 11:00', tz='utc'),
+        dirty_only=True
+    )
+    with engine.begin() as cn:
+        assert cache.dirty_series(cn, ['between-f'], ns) == {'between-f'}
+    assert tsh.cache.get(engine, 'between-f').tolist() == [2., 2., 2.]
+
+    # which keeps the series dirty until then
+    cache.refresh_policy(
+        tsa,
+        'between-policy',
+        final_revdate=pd.Timestamp('2022-1-6', tz='utc'),
+        dirty_only=True
+    )
+    with engine.begin() as cn:
+        assert not cache.dirty_series(cn, ['between-f'], ns)
+    assert tsh.cache.get(engine, 'between-f').tolist() == [2., 2., 2., 6.]
+
+
+def test_dirty_cross_policy(engine, tsa):
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    for name, value in (('cross-a', 1000.), ('cross-b', 1.)):
+        tsa.update(
+            name,
+            pd.Series([value], index=[utcdt(2022, 1, 1)]),
+            'Babar',
+            insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+        )
+    tsa.register_formula('cross-c', '(series "cross-a")')
+    tsa.register_formula(
+        'cross-d', '(add (series "cross-c") (series "cross-b"))'
+    )
+    for policy, rule, name in (
+            ('cross-slow', '0 */2 * * *', 'cross-c'),
+            ('cross-fast', '0 * * * *', 'cross-d')
+    ):
+        tsa.new_cache_policy(
+            policy,
+            initial_revdate='(date "2022-1-1")',
+            look_before='(shifted now #:days -10)',
+            look_after='(shifted now #:days 10)',
+            revdate_rule=rule,
+            schedule_rule='0 8-18 * * *',
+        )
+        tsa.set_cache_policy(policy, [name])
+
+    def refresh(policy, final):
+        cache.refresh_policy(
+            tsa,
+            policy,
+            final_revdate=pd.Timestamp(final, tz='utc'),
+            dirty_only=True
+        )
+
+    refresh('cross-slow', '2022-1-1 10:00')
+    refresh('cross-fast', '2022-1-1 10:00')
+    assert tsh.cache.get(engine, 'cross-d').tolist() == [1001.]
+
+    for name, value in (('cross-a', 1099.), ('cross-b', 2.)):
+        tsa.update(
+            name,
+            pd.Series([value], index=[utcdt(2022, 1, 1)]),
+            'Babar',
+            insertion_date=pd.Timestamp('2022-1-1 10:30', tz='utc')
+        )
+    # cross-d is refreshed before the cache of cross-c
+    refresh('cross-fast', '2022-1-1 11:00')
+    assert tsh.cache.get(engine, 'cross-d').tolist() == [1002.]
+    with engine.begin() as cn:
+        assert not cache.dirty_series(cn, ['cross-d'], ns)
+
+    # which flags it again when it gets its new revision
+    refresh('cross-slow', '2022-1-1 12:00')
+    with engine.begin() as cn:
+        assert cache.dirty_series(cn, ['cross-d'], ns) == {'cross-d'}
+    refresh('cross-fast', '2022-1-1 12:00')
+    assert tsh.cache.get(engine, 'cross-d').tolist() == [1101.]
+    assert tsa.get('cross-d', nocache=True).tolist() == [1101.]
+
+
+def test_refresh_listener(engine, tsa):
+    tsh = tsa.tsh
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+    )
+    tsa.update(
+        'listen-base', ts, 'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.update(
+        'listen-other', ts, 'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.register_formula('listen-formula', '(+ 1 (series "listen-base"))')
+    tsa.new_cache_policy(
+        'listen-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('listen-policy', ['listen-formula'])
+    cache.refresh_policy(
+        tsa,
+        'listen-policy',
+        final_revdate=pd.Timestamp('2022-1-2', tz='utc')
+    )
+
+    enqueued = []
+    listener = cache.refresh_listener(
+        tsa,
+        'listen-policy',
+        debounce=.3,
+        window=1,
+        enqueue=lambda: enqueued.append(time.monotonic())
+    )
+    thread = threading.Thread(target=listener.run)
+    thread.start()
+    try:
+        assert listener.listening.wait(5)
+        # everything is up to date
+        assert enqueued == []
+
+        # the writes of yesterday are due at today's revision date
+        yesterday = pd.Timestamp.now(tz='utc').floor('D') - pd.Timedelta(
+            hours=14
+        )
+
+        def write(name, day):
+            tsa.update(
+                name,
+                pd.Series([float(day)], index=[utcdt(2022, 1, day)]),
+                'Babar',
+                insertion_date=yesterday + pd.Timedelta(seconds=day)
+            )
+
+        # unrelated write
+        write('listen-other', 4)
+        time.sleep(.6)
+        assert enqueued == []
+
+        # a burst of writes is debounced
+        start = time.monotonic()
+        for day in (4, 5, 6):
+            write('listen-base', day)
+            time.sleep(.1)
+        time.sleep(.6)
+        assert len(enqueued) == 1
+        assert enqueued[0] - start >= .5
+
+        # a steady flow of writes is batched
+        enqueued.clear()
+        start = time.monotonic()
+        for day in range(7, 23):
+            write('listen-base', day)
+            time.sleep(.15)
+        time.sleep(.5)
+        assert 2 <= len(enqueued) < 8
+        assert enqueued[0] - start < 1.5
+    finally:
+        listener.stop()
+        thread.join()
+
+    # a refresh waiting in the queue is not enqueued twice
+    t1 = cache.enqueue_refresh(engine, 'listen-policy', tsh.namespace)
+    t2 = cache.enqueue_refresh(engine, 'listen-policy', tsh.namespace)
+    assert t1.tid == t2.tid
+    assert t1.input['policy'] == 'listen-policy'
+    engine.execute('delete from rework.task where id = %(id)s', id=t1.tid)
+
+
+def test_refresh_listener_revdates(engine, tsa):
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    today = pd.Timestamp.now(tz='utc').floor('D')
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(today - pd.Timedelta(days=3), freq='d', periods=3)
+    )
+    tsa.update(
+        'listen-rev-base', ts, 'Babar',
+        insertion_date=today - pd.Timedelta(days=3)
+    )
+    tsa.register_formula(
+        'listen-rev-formula', '(+ 1 (series "listen-rev-base"))'
+    )
+    tsa.new_cache_policy(
+        'listen-rev-policy',
+        initial_revdate=f'(date "{(today - pd.Timedelta(days=3)).date()}")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('listen-rev-policy', ['listen-rev-formula'])
+    cache.refresh_policy(
+        tsa,
+        'listen-rev-policy',
+        final_revdate=today - pd.Timedelta(days=1)
+    )
+
+    refreshed = threading.Event()
+
+    def refresh():
+        cache.refresh_policy(tsa, 'listen-rev-policy', dirty_only=True)
+        refreshed.set()
+
+    listener = cache.refresh_listener(
+        tsa,
+        'listen-rev-policy',
+        debounce=.3,
+        window=1,
+        enqueue=refresh
+    )
+    thread = threading.Thread(target=listener.run)
+    thread.start()
+    try:
+        assert listener.listening.wait(5)
+
+        # a write of yesterday, off the revision dates
+        tsa.update(
+            'listen-rev-base',
+            pd.Series([42.], index=[today]),
+            'Babar',
+            insertion_date=today - pd.Timedelta(hours=14)
+        )
+        assert refreshed.wait(10)
+        assert tsh.cache.get(
+            engine, 'listen-rev-formula'
+        ).tolist() == [2., 3., 4., 43.]
+        with engine.begin() as cn:
+            assert not cache.dirty_series(cn, ['listen-rev-formula'], ns)
+
+        # a write of now waits for the next revision date
+        refreshed.clear()
+        tsa.update(
+            'listen-rev-base',
+            pd.Series([43.], index=[today]),
+            'Babar'
+        )
+        time.sleep(.8)
+        assert not refreshed.is_set()
+        assert listener.due == today + pd.Timedelta(days=1)
+    finally:
+        listener.stop()
+        thread.join()
+
+
+def test_refresh_backoff(engine, tsa):
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(utcdt(2022, 1, 1), freq='d', periods=3)
+    )
+    tsa.update(
+        'backoff-base', ts, 'Babar',
+        insertion_date=pd.Timestamp('2022-1-1', tz='utc')
+    )
+    tsa.register_formula('backoff-ok', '(+ 1 (series "backoff-base"))')
+    tsa.register_formula('backoff-broken', '(+ 2 (series "backoff-base"))')
+    tsa.new_cache_policy(
+        'backoff-policy',
+        initial_revdate='(date "2022-1-1")',
+        look_before='(shifted now #:days -10)',
+        look_after='(shifted now #:days 10)',
+        revdate_rule='0 0 * * *',
+        schedule_rule='0 8-18 * * *',
+    )
+    tsa.set_cache_policy('backoff-policy', ['backoff-ok', 'backoff-broken'])
+
+    refreshed = []
+    refresh_series = cache.refresh_series
+
+    def crashing_refresh(engine, tsa, name, **kw):
+        refreshed.append(name)
+        if name == 'backoff-broken':
+            raise Exception('boom')
+        return refresh_series(engine, tsa, name, **kw)
+
+    def refresh():
+        refreshed.clear()
+        with patch.object(cache, 'refresh_series', crashing_refresh):
+            cache.refresh_policy(
+                tsa,
+                'backoff-policy',
+                final_revdate=pd.Timestamp('2022-1-2', tz='utc')
+            )
+
+    def failures():
+        with engine.begin() as cn:
+            return cache.refresh_failures(cn, ['backoff-broken'], ns)
+
+    def expire():
+        with engine.begin() as cn:
+            cn.execute(
+                f'update "{ns}".cache_refresh_failure '
+                f'set retry_after = now() - interval \'1 second\''
+            )
+
+    with pytest.raises(Exception):
+        refresh()
+    assert sorted(refreshed) == ['backoff-broken', 'backoff-ok']
+    state = failures()['backoff-broken']
+    assert state['failures'] == 1
+    assert state['error'] == 'boom'
+    assert state['retry_after'] - state['last_failure'] == pd.Timedelta(
+        seconds=cache.BACKOFF_BASE
+    )
+
+    # known broken: skipped, the healthy series are refreshed
+    refresh()
+    assert refreshed == ['backoff-ok']
+
+    # a skip is neither a success nor a failure
+    final = pd.Timestamp('2022-1-2', tz='utc')
+    assert cache._refresh_series_safely(
+        tsa, 'backoff-broken', final, True
+    ) is None
+    with cache.level_runner(tsa) as run:
+        assert run(['backoff-ok', 'backoff-broken'], final, True) == (
+            [], ['backoff-broken']
+        )
+    with engine.begin() as cn:
+        log = cache.refresh_log(cn, ['backoff-broken'], namespace=ns)
+    assert [entry['outcome'] for entry in log] == ['skipped'] * 3
+
+    # the delay doubles
+    expire()
+    with pytest.raises(Exception):
+        refresh()
+    state = failures()['backoff-broken']
+    assert state['failures'] == 2
+    assert state['retry_after'] - state['last_failure'] == pd.Timedelta(
+        seconds=2 * cache.BACKOFF_BASE
+    )
+
+    # up to a cap
+    with engine.begin() as cn:
+        cn.execute(
+            f'update "{ns}".cache_refresh_failure set failures = 20'
+        )
+    expire()
+    with pytest.raises(Exception):
+        refresh()
+    state = failures()['backoff-broken']
+    assert state['failures'] == 21
+    assert state['retry_after'] - state['last_failure'] == pd.Timedelta(
+        seconds=cache.BACKOFF_CAP
+    )
+
+    # an input write gives it a new chance
+    tsa.update(
+        'backoff-base',
+        pd.Series([4.], index=[utcdt(2022, 1, 4)]),
+        'Babar',
+        insertion_date=pd.Timestamp('2022-1-2', tz='utc')
+    )
+    assert failures() == {}
+    with pytest.raises(Exception):
+        refresh()
+    assert sorted(refreshed) == ['backoff-broken', 'backoff-ok']
+    assert failures()['backoff-broken']['failures'] == 1
+
+    # and so does a formula change
+    tsa.register_formula('backoff-broken', '(+ 3 (series "backoff-base"))')
+    assert failures() == {}
+
+    # a success forgets the failures
+    with pytest.raises(Exception):
+        refresh()
+    expire()
+    cache.refresh_policy(
+        tsa,
+        'backoff-policy',
+        final_revdate=pd.Timestamp('2022-1-2', tz='utc')
+    )
+    assert failures() == {}
+    assert tsa.has_cache('backoff-broken')
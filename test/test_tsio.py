@@ -569,6 +569,218 @@ def test_na_and_delete(engine, tsh):
     assert len(diff) == 0
 
 
+def test_cache_update_many(engine, tsh):
+    revisions = []
+    for day in range(1, 8):
+        ts = genserie(datetime(2020, 1, day), 'd', 5, initval=[day])
+        if day == 4:
+            # no change -> no revision
+            ts = revisions[-1][1]
+        revisions.append(
+            (pd.Timestamp(f'2020-1-{day}', tz='utc'), ts)
+        )
+    # an update in the past
+    revisions.append(
+        (
+            pd.Timestamp('2020-1-10', tz='utc'),
+            pd.Series([42.], index=[pd.Timestamp('2020-1-2')])
+        )
+    )
+
+    for idate, ts in revisions:
+        tsh.cache.update(
+            engine, ts, 'one-by-one', 'test', insertion_date=idate
+        )
+    # creation, then bulk writes
+    assert tsh.cache.update_many(engine, 'bulk', revisions[:3], 'test') == 3
+    assert tsh.cache.update_many(engine, 'bulk', revisions[3:], 'test') == 4
+    assert tsh.cache.update_many(engine, 'bulk', [], 'test') == 0
+
+    assert tsh.cache.insertion_dates(engine, 'bulk') == (
+        tsh.cache.insertion_dates(engine, 'one-by-one')
+    )
+    expected = tsh.cache.history(engine, 'one-by-one')
+    for idate, ts in tsh.cache.history(engine, 'bulk').items():
+        assert ts.values.tolist() == expected[idate].values.tolist()
+        assert ts.index.equals(expected[idate].index)
+    assert tsh.cache.interval(engine, 'bulk') == (
+        tsh.cache.interval(engine, 'one-by-one')
+    )
+
+    with engine.begin() as cn:
+        diffs = [
+            cn.execute(
+                f'select diffstart, diffend, tsstart, tsend '
+                f'from "{tsh.cache.namespace}.revision"."{name}" '
+                f'order by id'
+            ).fetchall()
+            for name in ('bulk', 'one-by-one')
+        ]
+    assert diffs[0] == diffs[1]
+
+
+def test_cache_summary(engine, tsh):
+    assert tsh.cache.summary(engine, 'no-such-cache') is None
+
+    for day in range(1, 4):
+        tsh.cache.update(
+            engine,
+            genserie(datetime(2020, 1, day), 'd', 3, initval=[day]),
+            'summary-cache', 'test',
+            insertion_date=pd.Timestamp(f'2020-1-{day}', tz='utc')
+        )
+    tsh.cache.update_many(
+        engine,
+        'summary-cache',
+        [
+            (
+                pd.Timestamp(f'2020-1-{day}', tz='utc'),
+                genserie(datetime(2020, 1, day), 'd', 3, initval=[day])
+            )
+            for day in (5, 7)
+        ],
+        'test'
+    )
+
+    def expected():
+        idates = tsh.cache.insertion_dates(engine, 'summary-cache')
+        return {
+            'first_idate': idates[0],
+            'last_idate': idates[-1],
+            'revisions': len(idates),
+            'freq': infer_freq(idates)[0],
+            'tzaware': False,
+            'interval': tsh.cache.interval(engine, 'summary-cache'),
+            'outdated': False
+        }
+
+    summary = tsh.cache.summary(engine, 'summary-cache')
+    assert summary == expected()
+    assert summary['revisions'] == 5
+    assert summary['freq'] == pd.Timedelta(days=1.5)
+
+    # a lost summary is computed by the reads ...
+    def rows():
+        return engine.execute(
+            f'select count(*) from "{tsh.cache.namespace}".summary'
+        ).scalar()
+
+    with engine.begin() as cn:
+        cn.execute(f'delete from "{tsh.cache.namespace}".summary')
+    assert tsh.cache.summary(engine, 'summary-cache') == summary
+    assert rows() == 0
+
+    # ... and rebuilt by the next write
+    csid = tsh.cache.changeset_at(
+        engine, 'summary-cache', pd.Timestamp('2020-1-5', tz='utc')
+    )
+    tsh.cache.strip(engine, 'summary-cache', csid)
+    assert rows() == 1
+    summary = tsh.cache.summary(engine, 'summary-cache')
+    assert summary == expected()
+    assert summary['revisions'] == 3
+
+    tsh.cache.delete(engine, 'summary-cache')
+    assert tsh.cache.summary(engine, 'summary-cache') is None
+
+
+def test_cache_head(engine, tsh):
+    def chain(name, **kw):
+        # the latest revision rebuilt from the snapshot chunks
+        return tsh.cache.get(
+            engine, name,
+            revision_date=pd.Timestamp('2100-1-1', tz='utc'),
+            **kw
+        )
+
+    def check(name, **kw):
+        head = tsh.cache.get(engine, name, **kw)
+        assert head.equals(chain(name, **kw))
+        return head
+
+    for tzaware, name in ((False, 'head-naive'), (True, 'head-tzaware')):
+        start = utcdt(2020, 1, 1) if tzaware else datetime(2020, 1, 1)
+        tsh.cache.update(
+            engine,
+            genserie(start, 'd', 5),
+            name, 'test',
+            insertion_date=utcdt(2020, 1, 1)
+        )
+        check(name)
+        tsh.cache.update(
+            engine,
+            genserie(start + timedelta(days=3), 'd', 4, initval=[42]),
+            name, 'test',
+            insertion_date=utcdt(2020, 1, 2)
+        )
+        # an erasure
+        tsh.cache.update(
+            engine,
+            pd.Series(
+                [np.nan],
+                index=[start + timedelta(days=1)]
+            ),
+            name, 'test',
+            insertion_date=utcdt(2020, 1, 3),
+            keepnans=True
+        )
+        tsh.cache.update_many(
+            engine,
+            name,
+            [
+                (utcdt(2020, 1, 4),
+                 genserie(start + timedelta(days=5), 'd', 2, initval=[7])),
+                (utcdt(2020, 1, 5),
+                 genserie(start + timedelta(days=6), 'd', 2, initval=[8]))
+            ],
+            'test'
+        )
+        head = check(name)
+        assert head.tolist() == [0., 2., 42., 42., 7., 8., 8.]
+        sliced = check(
+            name,
+            from_value_date=start + timedelta(days=2),
+            to_value_date=start + timedelta(days=5)
+        )
+        assert len(sliced) == 4
+        assert not len(
+            check(name, from_value_date=start + timedelta(days=100))
+        )
+
+        csid = tsh.cache.changeset_at(engine, name, utcdt(2020, 1, 2))
+        tsh.cache.strip(engine, name, csid)
+        assert check(name).tolist() == [0., 1., 2., 3., 4.]
+
+        tsh.cache.replace(
+            engine,
+            genserie(start, 'd', 2, initval=[3]),
+            name, 'test',
+            insertion_date=utcdt(2020, 1, 6)
+        )
+        assert check(name).tolist() == [3., 3.]
+
+    # a lost head is not used, then rebuilt on the next write
+    with engine.begin() as cn:
+        cn.execute(
+            f'update "{tsh.cache.namespace}".summary set head = false'
+        )
+        cn.execute(f'delete from "{tsh.cache.namespace}".head')
+    assert check('head-naive').tolist() == [3., 3.]
+    tsh.cache.update(
+        engine,
+        genserie(datetime(2020, 1, 3), 'd', 1, initval=[4]),
+        'head-naive', 'test',
+        insertion_date=utcdt(2020, 1, 7)
+    )
+    with engine.begin() as cn:
+        assert cn.execute(
+            f'select count(*) from "{tsh.cache.namespace}".head as h, '
+            f'  "{tsh.cache.namespace}".registry as r '
+            f'where h.series_id = r.id and r.name = \'head-naive\''
+        ).scalar() == 3
+    assert check('head-naive').tolist() == [3., 3., 4.]
+
+
 def test_exotic_name(engine, tsh):
     ts = genserie(datetime(2010, 1, 1), 'd', 11)
     tsh.update(engine, ts, 'ts-with_dash', 'test')
@@ -1,7 +1,15 @@
-from typing import List
+from datetime import datetime
+from typing import (
+    Dict,
+    List,
+    Optional
+)
+
+import pandas as pd
 
 from rework import api as rapi
 from tshistory.util import (
+    ensuretz,
     extend,
     threadpool
 )
@@ -96,7 +104,7 @@ def unset_cache_policy(self, seriesnames: List[str]) -> NONETYPE:
             name,
             namespace=self.tsh.namespace
         )
-        self.tsh.cache.delete(self.engine, name)
+        self.tsh.invalidate_cache(self.engine, name)
 
 
 @extend(mainsource)
@@ -130,6 +138,37 @@ def cache_free_series(self, allsources=True):  # noqa: F811
     return all
 
 
+@extend(mainsource)
+def get_batch(
+        self,
+        names: List[str],
+        revision_date: Optional[datetime]=None,
+        from_value_date: Optional[datetime]=None,
+        to_value_date: Optional[datetime]=None) -> Dict[str, Optional[pd.Series]]:
+    """Get many series by name, in one go.
+
+    Returns a dict from the names to the series (or None for the
+    unknown series). The cached formulas are read in bulk.
+    """
+    revision_date = ensuretz(revision_date)
+    series = self.tsh.get_batch(
+        self.engine,
+        names,
+        revision_date=revision_date,
+        from_value_date=from_value_date,
+        to_value_date=to_value_date
+    )
+    for name, ts in series.items():
+        if ts is None:
+            series[name] = self.othersources.get(
+                name,
+                revision_date=revision_date,
+                from_value_date=from_value_date,
+                to_value_date=to_value_date
+            )
+    return series
+
+
 @extend(mainsource)
 def cache_policies(self):
     """Return a list of cache policies names."""
@@ -164,6 +203,69 @@ def delete_cache(self, seriesname: str):
     return self.tsh.invalidate_cache(self.engine, seriesname)
 
 
+@extend(mainsource)
+def cache_refresh_log(
+        self,
+        names: Optional[List[str]]=None,
+        policyname: Optional[str]=None,
+        from_date: Optional[datetime]=None,
+        to_date: Optional[datetime]=None,
+        limit: Optional[int]=None) -> List[Dict]:
+    """Return the log of the cache refreshes, most recent first.
+
+    Each entry provides the series name, the start date, the time
+    spent (in seconds) overall, in the insertion dates lookup, in the
+    formula evaluation and in the cache writes, the number of
+    revisions and points written and the outcome ("done", "nothing",
+    "skipped" or "failed", with the error).
+
+    The entries can be restricted to some series, to the series of a
+    policy and to a range of start dates.
+    """
+    with self.engine.begin() as cn:
+        return cache.refresh_log(
+            cn,
+            names=names,
+            policy=policyname,
+            from_date=ensuretz(from_date),
+            to_date=ensuretz(to_date),
+            limit=limit,
+            namespace=self.tsh.namespace
+        )
+
+
+@extend(mainsource)
+def cache_refresh_plan(
+        self,
+        policyname: str,
+        names: Optional[List[str]]=None,
+        initial_revdate: Optional[str]=None,
+        revdate_rule: Optional[str]=None,
+        final_revdate: Optional[datetime]=None) -> List[Dict]:
+    """Return what a refresh of a cache policy would do, without doing
+    anything.
+
+    For each series (in refresh order), it tells from and up to which
+    revision date the refresh would go, how many revision dates of
+    the policy that makes ("revdates"), how many of them see new
+    insertions upstream ("reduced"), the number of component series
+    and insertion dates involved, and an estimate of the refresh time
+    (in seconds, or None) from the past refreshes.
+
+    The `initial_revdate` and `revdate_rule` of the policy can be
+    overridden and the series `names` given, e.g. to evaluate a
+    policy yet to be created.
+    """
+    return cache.plan_policy(
+        self,
+        policyname,
+        final_revdate=ensuretz(final_revdate),
+        names=names,
+        initial_revdate=initial_revdate,
+        revdate_rule=revdate_rule
+    )
+
+
 @extend(mainsource)
 def refresh_series_policy_now(self, policyname: str):
     return rapi.schedule(
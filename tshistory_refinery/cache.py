@@ -1,5 +1,21 @@
+from bisect import bisect_right
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait
+)
 from contextlib import contextmanager
-from functools import cmp_to_key
+from datetime import (
+    datetime,
+    timedelta
+)
+from functools import partial
+import multiprocessing as mp
+import select
+import sys
+import threading
+import time
 import traceback
 
 from icron import (
@@ -18,7 +34,15 @@ from sqlhelp import (
     update
 )
 
+from tshistory.util import (
+    compatible_date,
+    diffs,
+    patch,
+    threadpool
+)
 from tshistory_formula import registry
+from tshistory_formula.helper import inject_toplevel_bindings
+from tshistory_formula.interpreter import Interpreter
 from tshistory_refinery import helper
 from tshistory_refinery import tsio
 
@@ -127,6 +151,7 @@ def edit_policy(
             schedule_rule=schedule_rule
         )
         q.do(cn)
+        _update_stale_after(cn, name, namespace)
 
 
 def schedule_policy(engine, name, namespace='tsh'):
@@ -222,7 +247,7 @@ def delete_policy(engine, policy_name, namespace='tsh'):
 
         tsh = tsio.timeseries(namespace=namespace)
         for name in policy_series(cn, policy_name, namespace=namespace):
-            tsh.cache.delete(cn, name)
+            tsh.invalidate_cache(cn, name)
 
         cn.execute(
             f'delete from "{namespace}".cache_policy '
@@ -281,6 +306,7 @@ def set_policy(cn, policy_name, series_name, namespace='tsh'):
         cachename=policy_name,
         seriesname=series_name
     )
+    mark_dirty(cn, [series_name], namespace)
 
 
 def unset_policy(cn, series_name, namespace='tsh'):
@@ -319,18 +345,568 @@ def series_policy(cn, series_name, namespace='tsh'):
     return dict(p)
 
 
-@contextmanager
-def series_refresh_lock(engine, name, namespace):
-    with engine.begin() as cn:
-        xactkey = helper.hash64(name)
+# dirty tracking
+
+def mark_dirty(cn, names, namespace='tsh'):
+    """ Flag series caches as needing a refresh (whatever the revision
+    date they are brought to) """
+    cn.execute(
+        f'insert into "{namespace}".cache_dirty as d (series_id) '
+        f'select id from "{namespace}".registry '
+        f'where name = any(%(names)s) '
+        f'on conflict (series_id) do update '
+        f'set dirty_since = greatest(d.dirty_since, excluded.dirty_since)',
+        names=list(names)
+    )
+
+
+def mark_dependents_dirty(cn, name, insertion_date=None, namespace='tsh'):
+    """ Flag the series caches computed from a primary series or a
+    formula cache (which has just been written at `insertion_date`,
+    defaulting to now) as needing a refresh up to a revision date
+    covering the write (and to be retried if they were failing).
+
+    If there are any, the write is notified (at commit time) on the
+    dirty channel of the namespace (see `refresh_listener`).
+    """
+    cn.execute(
+        f'with dependents as ('
+        f' select ci.series_id '
+        f' from "{namespace}".cache_input as ci, '
+        f'      "{namespace}".registry as r '
+        f' where r.name = %(name)s and '
+        f'       ci.input_id = r.id'
+        f'), flagged as ('
+        f' insert into "{namespace}".cache_dirty as d '
+        f' (series_id, dirty_since) '
+        f' select series_id, coalesce(%(idate)s, clock_timestamp()) '
+        f' from dependents '
+        f' on conflict (series_id) do update '
+        f' set dirty_since = greatest(d.dirty_since, excluded.dirty_since)'
+        f'), retried as ('
+        f' delete from "{namespace}".cache_refresh_failure '
+        f' where series_id in (select series_id from dependents)'
+        f') '
+        f'select pg_notify(%(channel)s, %(name)s) '
+        f'from dependents limit 1',
+        name=name,
+        idate=insertion_date,
+        channel=dirty_channel(namespace)
+    )
+
+
+def dirty_channel(namespace='tsh'):
+    """ Postgres channel of the upstream writes flagging caches """
+    return f'{namespace}-dirty'
+
+
+def dirty_series(cn, names, namespace='tsh'):
+    """ Return the subset of `names` whose cache needs a refresh """
+    return {
+        name for name, in cn.execute(
+            f'select r.name '
+            f'from "{namespace}".cache_dirty as d, '
+            f'     "{namespace}".registry as r '
+            f'where d.series_id = r.id and '
+            f'      r.name = any(%(names)s)',
+            names=list(names)
+        ).fetchall()
+    }
+
+
+def _clear_dirty(cn, name, namespace='tsh'):
+    """ Unflag a series cache whose refresh checkpoint covers the
+    latest upstream write """
+    cn.execute(
+        f'delete from "{namespace}".cache_dirty as d '
+        f'using "{namespace}".registry as r, '
+        f'      "{namespace}-cache".registry as c, '
+        f'      "{namespace}".cache_refresh_checkpoint as cp '
+        f'where r.name = %(name)s and '
+        f'      d.series_id = r.id and '
+        f'      c.name = r.name and '
+        f'      cp.series_id = c.id and '
+        f'      d.dirty_since <= cp.revdate',
+        name=name
+    )
+
+
+# failure backoff
+
+BACKOFF_BASE = 15 * 60  # seconds
+BACKOFF_CAP = 24 * 3600  # seconds
+
+
+def _record_failure(cn, name, err, namespace='tsh'):
+    """ Count a refresh failure of a series: it won't be retried for
+    BACKOFF_BASE seconds, doubling with each new failure up to
+    BACKOFF_CAP seconds, unless its formula or inputs change """
+    cn.execute(
+        f'insert into "{namespace}".cache_refresh_failure as f '
+        f'(series_id, failures, last_failure, retry_after, error) '
+        f'select r.id, 1, now(), '
+        f'       now() + make_interval(secs => %(base)s), %(error)s '
+        f'from "{namespace}".registry as r '
+        f'where r.name = %(name)s '
+        f'on conflict (series_id) do update '
+        f'set failures = f.failures + 1, '
+        f'    last_failure = excluded.last_failure, '
+        f'    retry_after = excluded.last_failure + make_interval('
+        f'      secs => least(%(base)s * 2 ^ f.failures, %(cap)s)'
+        f'    ), '
+        f'    error = excluded.error',
+        name=name,
+        error=str(err) or repr(err),
+        base=BACKOFF_BASE,
+        cap=BACKOFF_CAP
+    )
+
+
+def _retry_after(cn, name, namespace='tsh'):
+    """ Return the date until which a failing series is not refreshed
+    (None if it can be refreshed now) """
+    return cn.execute(
+        f'select f.retry_after '
+        f'from "{namespace}".cache_refresh_failure as f, '
+        f'     "{namespace}".registry as r '
+        f'where r.name = %(name)s and '
+        f'      f.series_id = r.id and '
+        f'      f.retry_after > now()',
+        name=name
+    ).scalar()
+
+
+def clear_failures(cn, names, namespace='tsh'):
+    """ Forget the refresh failures of series (they are retried at
+    the next refresh) """
+    cn.execute(
+        f'delete from "{namespace}".cache_refresh_failure '
+        f'where series_id in ('
+        f' select id from "{namespace}".registry '
+        f' where name = any(%(names)s)'
+        f')',
+        names=list(names)
+    )
+
+
+def refresh_failures(cn, names=None, namespace='tsh'):
+    """ Return the refresh failure state of the failing series, as a
+    dict from name to dict """
+    q = (
+        f'select r.name, f.failures, f.last_failure, '
+        f'       f.retry_after, f.error '
+        f'from "{namespace}".cache_refresh_failure as f, '
+        f'     "{namespace}".registry as r '
+        f'where f.series_id = r.id'
+    )
+    if names is not None:
+        q += ' and r.name = any(%(names)s)'
+    return {
+        row.name: {
+            'failures': row.failures,
+            'last_failure': pd.Timestamp(row.last_failure),
+            'retry_after': pd.Timestamp(row.retry_after),
+            'error': row.error
+        }
+        for row in cn.execute(
+            q,
+            names=names and list(names)
+        ).fetchall()
+    }
+
+
+def _track_inputs(cn, tsh, name):
+    """ Record the series a formula cache is computed from, as the
+    refresh reads them (primary series and cached formulas, see
+    `name_stopper`), and tell whether they are all it depends on (no
+    remote series, no automatic operator, no reference to the present
+    time). Only then a write of these inputs (or of their caches) is
+    known to be the sole reason to refresh its cache.
+    """
+    ns = tsh.namespace
+    tree = tsh._expanded_formula(cn, tsh.formula(cn, name), qargs={})
+    inputs = sorted(tsh.find_series(cn, tree))
+    known = cn.execute(
+        f'select r.name '
+        f'from "{ns}".registry as r '
+        f'where r.name = any(%(names)s) and '
+        f'      (r.internal_metadata->\'formula\' is null or '
+        f'       exists (select 1 from "{ns}-cache".registry as c '
+        f'               where c.name = r.name))',
+        names=inputs
+    ).fetchall()
+    tracked = (
+        len(known) == len(inputs) and
+        not has_today(lisp.serialize(tree))
+    )
+
+    cn.execute(
+        f'delete from "{ns}".cache_input '
+        f'where series_id = ('
+        f' select id from "{ns}".registry where name = %(name)s'
+        f')',
+        name=name
+    )
+    if tracked:
         cn.execute(
-            f'select pg_advisory_xact_lock({xactkey})'
+            f'insert into "{ns}".cache_input (series_id, input_id) '
+            f'select f.id, r.id '
+            f'from "{ns}".registry as f, '
+            f'     "{ns}".registry as r '
+            f'where f.name = %(name)s and '
+            f'      r.name = any(%(inputs)s)',
+            name=name,
+            inputs=inputs
         )
+    return tracked
+
+
+# refresh telemetry
+
+class refresh_stats:
+    """ Where the time of a series refresh goes (in seconds) and what
+    it produced """
+    __slots__ = (
+        'idates_time', 'eval_time', 'write_time',
+        'revisions', 'points', 'outcome'
+    )
+
+    def __init__(self):
+        self.idates_time = self.eval_time = self.write_time = 0.
+        self.revisions = self.points = 0
+        self.outcome = 'done'
+
+    @contextmanager
+    def timing(self, what):
+        t0 = time.perf_counter()
         try:
             yield
+        finally:
+            setattr(
+                self, what,
+                getattr(self, what) + time.perf_counter() - t0
+            )
+
+    def timed(self, what, func):
+        def timedfunc(*a, **kw):
+            with self.timing(what):
+                return func(*a, **kw)
+        return timedfunc
+
+
+@contextmanager
+def _logged_refresh(engine, name, namespace='tsh'):
+    """ Provide the stats of a series refresh and record them in the
+    refresh log, together with the wall time and outcome ("done",
+    "nothing" when there was no work, "skipped" for a failing series
+    waiting for its retry or "failed") """
+    stats = refresh_stats()
+    started = pd.Timestamp.now(tz='UTC')
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield stats
+    except Exception as err:
+        stats.outcome = 'failed'
+        error = str(err) or repr(err)
+        raise
+    finally:
+        try:
+            with engine.begin() as cn:
+                cn.execute(
+                    f'insert into "{namespace}".cache_refresh_log '
+                    f'(series_id, started, wall_time, idates_time, '
+                    f' eval_time, write_time, revisions, points, '
+                    f' outcome, error) '
+                    f'select r.id, %(started)s, %(wall)s, %(idates)s, '
+                    f'       %(eval)s, %(write)s, %(revisions)s, %(points)s, '
+                    f'       %(outcome)s, %(error)s '
+                    f'from "{namespace}".registry as r '
+                    f'where r.name = %(name)s',
+                    name=name,
+                    started=started,
+                    wall=time.perf_counter() - t0,
+                    idates=stats.idates_time,
+                    eval=stats.eval_time,
+                    write=stats.write_time,
+                    revisions=stats.revisions,
+                    points=stats.points,
+                    outcome=stats.outcome,
+                    error=error
+                )
+        except Exception:
+            # the telemetry must not break the refreshes
+            traceback.print_exc()
+
+
+def refresh_log(cn, names=None, policy=None, from_date=None, to_date=None,
+                limit=None, namespace='tsh'):
+    """ Return the recorded series refreshes (most recent first), as a
+    list of dicts, possibly restricted to some series or to the series
+    of a policy and to a range of start dates """
+    q = (
+        f'select r.name, l.started, l.wall_time, l.idates_time, '
+        f'       l.eval_time, l.write_time, l.revisions, l.points, '
+        f'       l.outcome, l.error '
+        f'from "{namespace}".cache_refresh_log as l '
+        f'join "{namespace}".registry as r on r.id = l.series_id '
+    )
+    if policy is not None:
+        q += (
+            f'join "{namespace}".cache_policy_series as ps '
+            f'  on ps.series_id = l.series_id '
+            f'join "{namespace}".cache_policy as p '
+            f'  on p.id = ps.cache_policy_id and p.name = %(policy)s '
+        )
+    q += 'where true '
+    if names is not None:
+        q += 'and r.name = any(%(names)s) '
+    if from_date is not None:
+        q += 'and l.started >= %(from_date)s '
+    if to_date is not None:
+        q += 'and l.started <= %(to_date)s '
+    q += 'order by l.started desc, l.id desc'
+    if limit is not None:
+        q += ' limit %(limit)s'
+    log = []
+    for row in cn.execute(
+            q,
+            names=names and list(names),
+            policy=policy,
+            from_date=from_date,
+            to_date=to_date,
+            limit=limit
+    ).fetchall():
+        entry = dict(row)
+        entry['started'] = pd.Timestamp(entry['started'])
+        log.append(entry)
+    return log
+
+
+# the refresh locks held by the current thread
+_HELD = threading.local()
+
+
+@contextmanager
+def series_refresh_lock(engine, name, namespace, wait=True):
+    """ Serialize the refreshes of a series cache.
+
+    This is a session level lock held by a dedicated connection
+    (outside of any transaction): the refresh commits its work in
+    chunks while holding it.
+
+    Without `wait`, the context yields False rather than waiting when
+    another refresh holds the lock. The lock is reentrant within a
+    thread.
+    """
+    held = _HELD.__dict__.setdefault('names', set())
+    if name in held:
+        yield True
+        return
+
+    lockkey = helper.hash64(name)
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT'
+    ) as cn:
+        if wait:
+            cn.execute(
+                f'select pg_advisory_lock({lockkey})'
+            )
+        elif not cn.execute(
+                f'select pg_try_advisory_lock({lockkey})'
+        ).scalar():
+            yield False
+            return
+
+        held.add(name)
+        try:
+            yield True
         except:
             traceback.print_exc()
             raise
+        finally:
+            held.discard(name)
+            cn.execute(
+                f'select pg_advisory_unlock({lockkey})'
+            )
+
+
+def refresh_checkpoint(cn, name, namespace='tsh'):
+    """ Return the last revision date durably processed by a refresh
+    of the series cache (or None) """
+    return cn.execute(
+        f'select cp.revdate '
+        f'from "{namespace}".cache_refresh_checkpoint as cp, '
+        f'     "{namespace}-cache".registry as r '
+        f'where r.name = %(name)s and '
+        f'      cp.series_id = r.id',
+        name=name
+    ).scalar()
+
+
+def stale_after(policy, watermark):
+    """ Return the date past which a cache refreshed up to `watermark`
+    is stale: the next revision date of the policy (revdate_rule)
+    should have been processed by the refresh scheduled after it
+    (schedule_rule), plus one more scheduled refresh of slack.
+    """
+    watermark = pd.Timestamp(watermark).to_pydatetime()
+    nextrev = croniter(policy['revdate_rule'], watermark).get_next(datetime)
+    schedule = croniter(
+        policy['schedule_rule'],
+        nextrev - timedelta(microseconds=1)
+    )
+    schedule.get_next(datetime)
+    return pd.Timestamp(schedule.get_next(datetime))
+
+
+def series_stale_after(cn, name, namespace='tsh'):
+    """ Return the precomputed date past which the series cache is
+    stale (or None if unknown) """
+    return cn.execute(
+        f'select cp.stale_after '
+        f'from "{namespace}".cache_refresh_checkpoint as cp, '
+        f'     "{namespace}-cache".registry as r '
+        f'where r.name = %(name)s and '
+        f'      cp.series_id = r.id',
+        name=name
+    ).scalar()
+
+
+def shadow_name(name):
+    """ Name of the cache series where an outdated cache is rebuilt """
+    return f'{name} (shadow)'
+
+
+def _swap_shadow(cn, tsh, name):
+    """ Replace an outdated cache by its rebuilt shadow """
+    tsh.cache.delete(cn, name)
+    tsh.cache.rename(cn, shadow_name(name), name)
+    tsh.cache._notify_write(cn, name)
+    tsh.cache._flag_dependents(
+        cn, name, tsh.cache.latest_insertion_date(cn, name)
+    )
+
+
+def _set_refresh_checkpoint(cn, name, revdate, namespace='tsh'):
+    cn.execute(
+        f'insert into "{namespace}".cache_refresh_checkpoint '
+        f'(series_id, revdate) '
+        f'select r.id, %(revdate)s '
+        f'from "{namespace}-cache".registry as r '
+        f'where r.name = %(name)s '
+        f'on conflict (series_id) do update '
+        f'set revdate = excluded.revdate',
+        name=name,
+        revdate=revdate
+    )
+
+
+def _set_stale_after(cn, name, revdate, watermark, policy, namespace='tsh'):
+    """ Record that the cache has seen everything up to `watermark`
+    (`revdate` is the checkpoint to use if none exists yet) """
+    cn.execute(
+        f'insert into "{namespace}".cache_refresh_checkpoint '
+        f'(series_id, revdate, watermark, stale_after) '
+        f'select r.id, %(revdate)s, %(watermark)s, %(stale)s '
+        f'from "{namespace}-cache".registry as r '
+        f'where r.name = %(name)s '
+        f'on conflict (series_id) do update '
+        f'set watermark = excluded.watermark, '
+        f'    stale_after = excluded.stale_after',
+        name=name,
+        revdate=revdate,
+        watermark=watermark,
+        stale=stale_after(policy, watermark)
+    )
+
+
+def _update_stale_after(cn, policy_name, namespace='tsh'):
+    """ Recompute the staleness expectations of the series of a policy """
+    policy = dict(
+        cn.execute(
+            f'select revdate_rule, schedule_rule '
+            f'from "{namespace}".cache_policy '
+            f'where name = %(name)s',
+            name=policy_name
+        ).fetchone()
+    )
+    checkpoints = cn.execute(
+        f'select cp.series_id, cp.watermark '
+        f'from "{namespace}".cache_refresh_checkpoint as cp, '
+        f'     "{namespace}-cache".registry as c, '
+        f'     "{namespace}".registry as s, '
+        f'     "{namespace}".cache_policy_series as m, '
+        f'     "{namespace}".cache_policy as p '
+        f'where cp.series_id = c.id and '
+        f'      c.name = s.name and '
+        f'      m.series_id = s.id and '
+        f'      m.cache_policy_id = p.id and '
+        f'      p.name = %(name)s and '
+        f'      cp.watermark is not null',
+        name=policy_name
+    ).fetchall()
+    for sid, watermark in checkpoints:
+        cn.execute(
+            f'update "{namespace}".cache_refresh_checkpoint '
+            f'set stale_after = %(stale)s '
+            f'where series_id = %(sid)s',
+            sid=sid,
+            stale=stale_after(policy, watermark)
+        )
+
+
+# remote and auto-operator insertion dates are fetched concurrently
+IDATES_WORKERS = 8
+IDATES_TIMEOUT = 120  # seconds, per source
+
+
+def _fetch_concurrently(jobs, workers=IDATES_WORKERS, timeout=IDATES_TIMEOUT):
+    """ Run the `jobs` (a source name -> callable mapping) on a bounded
+    thread pool and return a source name -> result mapping.
+
+    Each job gets `timeout` seconds from its actual start: the sources
+    still running past it are reported with a TimeoutError.
+    """
+    if not jobs:
+        return {}
+
+    started = {}
+
+    def run(source, job):
+        started[source] = time.monotonic()
+        return job()
+
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(jobs)))
+    futures = {
+        executor.submit(run, source, job): source
+        for source, job in jobs.items()
+    }
+    results = {}
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=min(timeout, 1),
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                results[futures[future]] = future.result()
+            now = time.monotonic()
+            late = sorted(
+                futures[future] for future in pending
+                if now - started.get(futures[future], now) > timeout
+            )
+            if late:
+                raise TimeoutError(
+                    f'no insertion dates after {timeout}s from: '
+                    f'{", ".join(late)}'
+                )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
 
 
 def _insertion_dates(tsa,
@@ -348,11 +924,40 @@ def _insertion_dates(tsa,
         formula,
         qargs={}  # we want the stopnames mecanism to work for us
     )
-    idates = []
+    idates = set()
+    selects = []
+    jobs = {}
+    ns = tsh.namespace
+    datefilter = ''
+    if from_insertion_date:
+        datefilter += ' and insertion_date >= %(from_idate)s'
+    if to_insertion_date:
+        datefilter += ' and insertion_date <= %(to_idate)s'
 
     with engine.begin() as cn:
-        for sname, localtree in tsh.find_series(cn, tree).items():
-            if not tsh.exists(cn, sname):
+        found = tsh.find_series(cn, tree)
+        # resolve all the local revision tables at once
+        # (the revisions of an outdated cache are those of the obsolete
+        # formula: such components are treated as uncached)
+        tables = {
+            sname: (exists, isformula, tablename, cachetablename)
+            for sname, exists, isformula, tablename, cachetablename in cn.execute(
+                f'select n.name, s.id is not null, '
+                f'       s.internal_metadata->\'formula\' is not null, '
+                f'       s.internal_metadata->>\'tablename\', '
+                f'       case when coalesce(cs.outdated, false) then null '
+                f'            else c.internal_metadata->>\'tablename\' end '
+                f'from unnest(%(names)s::text[]) as n(name) '
+                f'left join "{ns}".registry as s on s.name = n.name '
+                f'left join "{ns}-cache".registry as c on c.name = n.name '
+                f'left join "{ns}-cache".summary as cs on cs.series_id = c.id',
+                names=list(found)
+            ).fetchall()
+        }
+
+        for sname, localtree in found.items():
+            exists, isformula, tablename, cachetablename = tables[sname]
+            if not exists:
                 # delegate to auto operator idates impl.
                 # localtree looks like:
                 # ['<opname> <param1> ... <paramn>]
@@ -360,42 +965,77 @@ def _insertion_dates(tsa,
                     localtree[0]
                 )
                 if idatefunc:
-                    idates += idatefunc(
-                        cn,
+                    jobs[sname] = partial(
+                        _auto_insertion_dates,
+                        engine,
                         tsh,
+                        idatefunc,
                         # localtree given in full: all params will be needed
                         # to build a proper series id
                         localtree,
-                        from_insertion_date=from_insertion_date,
-                        to_insertion_date=to_insertion_date
+                        from_insertion_date,
+                        to_insertion_date
                     )
                     continue
                 # delegate to other instance
-                idates += tsa.insertion_dates(
-                    name,
+                jobs[sname] = partial(
+                    tsa.insertion_dates,
+                    sname,
                     from_insertion_date=from_insertion_date,
                     to_insertion_date=to_insertion_date
                 )
                 continue
 
-            if tsh.cache.exists(cn, sname):
-                idates += tsh.cache.insertion_dates(
-                    cn,
-                    sname,
-                    from_insertion_date=from_insertion_date,
-                    to_insertion_date=to_insertion_date
+            if cachetablename:
+                selects.append(
+                    f'select insertion_date '
+                    f'from "{ns}-cache.revision"."{cachetablename}" '
+                    f'where true{datefilter}'
+                )
+            elif not isformula:
+                selects.append(
+                    f'select insertion_date '
+                    f'from "{ns}.revision"."{tablename}" '
+                    f'where true{datefilter}'
                 )
             else:
-                idates += tsh.insertion_dates(
-                    cn,
-                    sname,
-                    from_insertion_date=from_insertion_date,
-                    to_insertion_date=to_insertion_date
+                idates.update(
+                    tsh.insertion_dates(
+                        cn,
+                        sname,
+                        from_insertion_date=from_insertion_date,
+                        to_insertion_date=to_insertion_date
+                    )
                 )
 
-    return sorted(
-        set(idates)
-    )
+        if selects:
+            # local primaries and cached components in one query
+            idates.update(
+                pd.Timestamp(idate).astimezone('UTC')
+                for idate, in cn.execute(
+                    ' union '.join(selects) + ' order by 1',
+                    from_idate=from_insertion_date,
+                    to_idate=to_insertion_date
+                ).fetchall()
+            )
+
+    # the remote and auto-operator sources, concurrently
+    for sidates in _fetch_concurrently(jobs).values():
+        idates.update(sidates)
+
+    return sorted(idates)
+
+
+def _auto_insertion_dates(engine, tsh, idatefunc, tree,
+                          from_insertion_date, to_insertion_date):
+    with engine.begin() as cn:
+        return idatefunc(
+            cn,
+            tsh,
+            tree,
+            from_insertion_date=from_insertion_date,
+            to_insertion_date=to_insertion_date
+        )
 
 
 def has_today(formula):
@@ -415,25 +1055,321 @@ def has_today(formula):
     return _findtoday(tree)
 
 
-def refresh_series(engine, tsa, name, final_revdate=None):
-    """ Refresh a series cache """
+class _base_reader:
+    """ Forward to a tshistory object, keeping the series state read by
+    `get` (`diffs` starts with the state before its first revision) """
+    __slots__ = 'tsh', 'base'
+
+    def __init__(self, tsh):
+        self.tsh = tsh
+        self.base = None
+
+    def __getattr__(self, attr):
+        return getattr(self.tsh, attr)
+
+    def get(self, cn, name, **kw):
+        self.base = self.tsh.get(cn, name, **kw)
+        return self.base
+
+
+class _component_history:
+    """ The successive states of a series, rebuilt from its diffs as
+    increasing revision dates are asked """
+    __slots__ = 'state', 'revs', 'pending', 'tzaware', 'lock'
+
+    def __init__(self, cn, tsh, name, from_idate, to_idate):
+        self.tzaware = tsh.tzaware(cn, name)
+        reader = _base_reader(tsh)
+        self.revs = diffs(
+            cn, reader, name,
+            tsh._series_to_tablename(cn, name),
+            from_idate, to_idate
+        )
+        self.pending = next(self.revs, None)
+        # the state before `from_idate`, read once by `diffs`
+        self.state = reader.base
+        self.lock = threading.Lock()
+
+    def get(self, revision_date, from_value_date=None, to_value_date=None):
+        with self.lock:
+            while self.pending is not None and self.pending[1] <= revision_date:
+                self.state = patch(self.state, self.pending[2]).dropna()
+                self.pending = next(self.revs, None)
+            state = self.state
+
+        return state.loc[
+            compatible_date(self.tzaware, from_value_date):
+            compatible_date(self.tzaware, to_value_date)
+        ].copy()
+
+
+class batch_interpreter(Interpreter):
+    """ Formula interpreter serving the local components of a formula
+    out of their pre-loaded history """
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'vcache', 'auto', 'components')
+
+    def __init__(self, cn, tsh, components):
+        super().__init__(cn, tsh, {})
+        self.components = components
+
+    def get(self, name, getargs):
+        history = self.components.get(name)
+        revdate = getargs.get('revision_date')
+        if (history is None or
+            revdate is None or
+            revdate != self.getargs['revision_date']):
+            return super().get(name, getargs)
+
+        ts = history.get(
+            revdate,
+            getargs.get('from_value_date'),
+            getargs.get('to_value_date')
+        )
+        ts.name = name
+        return ts
+
+
+@contextmanager
+def formula_evaluator(tsa, formula, from_revdate, to_revdate, batched=True):
+    """ Provide a function to evaluate a formula at increasing revision
+    dates within [from_revdate, to_revdate].
+
+    In batched mode, the history of the local primary series involved
+    is loaded once for the whole span and the formula gets evaluated
+    out of their in-memory states.
+    """
+    if not batched:
+        def evaluate(revision_date, from_value_date, to_value_date):
+            return tsa.eval_formula(
+                formula,
+                revision_date=revision_date,
+                from_value_date=from_value_date,
+                to_value_date=to_value_date,
+            )
+        yield evaluate
+        return
+
+    tsh, engine = tsa.tsh, tsa.engine
+    with engine.begin() as cn:
+        tree = tsh._expanded_formula(
+            cn,
+            formula,
+            qargs={}  # the stopnames will give us the cached components
+        )
+        components = {}
+        for sname in tsh.find_series(cn, tree):
+            if not tsh.exists(cn, sname):
+                # remote series
+                continue
+            # the cached formulas keep going through the regular
+            # read path (which knows when to bypass a cache)
+            if tsh.type(cn, sname) == 'primary':
+                components[sname] = _component_history(
+                    cn, tsh, sname, from_revdate, to_revdate
+                )
+
+        interpreter = batch_interpreter(cn, tsh, components)
+
+        def evaluate(revision_date, from_value_date, to_value_date):
+            qargs = {
+                'revision_date': revision_date,
+                'from_value_date': from_value_date,
+                'to_value_date': to_value_date
+            }
+            interpreter.getargs = qargs
+            return interpreter.evaluate(
+                inject_toplevel_bindings(tree, qargs)
+            )
+
+        yield evaluate
+
+
+# incremental refresh
+
+# operators computing each point out of the same value date points of
+# their inputs: a formula only made of those can be refreshed over the
+# value dates of the upstream changes only
+POINTWISE_OPERATORS = {
+    '+', '*', '/', 'add', 'sub', 'mul', 'div', 'priority', 'abs',
+    'round', 'clip', 'min', 'max', 'row-mean', 'row-min', 'row-max',
+    'series'
+}
+
+
+def is_pointwise(tree):
+    """ Tell if an (expanded) formula only uses pointwise operators """
+    if not isinstance(tree, list):
+        return True
+    if tree[0] not in POINTWISE_OPERATORS:
+        return False
+    if tree[0] == 'series' and 'fill' in tree:
+        # ffill/bfill look at the neighbours
+        fill = tree[tree.index('fill') + 1]
+        if isinstance(fill, str):
+            return False
+    return all(
+        is_pointwise(item)
+        for item in tree[1:]
+    )
+
+
+def _upstream_diffs(cn, tsh, tree, from_idate, to_idate):
+    """ Return the sorted (insertion_date, diffstart, diffend) triples of
+    the revisions of the components of an expanded formula within
+    ]from_idate, to_idate], in one query.
+
+    When some component has no known revision table (remote series),
+    None is returned.
+    """
+    selects = []
+    tzaware = None
+    for sname in tsh.find_series(cn, tree):
+        if not tsh.exists(cn, sname):
+            return
+        if tsh.type(cn, sname) == 'primary':
+            source = tsh
+        elif tsh.cache.exists(cn, sname):
+            source = tsh.cache
+        else:
+            return
+        tzaware = source.tzaware(cn, sname)
+        tablename = source._series_to_tablename(cn, sname)
+        selects.append(
+            f'select insertion_date, diffstart, diffend '
+            f'from "{source.namespace}.revision"."{tablename}" '
+            f'where insertion_date > %(from_idate)s and '
+            f'      insertion_date <= %(to_idate)s'
+        )
+
+    if not selects:
+        return []
+
+    def utc(stamp):
+        if stamp is None:
+            return None
+        stamp = pd.Timestamp(stamp)
+        if not tzaware:
+            # the naive stamps are stored using the session time zone
+            return stamp.replace(tzinfo=None).tz_localize('UTC')
+        return stamp.tz_convert('UTC')
+
+    return [
+        (pd.Timestamp(idate).tz_convert('UTC'), utc(start), utc(end))
+        for idate, start, end in cn.execute(
+            ' union all '.join(selects) + ' order by 1',
+            from_idate=from_idate,
+            to_idate=to_idate
+        ).fetchall()
+    ]
+
+
+def _utc(stamp):
+    stamp = pd.Timestamp(stamp)
+    if stamp.tzinfo is None:
+        return stamp.tz_localize('UTC')
+    return stamp.tz_convert('UTC')
+
+
+def changed_intervals(revs, idates, prevdate, revdate, window, prevwindow):
+    """ Compute the value date intervals to re-evaluate at `revdate`,
+    given the upstream revisions made since `prevdate` (the last
+    evaluated revision) and the move of the evaluation window.
+
+    `idates` holds the (sorted) insertion dates of the `revs`
+    revisions, to find those of the ]prevdate, revdate] slice.
+
+    Returns a list of disjoint closed intervals, possibly empty.
+    """
+    fvd, tvd = window
+    pfvd, ptvd = prevwindow
+    spans = []
+    for _, start, end in revs[
+            bisect_right(idates, prevdate):bisect_right(idates, revdate)
+    ]:
+        if start is None or end is None:
+            # unknown diff bounds (unmigrated revision table)
+            return [window]
+        spans.append((max(start, fvd), min(end, tvd)))
+
+    # the window move brings in points unseen by the last evaluation
+    if tvd > ptvd:
+        spans.append((max(ptvd, fvd), tvd))
+    if fvd < pfvd:
+        spans.append((fvd, min(pfvd, tvd)))
+
+    merged = []
+    for start, end in sorted(spans):
+        if start > end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            continue
+        merged.append((start, end))
+    return merged
+
+
+def _resume_revdate(engine, tsh, target, policy):
+    """ The revision date from which the refresh of an existing cache
+    resumes """
+    cached_last_idate = tsh.cache.summary(engine, target)['last_idate']
+    policy_initial_revdate = pd.Timestamp(
+        eval_moment(policy['initial_revdate']),
+        tz='UTC'
+    )
+    # usefull for discontinued series & edited caches
+    initial_revdate = max(cached_last_idate, policy_initial_revdate)
+    with engine.begin() as cn:
+        checkpoint = refresh_checkpoint(cn, target, tsh.namespace)
+    if checkpoint is not None:
+        # revision dates up to there were already computed
+        # (possibly yielding no new revision)
+        initial_revdate = max(initial_revdate, checkpoint)
+    return initial_revdate
+
+
+def refresh_series(engine, tsa, name, final_revdate=None, batched=True,
+                   incremental=False, chunksize=10):
+    """ Refresh a series cache
+
+    The computed revisions are committed by chunks of `chunksize`
+    revision dates, together with a checkpoint: an interrupted refresh
+    resumes after the last committed chunk.
+
+    With `batched`, the history of the formula components is loaded
+    once for all the revisions to compute (see `formula_evaluator`).
+
+    With `incremental`, formulas made of pointwise operators only are
+    evaluated over the value dates touched by the upstream revisions
+    (using their diffstart/diffend bounds) rather than over the whole
+    look_before/look_after window.
+
+    Each refresh is recorded in the refresh log (see `refresh_log`).
+    """
     tsh = tsa.tsh
     policy = series_policy(engine, name, tsh.namespace)
 
     # now, prepare the formula
     formula = tsa.formula(name)
 
-    with series_refresh_lock(engine, name, tsh.namespace):
+    with series_refresh_lock(engine, name, tsh.namespace), \
+         _logged_refresh(engine, name, tsh.namespace) as stats:
+        # the cache series we write to
+        target = name
         exists = tsh.cache.exists(engine, name)
+        if exists and tsh.cache.summary(engine, name)['outdated']:
+            # rebuild in the shadow, the outdated cache serves the
+            # reads meanwhile
+            target = shadow_name(name)
+            exists = tsh.cache.exists(engine, target)
+            print(f'rebuilding the outdated cache of {name}')
+
+        def finish():
+            if target != name and tsh.cache.exists(engine, target):
+                with engine.begin() as cn:
+                    _swap_shadow(cn, tsh, name)
+
         if exists:
-            cache_idates = tsh.cache.insertion_dates(engine, name)
-            cached_last_idate = cache_idates[-1]
-            policy_initial_revdate = pd.Timestamp(
-                eval_moment(policy['initial_revdate']),
-                tz='UTC'
-            )
-            # usefull for discontinued series & edited caches
-            initial_revdate = max(cached_last_idate, policy_initial_revdate)
+            initial_revdate = _resume_revdate(engine, tsh, target, policy)
         else:
             # cache creation
             initial_revdate = pd.Timestamp(
@@ -442,37 +1378,52 @@ def refresh_series(engine, tsa, name, final_revdate=None):
             )
             # the first cache revision contains a full horizon view of
             # the underlying series
-            ts = tsa.eval_formula(
-                formula,
-                revision_date=initial_revdate
-            )
+            with stats.timing('eval_time'):
+                ts = tsa.eval_formula(
+                    formula,
+                    revision_date=initial_revdate
+                )
             print(f'{initial_revdate} -> {len(ts)} points (initial full horizon import)')
             if len(ts):
-                tsh.cache.update(
-                    engine,
-                    ts,
-                    name,
-                    'formula-cacher',
-                    insertion_date=initial_revdate
-                )
+                with stats.timing('write_time'):
+                    tsh.cache.update(
+                        engine,
+                        ts,
+                        target,
+                        'formula-cacher',
+                        insertion_date=initial_revdate
+                    )
+                stats.revisions += 1
+                stats.points += len(ts)
             else:
                 print(f'there was no data (!) for the first cache revision ({name})')
 
         now = pd.Timestamp.utcnow()
-        idates = _insertion_dates(
-            tsa,
-            name,
-            from_insertion_date=initial_revdate,
-            to_insertion_date=now
-        )
+        with stats.timing('idates_time'):
+            idates = _insertion_dates(
+                tsa,
+                name,
+                from_insertion_date=initial_revdate,
+                to_insertion_date=now
+            )
         do_all_idates = has_today(formula)
+        # everything up to there will have been seen
+        watermark = min(final_revdate or now, now)
         if (not idates or not len(idates)) and not do_all_idates:
             print(f'no idate over {initial_revdate} -> {now}, no refresh')
+            stats.outcome = 'nothing'
+            with engine.begin() as cn:
+                _set_stale_after(
+                    cn, target, initial_revdate, watermark, policy, tsh.namespace
+                )
+            finish()
             return  # that's an odd series, let's bail out
 
         final_revdate = final_revdate or pd.Timestamp.utcnow()
         if initial_revdate >= final_revdate:
             print('empty interval, nothing to do')
+            stats.outcome = 'nothing'
+            finish()
             return
 
         print('starting range refresh', initial_revdate, '->', final_revdate)
@@ -487,44 +1438,115 @@ def refresh_series(engine, tsa, name, final_revdate=None):
             # let's not prune anything
             reduced_cron = cron_range
         else:
-            reduced_cron = helper.reduce_frequency(list(cron_range), idates)
+            reduced_cron = helper.reduce_frequency(cron_range, idates)
+
+        revs = None
+        if incremental and not do_all_idates:
+            with engine.begin() as cn:
+                tree = tsh._expanded_formula(cn, formula, qargs={})
+                if is_pointwise(tree):
+                    revs = _upstream_diffs(
+                        cn, tsh, tree, initial_revdate, final_revdate
+                    )
+            if revs is None:
+                print('incremental refresh not possible, using the full window')
+            else:
+                revidates = [idate for idate, _, _ in revs]
 
-        for idx, revdate in enumerate(reduced_cron):
-            # native python datetimes lack some method
-            revdate = pd.Timestamp(revdate)
+        # last evaluated revision and value date window
+        prevdate = initial_revdate
+        if exists:
+            prevwindow = (
+                _utc(eval_moment(policy['look_before'], {'now': initial_revdate})),
+                _utc(eval_moment(policy['look_after'], {'now': initial_revdate}))
+            )
+        else:
+            # the first revision has the full horizon
+            prevwindow = (pd.Timestamp.min.tz_localize('UTC'),
+                          pd.Timestamp.max.tz_localize('UTC'))
+
+        pending = []
+        done = []
+
+        def commit():
+            if not done:
+                return
+            with stats.timing('write_time'), engine.begin() as cn:
+                tsh.cache.update_many(
+                    cn,
+                    target,
+                    pending,
+                    'formula-cacher'
+                )
+                _set_refresh_checkpoint(cn, target, done[-1], tsh.namespace)
+            stats.revisions += len(pending)
+            stats.points += sum(len(ts) for _, ts in pending)
+            pending.clear()
+            done.clear()
 
-            if exists:
-                if revdate == initial_revdate:
+        with formula_evaluator(
+                tsa,
+                formula,
+                initial_revdate,
+                final_revdate,
+                batched=batched
+        ) as evaluate:
+            evaluate = stats.timed('eval_time', evaluate)
+            for idx, revdate in enumerate(reduced_cron):
+                # native python datetimes lack some method
+                revdate = pd.Timestamp(revdate)
+
+                if exists:
+                    if revdate == initial_revdate:
+                        continue
+
+                if not idx and not exists:
+                    # cache creation: first revision was created before
                     continue
 
-            if not idx and not exists:
-                # cache creation: first revision was created before
-                continue
-
-            from_value_date = eval_moment(
-                policy['look_before'],
-                {'now': revdate}
-            )
-            to_value_date = eval_moment(
-                policy['look_after'],
-                {'now': revdate}
-            )
+                from_value_date = eval_moment(
+                    policy['look_before'],
+                    {'now': revdate}
+                )
+                to_value_date = eval_moment(
+                    policy['look_after'],
+                    {'now': revdate}
+                )
 
-            ts = tsa.eval_formula(
-                formula,
-                revision_date=revdate,
-                from_value_date=from_value_date,
-                to_value_date=to_value_date,
+                if revs is None:
+                    ts = evaluate(
+                        revdate,
+                        from_value_date,
+                        to_value_date
+                    )
+                else:
+                    window = _utc(from_value_date), _utc(to_value_date)
+                    intervals = changed_intervals(
+                        revs, revidates, prevdate, revdate, window, prevwindow
+                    )
+                    prevdate, prevwindow = revdate, window
+                    parts = [
+                        evaluate(revdate, start, end)
+                        for start, end in intervals
+                    ]
+                    ts = pd.Series(dtype='float64')
+                    if parts:
+                        ts = pd.concat(parts)
+                        ts = ts[~ts.index.duplicated(keep='last')].sort_index()
+                    print(f'{revdate} -> evaluated over {intervals}')
+                print(f'{revdate} -> {len(ts)} points')
+                if len(ts):
+                    pending.append((revdate, ts))
+                done.append(revdate)
+                if len(done) >= chunksize:
+                    commit()
+
+        commit()
+        with engine.begin() as cn:
+            _set_stale_after(
+                cn, target, initial_revdate, watermark, policy, tsh.namespace
             )
-            print(f'{revdate} -> {len(ts)} points')
-            if len(ts):
-                tsh.cache.update(
-                    engine,
-                    ts,
-                    name,
-                    'formula-cacher',
-                    insertion_date=revdate
-                )
+        finish()
 
 
 def refresh_now(engine, tsa, name):
@@ -540,8 +1562,9 @@ def refresh_now(engine, tsa, name):
     now = pd.Timestamp.utcnow()
     formula = tsa.formula(name)
     with series_refresh_lock(engine, name, tsh.namespace):
-        known_min_date = tsh.cache.interval(engine, name).left
-        tzaware = tsh.cache.tzaware(engine, name)
+        summary = tsh.cache.summary(engine, name)
+        known_min_date = summary['interval'].left
+        tzaware = summary['tzaware']
 
         before = eval_moment(
             policy['look_before'],
@@ -569,15 +1592,368 @@ def refresh_now(engine, tsa, name):
 
         print(f'{now} -> {len(ts)} points')
         if len(ts):
-            tsh.cache.update(
-                engine,
-                ts,
-                name,
-                'formula-cacher'
+            with engine.begin() as cn:
+                tsh.cache.update(
+                    cn,
+                    ts,
+                    name,
+                    'formula-cacher',
+                    insertion_date=now
+                )
+                _set_stale_after(cn, name, now, now, policy, tsh.namespace)
+
+
+def plan_refresh(tsa, names, policy, final_revdate=None):
+    """ Dry run of the refresh of some series with a policy (a dict
+    with at least the initial_revdate and revdate_rule expressions):
+    nothing is written.
+
+    For each series, it tells from where the refresh would start
+    ("from", resuming an existing cache or creating it), the number
+    of revision dates of the policy up to `final_revdate` ("revdates")
+    and of those which see new insertions upstream ("reduced"), the
+    number of component series and insertion dates involved and an
+    estimate of the refresh time in seconds (or None), based on the
+    refresh log.
+    """
+    engine, tsh = tsa.engine, tsa.tsh
+    now = pd.Timestamp.utcnow()
+    final_revdate = final_revdate or now
+    costs = _refresh_costs(engine, names, tsh.namespace)
+
+    plan = []
+    for name in names:
+        target = name
+        exists = tsh.cache.exists(engine, name)
+        if exists and tsh.cache.summary(engine, name)['outdated']:
+            target = shadow_name(name)
+            exists = tsh.cache.exists(engine, target)
+        if exists:
+            initial_revdate = _resume_revdate(engine, tsh, target, policy)
+        else:
+            initial_revdate = pd.Timestamp(
+                eval_moment(policy['initial_revdate']),
+                tz='UTC'
+            )
+
+        formula = tsh.formula(engine, name)
+        with engine.begin() as cn:
+            tree = tsh._expanded_formula(cn, formula, qargs={})
+            components = tsh.find_series(cn, tree)
+        idates = _insertion_dates(
+            tsa,
+            name,
+            from_insertion_date=initial_revdate,
+            to_insertion_date=now
+        ) or []
+
+        revdates = reduced = 0
+        if initial_revdate < final_revdate:
+            revdates = sum(
+                1 for _ in croniter_range(
+                    initial_revdate,
+                    final_revdate,
+                    policy['revdate_rule']
+                )
+            )
+            if has_today(formula):
+                reduced = revdates
+            elif len(idates):
+                reduced = len(
+                    helper.reduce_frequency(
+                        croniter_range(
+                            initial_revdate,
+                            final_revdate,
+                            policy['revdate_rule']
+                        ),
+                        idates
+                    )
+                )
+
+        estimate = None
+        cost = costs.get(name, costs.get(None))
+        if cost is not None:
+            per_revision, idates_time = cost
+            estimate = idates_time + per_revision * reduced
+
+        plan.append({
+            'name': name,
+            'cached': tsh.cache.exists(engine, name),
+            'from': initial_revdate,
+            'to': final_revdate,
+            'revdates': revdates,
+            'reduced': reduced,
+            'components': len(components),
+            'idates': len(idates),
+            'estimate': estimate
+        })
+    return plan
+
+
+def _refresh_costs(engine, names, namespace='tsh'):
+    """ Average cost of a revision and of the insertion dates lookup
+    (in seconds) from the successful refreshes of the refresh log,
+    per series and over all the series (None key) """
+    q = (
+        f'select {{key}}, '
+        f'       sum(l.wall_time - l.idates_time) / sum(l.revisions), '
+        f'       avg(l.idates_time) '
+        f'from "{namespace}".cache_refresh_log as l '
+        f'join "{namespace}".registry as r on r.id = l.series_id '
+        f'where l.outcome = \'done\' and l.revisions > 0 {{filter}}'
+    )
+    with engine.begin() as cn:
+        costs = {
+            name: (perrev, idates)
+            for name, perrev, idates in cn.execute(
+                q.format(
+                    key='r.name',
+                    filter='and r.name = any(%(names)s) group by r.name'
+                ),
+                names=list(names)
+            ).fetchall()
+        }
+        perrev, idates = cn.execute(
+            q.format(key='null', filter='')
+        ).fetchone()[1:]
+    if perrev is not None:
+        costs[None] = perrev, idates
+    return costs
+
+
+def plan_policy(tsa, policy, final_revdate=None, **overrides):
+    """ Dry run of the refresh of a cache policy (see `plan_refresh`),
+    in refresh order.
+
+    The policy parameters can be overridden (e.g. to evaluate a new
+    revdate_rule) and the `names` of the series given (e.g. for a
+    policy yet to be created, with all the parameters given).
+    """
+    tsh = tsa.tsh
+    ns = tsh.namespace
+    names = overrides.pop('names', None)
+    with tsa.engine.begin() as cn:
+        exists = cn.execute(
+            f'select 1 from "{ns}".cache_policy where name = %(name)s',
+            name=policy
+        ).scalar()
+    params = {}
+    if exists:
+        params = policy_by_name(tsa.engine, policy, namespace=ns)
+        if names is None:
+            names = policy_series(tsa.engine, policy, namespace=ns)
+    params.update(
+        (key, value) for key, value in overrides.items()
+        if value is not None
+    )
+    missing = {'initial_revdate', 'revdate_rule'} - set(params)
+    if missing:
+        raise ValueError(
+            f'unknown policy `{policy}`: missing {sorted(missing)}'
+        )
+
+    names = names or []
+    with tsa.engine.begin() as cn:
+        graph = helper.dependency_graph(cn, tsh, names)
+    ordered = [
+        name
+        for level in helper.dependency_levels(graph, names)
+        for name in level
+    ]
+    return plan_refresh(tsa, ordered, params, final_revdate=final_revdate)
+
+
+def _refresh_series_safely(tsa, name, final_revdate, checkhash,
+                           incremental=False):
+    """ Refresh a series cache and report success as a boolean (errors
+    are printed, not raised), or None when the series was skipped.
+
+    The dirty flag of the series is cleared after a successful
+    refresh, once its checkpoint has reached the latest upstream write
+    (an upstream write between two revision dates keeps it dirty until
+    the next one is evaluated), unless its inputs cannot be tracked.
+
+    A series which failed is skipped until its backoff delay expires
+    (see `_record_failure`).
+    """
+    engine, tsh = tsa.engine, tsa.tsh
+    with engine.begin() as cn:
+        retry_after = _retry_after(cn, name, tsh.namespace)
+    if retry_after is not None:
+        print(f'skipping the failing series `{name}` until {retry_after}')
+        with _logged_refresh(engine, name, tsh.namespace) as stats:
+            stats.outcome = 'skipped'
+        return None
+
+    print('refresh ->', name)
+    try:
+        with engine.begin() as cn:
+            if checkhash:
+                if tsh.live_content_hash(cn, name) != tsh.content_hash(cn, name):
+                    tsh.outdate_cache(cn, name)
+            tracked = _track_inputs(cn, tsh, name)
+
+        refresh_series(
+            engine,
+            tsa,
+            name,
+            final_revdate=final_revdate,
+            incremental=incremental
+        )
+    except Exception as err:
+        traceback.print_exc()
+        print(f'series `{name}` crashed because {err}')
+        with engine.begin() as cn:
+            mark_dirty(cn, [name], tsh.namespace)
+            _record_failure(cn, name, err, tsh.namespace)
+        return False
+
+    with engine.begin() as cn:
+        clear_failures(cn, [name], tsh.namespace)
+        if tracked:
+            _clear_dirty(cn, name, tsh.namespace)
+    return True
+
+
+# process pool workers get the api object through fork inheritance
+_WORKERTSA = None
+
+
+def _init_process_worker(tsa):
+    global _WORKERTSA
+    # the inherited connections belong to the parent process
+    tsa.engine.dispose(close=False)
+    # and so does a possibly captured stdout/stderr
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    _WORKERTSA = tsa
+
+
+def _process_refresh(name, final_revdate, checkhash, incremental):
+    return _refresh_series_safely(
+        _WORKERTSA, name, final_revdate, checkhash, incremental
+    )
+
+
+@contextmanager
+def level_runner(tsa, workers=1, pool='thread', incremental=False):
+    """ Provide a function to refresh a list of independent series (a
+    dependency level) using `workers` threads or processes.
+
+    With the "rework" pool, each series is refreshed by its own
+    `refresh_formula_cache_series` task (spread over the workers of
+    the timeseries domain) and the function waits for all of them.
+    If the caller itself runs in that domain, it needs at least one
+    other worker.
+
+    The function returns the lists of the failed series and of the
+    series skipped (see `_refresh_series_safely`).
+    """
+    assert pool in ('thread', 'process', 'rework'), f'unknown pool kind `{pool}`'
+
+    if pool == 'rework':
+        def run(names, final_revdate, checkhash):
+            tasks = [
+                (name, rapi.schedule(
+                    tsa.engine,
+                    'refresh_formula_cache_series',
+                    domain='timeseries',
+                    inputdata={
+                        'name': name,
+                        'final_revdate': final_revdate,
+                        'checkhash': checkhash,
+                        'incremental': incremental
+                    }
+                ))
+                for name in names
+            ]
+            for _, task in tasks:
+                task.join()
+            return (
+                sorted(
+                    name for name, task in tasks
+                    if task.state != 'done'
+                ),
+                sorted(
+                    name for name, task in tasks
+                    if task.state == 'done' and task.output == 'skipped'
+                )
             )
+        yield run
+        return
 
+    if workers <= 1:
+        def run(names, final_revdate, checkhash):
+            results = [
+                _refresh_series_safely(
+                    tsa, name, final_revdate, checkhash, incremental
+                )
+                for name in names
+            ]
+            return _outcomes(names, results)
+        yield run
+        return
+
+    if pool == 'thread':
+        def run(names, final_revdate, checkhash):
+            results = {}
+
+            def refresh(name):
+                results[name] = _refresh_series_safely(
+                    tsa, name, final_revdate, checkhash, incremental
+                )
 
-def refresh_policy(tsa, policy, final_revdate=None):
+            threadpool(workers)(refresh, [(name,) for name in names])
+            return _outcomes(names, [results[name] for name in names])
+        yield run
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context('fork'),
+            initializer=_init_process_worker,
+            initargs=(tsa,)
+    ) as executor:
+        def run(names, final_revdate, checkhash):
+            results = executor.map(
+                _process_refresh,
+                names,
+                [final_revdate] * len(names),
+                [checkhash] * len(names),
+                [incremental] * len(names)
+            )
+            return _outcomes(names, results)
+        yield run
+
+
+def _outcomes(names, results):
+    """ Split the refreshed series into the (sorted) failed and skipped
+    ones, from the results of `_refresh_series_safely` """
+    failed, skipped = [], []
+    for name, ok in zip(names, results):
+        if ok is None:
+            skipped.append(name)
+        elif not ok:
+            failed.append(name)
+    return sorted(failed), sorted(skipped)
+
+
+def refresh_policy(tsa, policy, final_revdate=None, workers=1, pool='thread',
+                   incremental=False, dirty_only=False):
+    """ Refresh all the series of a cache policy.
+
+    The series are grouped in dependency levels (a cached series is
+    always refreshed before the series that use it) and the series of
+    a given level are refreshed concurrently using `workers` threads
+    or processes (`pool` being either "thread" or "process"), or
+    rework tasks (`pool` being "rework", see `level_runner`).
+
+    With `incremental`, the cache updates only re-evaluate the value
+    dates touched upstream when possible (see `refresh_series`).
+
+    With `dirty_only`, the cached series whose inputs have not been
+    written since their last refresh are skipped (they are only
+    marked as up to date).
+    """
     tsh = tsa.tsh
     names = policy_series(
         tsa.engine,
@@ -603,58 +1979,184 @@ def refresh_policy(tsa, policy, final_revdate=None):
         if name not in unames
     ]
 
-    cmp = helper.comparator(tsh, engine)
-    names.sort(key=cmp_to_key(cmp))
+    pol = policy_by_name(engine, policy, namespace=tsh.namespace)
+
+    def dirty_level(level):
+        # checked once the previous levels are refreshed: their cache
+        # writes flag the series computed from them
+        if not dirty_only:
+            return level
+        with engine.begin() as cn:
+            dirty = dirty_series(cn, level, namespace=tsh.namespace)
+            clean = [name for name in level if name not in dirty]
+            _skip_clean(cn, pol, clean, final_revdate, tsh.namespace)
+        if clean:
+            print(f'skipping {len(clean)} up to date series')
+        return [name for name in level if name in dirty]
+
+    with engine.begin() as cn:
+        graph = helper.dependency_graph(cn, tsh, names + list(unames))
+    levels = helper.dependency_levels(graph, names)
+    ulevels = helper.dependency_levels(graph, unames)
+
+    print(
+        f'refresh in order: {[name for level in levels for name in level]}, '
+        f'then {[name for level in ulevels for name in level]}'
+    )
 
-    unames = list(unames)
-    unames.sort(key=cmp_to_key(cmp))
+    failed, skipped = [], []
+    with level_runner(tsa, workers, pool, incremental) as run:
+        # first batch (potentially just a refresh if not an initial run)
+        print(f'first batch (cache update) ({len(names)} series)')
+        for level in levels:
+            lfailed, lskipped = run(dirty_level(level), final_revdate, True)
+            failed += lfailed
+            skipped += lskipped
 
-    print(f'refresh in order: {names}, then {unames}')
+        # second batch (potentially re-filling invalidated caches)
+        print(f'second batch (full cache construction) ({len(unames)} series)')
+        for level in ulevels:
+            lfailed, lskipped = run(level, final_revdate, False)
+            failed += lfailed
+            skipped += lskipped
 
-    failed = []
+    if skipped:
+        print(
+            f'the following failing series wait for their retry: '
+            f'{", ".join(skipped)}'
+        )
+    if failed:
+        print(
+            f'the following series failed to be refreshed: '
+            f'{", ".join(failed)}'
+        )
+        raise Exception(f'failed series on refresh: {failed}')
 
-    # first batch (potentially just a refresh if not an initial run)
-    print(f'first batch (cache update) ({len(names)} series)')
-    for name in names:
-        print('refresh ->', name)
+
+def refresh_policy_cooperative(tsa, policy, final_revdate=None,
+                               incremental=False, dirty_only=False,
+                               poll=1):
+    """ Refresh the series of a cache policy together with the other
+    nodes doing the same, with no central coordination.
+
+    The series are claimed one by one in dependency order using a non
+    blocking refresh lock: a series being refreshed elsewhere is left
+    to its node. A series is ready once its dependencies (in the
+    policy) have been refreshed since the start of the run (by any
+    node) or have failed (or been skipped) here. When nothing is ready, the node waits
+    `poll` seconds for the other nodes to make progress.
+    """
+    tsh = tsa.tsh
+    engine = tsa.engine
+    ns = tsh.namespace
+    since = final_revdate or pd.Timestamp.now(tz='UTC')
+    names = policy_series(engine, policy, namespace=ns)
+    print(f'Cooperative refresh of cache policy `{policy}` (ns={ns})')
+
+    pol = policy_by_name(engine, policy, namespace=ns)
+    with engine.begin() as cn:
+        graph = helper.dependency_graph(cn, tsh, names)
+    needs = _policy_needs(graph, names)
+    order = [
+        name
+        for level in helper.dependency_levels(graph, names)
+        for name in level
+    ]
+
+    todo = set(names)
+    failed, skipped = [], []
+    while todo:
         with engine.begin() as cn:
-            if tsh.live_content_hash(cn, name) != tsh.content_hash(cn, name):
-                tsh.invalidate_cache(cn, name)
+            todo -= _refreshed_since(cn, todo, since, ns)
 
-        try:
-            refresh_series(
-                engine,
-                tsa,
-                name,
-                final_revdate=final_revdate
-            )
-        except Exception as err:
-            failed.append(name)
-            traceback.print_exc()
-            print(f'series `{name}` crashed because {err}')
+        progress = False
+        for name in order:
+            if name not in todo or needs[name] & todo:
+                continue
+            with series_refresh_lock(engine, name, ns, wait=False) as mine:
+                if not mine:
+                    # another node is on it
+                    continue
+                with engine.begin() as cn:
+                    if _refreshed_since(cn, [name], since, ns):
+                        todo.discard(name)
+                        continue
+                checkhash = tsh.cache.exists(engine, name)
+                if dirty_only and checkhash:
+                    # checked once its dependencies are refreshed: their
+                    # cache writes flag it
+                    with engine.begin() as cn:
+                        if not dirty_series(cn, [name], namespace=ns):
+                            _skip_clean(cn, pol, [name], final_revdate, ns)
+                            todo.discard(name)
+                            progress = True
+                            continue
+                ok = _refresh_series_safely(
+                    tsa, name, final_revdate, checkhash, incremental
+                )
+                if ok is None:
+                    skipped.append(name)
+                elif not ok:
+                    failed.append(name)
+                todo.discard(name)
+                progress = True
 
-    # second batch (potentially re-filling invalidated caches)
-    print(f'second batch (full cache construction) ({len(unames)} series)')
-    for name in unames:
-        print('refresh ->', name)
-        try:
-            refresh_series(
-                engine,
-                tsa,
-                name,
-                final_revdate=final_revdate
-            )
-        except Exception as err:
-            failed.append(name)
-            traceback.print_exc()
-            print(f'series `{name}` crashed because {err}')
+        if todo and not progress:
+            time.sleep(poll)
 
+    if skipped:
+        print(
+            f'the following failing series wait for their retry: '
+            f'{", ".join(sorted(skipped))}'
+        )
     if failed:
         print(
             f'the following series failed to be refreshed: '
             f'{", ".join(failed)}'
         )
-        raise Exception(f'failed series on refresh: {failed}')
+        raise Exception(f'failed series on refresh: {sorted(failed)}')
+
+
+def _policy_needs(graph, names):
+    """ For each series of `names`, the series of `names` it depends
+    on (possibly through other formulas) """
+    names = set(names)
+    reach = {}
+    for node in helper.topological_sort(graph):
+        reach[node] = set()
+        for need in graph[node]:
+            reach[node] |= reach[need]
+            if need in names:
+                reach[node].add(need)
+    return {
+        name: reach.get(name, set())
+        for name in names
+    }
+
+
+def _refreshed_since(cn, names, since, namespace='tsh'):
+    """ Return the series of `names` whose cache has been refreshed up
+    to `since` """
+    return {
+        name for name, in cn.execute(
+            f'select r.name '
+            f'from "{namespace}".cache_refresh_checkpoint as cp, '
+            f'     "{namespace}-cache".registry as r '
+            f'where cp.series_id = r.id and '
+            f'      r.name = any(%(names)s) and '
+            f'      cp.watermark >= %(since)s',
+            names=list(names),
+            since=since
+        ).fetchall()
+    }
+
+
+def _skip_clean(cn, policy, names, final_revdate, namespace='tsh'):
+    """ Move forward the watermark of caches known to be up to date """
+    now = pd.Timestamp.now(tz='UTC')
+    watermark = min(final_revdate or now, now)
+    for name in names:
+        _set_stale_after(cn, name, watermark, watermark, policy, namespace)
 
 
 def refresh_policy_now(tsa, policy):
@@ -682,11 +2184,13 @@ def refresh_policy_now(tsa, policy):
         if name not in unames
     ]
 
-    cmp = helper.comparator(tsh, engine)
-    names.sort(key=cmp_to_key(cmp))
-
-    unames = list(unames)
-    unames.sort(key=cmp_to_key(cmp))
+    with engine.begin() as cn:
+        graph = helper.dependency_graph(cn, tsh, names + list(unames))
+    names = [
+        name
+        for level in helper.dependency_levels(graph, names)
+        for name in level
+    ]
 
     print(f'updating ({len(names)} series)')
     for name in names:
@@ -702,6 +2206,157 @@ def refresh_policy_now(tsa, policy):
         print('only a regular update can fix them')
 
 
+def enqueue_refresh(engine, policy_name, namespace='tsh'):
+    """ Schedule a refresh of a cache policy (of its dirty series),
+    unless one is already waiting in the queue """
+    r = engine.execute(
+        'select t.id '
+        'from rework.task as t, '
+        '     rework.operation as o '
+        'where t.operation = o.id and '
+        '      o.name = \'refresh_formula_cache\' and '
+        '      t.status = \'queued\''
+    )
+    for tid, in r.fetchall():
+        task = rtask.Task.byid(engine, tid)
+        if task.input['policy'] == policy_name:
+            return task
+    return rapi.schedule(
+        engine,
+        'refresh_formula_cache',
+        domain='timeseries',
+        inputdata={
+            'policy': policy_name
+        },
+    )
+
+
+class refresh_listener:
+    """ Refresh the caches of a policy shortly after their inputs are
+    written, rather than at the next scheduled refresh.
+
+    The writes flagging caches as dirty are notified on the dirty
+    channel of the namespace (see `mark_dependents_dirty`). They are
+    checked once no write has come for `debounce` seconds, or at the
+    latest `window` seconds after the first pending write (a steady
+    flow of writes is handled in batches).
+
+    A refresh is enqueued when some dirty series of the policy have a
+    revision date covering their latest upstream write to evaluate:
+    a write landing between two revision dates is only picked up once
+    the next one has come (see `due`).
+    """
+
+    def __init__(self, tsa, policy, debounce=5, window=60, enqueue=None):
+        self.engine = tsa.engine
+        self.namespace = tsa.tsh.namespace
+        self.policy = policy
+        self.debounce = debounce
+        self.window = window
+        self.enqueue = enqueue or partial(
+            enqueue_refresh,
+            self.engine,
+            policy,
+            namespace=self.namespace
+        )
+        # the revision date at which the pending writes can be refreshed
+        self.due = None
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self._listen()
+            except Exception:
+                traceback.print_exc()
+            if not self.stopped.is_set():
+                time.sleep(1)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _listen(self):
+        # a dedicated connection, out of the pool
+        fairy = self.engine.raw_connection()
+        fairy.detach()
+        cn = fairy.connection
+        try:
+            cn.autocommit = True
+            with cn.cursor() as cursor:
+                cursor.execute(
+                    f'listen "{dirty_channel(self.namespace)}"'
+                )
+            self.listening.set()
+            # catch up with the writes we have missed
+            self._flush()
+
+            first, last = None, None
+            while not self.stopped.is_set():
+                if select.select([cn], [], [], .1) != ([], [], []):
+                    cn.poll()
+                    while cn.notifies:
+                        cn.notifies.pop(0)
+                        last = time.monotonic()
+                        first = first or last
+                if first is not None:
+                    now = time.monotonic()
+                    if (now - last >= self.debounce or
+                        now - first >= self.window):
+                        self._flush()
+                        first, last = None, None
+                        continue
+                if (self.due is not None and
+                    pd.Timestamp.now(tz='UTC') >= self.due):
+                    self._flush()
+        finally:
+            self.listening.clear()
+            cn.close()
+
+    def _flush(self):
+        """ Enqueue a refresh if some tracked dirty series of the policy
+        have a revision date to evaluate, or else record when the
+        first one comes (in `due`) """
+        ns = self.namespace
+        with self.engine.begin() as cn:
+            pending = cn.execute(
+                f'select p.revdate_rule, '
+                f'       min(d.dirty_since) = \'-infinity\', '
+                f'       nullif(min(d.dirty_since), \'-infinity\') '
+                f'from "{ns}".cache_policy as p, '
+                f'     "{ns}".cache_policy_series as ps, '
+                f'     "{ns}".cache_dirty as d '
+                f'where p.name = %(policy)s and '
+                f'      ps.cache_policy_id = p.id and '
+                f'      d.series_id = ps.series_id and '
+                f'      exists (select 1 from "{ns}".cache_input as ci '
+                f'              where ci.series_id = ps.series_id) '
+                f'group by p.revdate_rule',
+                policy=self.policy
+            ).fetchone()
+        self.due = None
+        if pending is None:
+            return
+
+        rule, anytime, since = pending
+        if not anytime:
+            # the first revision date at or after the oldest write
+            due = pd.Timestamp(
+                croniter(
+                    rule,
+                    since - timedelta(microseconds=1)
+                ).get_next(datetime)
+            ).tz_convert('UTC')
+            if due > pd.Timestamp.now(tz='UTC'):
+                self.due = due
+                return
+
+        print(
+            f'upstream writes: refreshing the policy `{self.policy}`'
+        )
+        self.enqueue()
+
+
 @contextmanager
 def suspended_policies(engine, namespace='tsh'):
     """A context manager to deactivate  / reactivate policies.
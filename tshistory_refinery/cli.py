@@ -40,8 +40,32 @@ def setup_tasks(db_uri):
 @click.argument('db-uri')
 @click.argument('policy-name')
 @click.option('--initial', default=False, is_flag=True)
-def refresh_cache(db_uri, policy_name, initial=False):
+@click.option('--plan', default=False, is_flag=True,
+              help='show what the refresh would do (and do nothing)')
+def refresh_cache(db_uri, policy_name, initial=False, plan=False):
     dburi = find_dburi(db_uri)
+    if plan:
+        tsa = timeseries(dburi)
+        steps = tsa.cache_refresh_plan(policy_name)
+        total = 0
+        for step in steps:
+            estimate = step['estimate']
+            if estimate is not None:
+                total += estimate
+            print(
+                f'{step["name"]}: '
+                f'{"update" if step["cached"] else "creation"} '
+                f'from {step["from"]}, '
+                f'{step["reduced"]}/{step["revdates"]} revdates, '
+                f'{step["components"]} components, '
+                f'{step["idates"]} idates, '
+                f'estimate: ' + (
+                    f'{estimate:.1f}s' if estimate is not None else 'unknown'
+                )
+            )
+        print(f'{len(steps)} series, estimated total: {total:.1f}s')
+        return
+
     engine = create_engine(dburi)
     t = api.schedule(
         engine,
@@ -94,6 +118,11 @@ def migrate_to_cache(db_uri, namespace='tsh'):
     dburi = find_dburi(db_uri)
     engine = create_engine(dburi)
 
+    # the cache policy tables refer to the cache registry
+    from tshistory.schema import tsschema
+    schem = tsschema(f'{namespace}-cache')
+    schem.create(engine)
+
     exists = engine.execute(
         "select 1 from pg_tables where schemaname = 'tsh' and tablename = %(name)s",
         name='cache_policy'
@@ -104,10 +133,6 @@ def migrate_to_cache(db_uri, namespace='tsh'):
         with engine.begin() as cn:
             cn.execute(sqlfile(cache_policy, ns=namespace))
 
-    from tshistory.schema import tsschema
-    schem = tsschema(f'{namespace}-cache')
-    schem.create(engine)
-
 
 @click.command('init-db')
 @click.argument('db-uri')
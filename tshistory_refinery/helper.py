@@ -1,7 +1,15 @@
+from collections import (
+    defaultdict,
+    deque
+)
+from datetime import timezone
 import hashlib
+from itertools import islice
 import warnings
 
 from inireader import reader
+import numpy as np
+from psyl.lisp import parse
 from tshistory.api import timeseries
 
 
@@ -47,7 +55,11 @@ def hash64(text: str) -> int:
 # topological sort of formulas
 
 def comparator(tsh, engine):
-    """ produces a `cmp` function to order series by dependents """
+    """ produces a `cmp` function to order series by dependents
+
+    Note: this costs two queries per comparison, prefer
+    `dependency_graph` and `topological_sort`.
+    """
 
     def compare(n1, n2):
         d1 = tsh.dependents(engine, n1)
@@ -71,15 +83,195 @@ def comparator(tsh, engine):
     return compare
 
 
-def reduce_frequency(tempo, idates):
-    if not len(tempo):
-        return tempo
+def _formula_edges(cn, namespace, roots=None):
+    """ collect the (formula, needed formula) edges of the `dependent`
+    table, either for the whole namespace or for the sub-graph
+    reachable from the `roots` names
+    """
+    if roots is None:
+        q = (
+            f'select f.name, n.name '
+            f'from "{namespace}".dependent as d, '
+            f'     "{namespace}".registry as f, '
+            f'     "{namespace}".registry as n '
+            f'where d.sid = f.id and d.needs = n.id'
+        )
+        return cn.execute(q).fetchall()
+
+    q = (
+        f'with recursive edges (sid, needs) as ( '
+        f'  select d.sid, d.needs '
+        f'  from "{namespace}".dependent as d, '
+        f'       "{namespace}".registry as r '
+        f'  where d.sid = r.id and r.name = any(%(roots)s) '
+        f' union '
+        f'  select d.sid, d.needs '
+        f'  from "{namespace}".dependent as d, edges as e '
+        f'  where d.sid = e.needs '
+        f') '
+        f'select f.name, n.name '
+        f'from edges as e, '
+        f'     "{namespace}".registry as f, '
+        f'     "{namespace}".registry as n '
+        f'where e.sid = f.id and e.needs = n.id'
+    )
+    return cn.execute(q, roots=list(roots)).fetchall()
+
+
+def dependency_graph(cn, tsh, names=None):
+    """ produces the formula dependency graph as a mapping from formula
+    name to the set of formulas it directly needs
+
+    The edges are loaded in one query, either for the whole namespace
+    (when `names` is None) or for the sub-graph reachable from `names`.
+    Only the formulas using `findseries` need an extra resolution step
+    since their dependencies are dynamic.
+    """
+    ns = tsh.namespace
+    graph = defaultdict(set)
+    if names is not None:
+        for name in names:
+            graph[name]
+
+    for name, needs in _formula_edges(cn, ns, names):
+        graph[name].add(needs)
+        graph[needs]
+
+    dynamic = dict(
+        cn.execute(
+            f'select name, internal_metadata->>\'formula\' '
+            f'from "{ns}".registry '
+            f'where internal_metadata->>\'formula\' like \'%%findseries%%\''
+        ).fetchall()
+    )
+    resolved = set()
+    while True:
+        todo = [
+            name for name in graph
+            if name in dynamic and name not in resolved
+        ]
+        if not todo:
+            break
+
+        for name in todo:
+            resolved.add(name)
+            components = list(tsh.find_series(cn, parse(dynamic[name])))
+            formulas = [
+                fname for fname, in cn.execute(
+                    f'select name from "{ns}".registry '
+                    f'where name = any(%(names)s) and '
+                    f'      internal_metadata->\'formula\' is not null',
+                    names=components
+                ).fetchall()
+            ]
+            unknown = [
+                fname for fname in formulas
+                if fname not in graph
+            ]
+            graph[name].update(formulas)
+            for fname in formulas:
+                graph[fname]
+            if unknown:
+                # complete the graph with the newly reached sub-graphs
+                for fname, needs in _formula_edges(cn, ns, unknown):
+                    graph[fname].add(needs)
+                    graph[needs]
+
+    return dict(graph)
+
+
+def topological_sort(graph):
+    """ Kahn-style linear sort of a dependency graph (mapping from node
+    to the set of nodes it needs): the needed nodes come first
+    """
+    users = defaultdict(list)
+    pending = {}
+    for node, needs in graph.items():
+        pending[node] = len(needs)
+        for need in needs:
+            users[need].append(node)
+
+    ready = deque(sorted(
+        node for node, count in pending.items()
+        if not count
+    ))
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        for user in users[node]:
+            pending[user] -= 1
+            if not pending[user]:
+                ready.append(user)
+
+    if len(order) != len(pending):
+        raise ValueError(
+            'dependency cycle among '
+            f'{sorted(node for node, count in pending.items() if count)}'
+        )
+    return order
+
+
+def dependency_levels(graph, names):
+    """ groups series in dependency levels: a series only depends
+    (possibly through formulas outside of `names`) on series of the
+    previous levels, hence the series of a given level can be handled
+    concurrently
+    """
+    names = set(names)
+    depth = {}
+    for node in topological_sort(graph):
+        depth[node] = max(
+            (
+                depth[need] + (need in names)
+                for need in graph[node]
+            ),
+            default=0
+        )
+
+    levels = defaultdict(list)
+    for name in names:
+        levels[depth.get(name, 0)].append(name)
+
+    return [
+        sorted(levels[level])
+        for level in sorted(levels)
+    ]
+
+
+def _stamps(dates):
+    """ Epoch microseconds of a list of dates (naive ones taken as utc) """
+    if len(dates) and dates[0].tzinfo is None:
+        dates = [date.replace(tzinfo=timezone.utc) for date in dates]
+    return np.rint(
+        np.array([date.timestamp() for date in dates]) * 1e6
+    ).astype('int64')
+
+
+def reduce_frequency(tempo, idates, blocksize=4096):
+    """ Keep the dates of `tempo` (an increasing, possibly lazy,
+    sequence of dates) which see at least one new insertion date since
+    the previous kept date.
 
+    The tempo is consumed by blocks, located at once in the sorted
+    insertion dates and dropped as soon as all the insertion dates
+    are covered.
+    """
     assert len(idates)
+    stamps = np.sort(_stamps(idates))
+    tempo = iter(tempo)
     new_tempo = []
-    for cdate in tempo:
-        if len([idate for idate in idates if idate <= cdate]):
-            new_tempo.append(cdate)
-            idates = [idate for idate in idates if idate > cdate]
+    covered = 0  # number of insertion dates before the last kept date
+    while covered < len(stamps):
+        block = list(islice(tempo, blocksize))
+        if not block:
+            break
+        positions = np.searchsorted(stamps, _stamps(block), side='right')
+        previous = np.concatenate(([covered], positions[:-1]))
+        new_tempo.extend(
+            block[idx]
+            for idx in np.flatnonzero(positions > previous)
+        )
+        covered = positions[-1]
 
     return new_tempo
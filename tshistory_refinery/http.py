@@ -1,16 +1,27 @@
 import json
 
+import pandas as pd
+from flask import make_response
 from flask_restx import (
     inputs,
     Resource,
     reqparse
 )
 
+from tshistory.util import (
+    pack_many_series,
+    series_metadata,
+    unpack_many_series
+)
 from tshistory.http.util import (
     onerror,
-    required_roles
+    required_roles,
+    utcdt
+)
+from tshistory.http.client import (
+    strft,
+    unwraperror
 )
-from tshistory.http.client import unwraperror
 from tshistory_xl.http_xl import (
     xl_httpapi,
     xl_httpclient
@@ -113,6 +124,62 @@ shc.add_argument(
     help='series name'
 )
 
+batch = reqparse.RequestParser()
+batch.add_argument(
+    'names',
+    type=jsonlist,
+    required=True,
+    help='list of series names'
+)
+batch.add_argument(
+    'revision_date', type=utcdt, default=None,
+    help='revision date can be forced'
+)
+batch.add_argument(
+    'from_value_date', type=utcdt, default=None
+)
+batch.add_argument(
+    'to_value_date', type=utcdt, default=None
+)
+
+refreshlog = reqparse.RequestParser()
+refreshlog.add_argument(
+    'names', type=jsonlist, default=None,
+    help='list of series names'
+)
+refreshlog.add_argument(
+    'policyname', type=str, default=None,
+    help='cache policy name'
+)
+refreshlog.add_argument(
+    'from_date', type=utcdt, default=None
+)
+refreshlog.add_argument(
+    'to_date', type=utcdt, default=None
+)
+refreshlog.add_argument(
+    'limit', type=int, default=None
+)
+
+
+refreshplan = cp.copy()
+refreshplan.add_argument(
+    'names', type=jsonlist, default=None,
+    help='list of series names'
+)
+refreshplan.add_argument(
+    'initial_revdate', type=str, default=None,
+    help='initial revision date (overrides the policy one)'
+)
+refreshplan.add_argument(
+    'revdate_rule', type=str, default=None,
+    help='cron rule for the revision date (overrides the policy one)'
+)
+refreshplan.add_argument(
+    'final_revdate', type=utcdt, default=None
+)
+
+
 
 class refinery_httpapi(xl_httpapi):
     __slots__ = 'tsa', 'bp', 'api', 'nss', 'nsg'
@@ -127,6 +194,35 @@ class refinery_httpapi(xl_httpapi):
             description='Formula Cache Operations'
         )
 
+        @self.nss.route('/batch')
+        class series_batch(Resource):
+
+            @api.expect(batch)
+            @onerror
+            @required_roles('admin', 'rw', 'ro')
+            def post(self):
+                """get many series in one go
+
+                The unknown series are omitted from the response.
+                (POST because of the size of the names list.)
+                """
+                args = batch.parse_args()
+                series = tsa.get_batch(
+                    args.names,
+                    revision_date=args.revision_date,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date
+                )
+                response = make_response(
+                    pack_many_series([
+                        (series_metadata(ts), ts)
+                        for ts in series.values()
+                        if ts is not None
+                    ])
+                )
+                response.headers['Content-Type'] = 'application/octet-stream'
+                return response
+
         @nsc.route('/policy')
         class cache_policy(Resource):
 
@@ -262,6 +358,48 @@ class refinery_httpapi(xl_httpapi):
                 tsa.delete_cache(args.name)
                 return '', 204
 
+        @nsc.route('/refresh-log')
+        class cache_refresh_log(Resource):
+
+            @api.expect(refreshlog)
+            @onerror
+            @required_roles('admin', 'rw', 'ro')
+            def get(self):
+                args = refreshlog.parse_args()
+                log = tsa.cache_refresh_log(
+                    names=args.names,
+                    policyname=args.policyname,
+                    from_date=args.from_date,
+                    to_date=args.to_date,
+                    limit=args.limit
+                )
+                for entry in log:
+                    entry['started'] = entry['started'].isoformat()
+                return log
+
+        @nsc.route('/refresh-plan')
+        class cache_refresh_plan(Resource):
+
+            @api.expect(refreshplan)
+            @onerror
+            @required_roles('admin', 'rw', 'ro')
+            def get(self):
+                args = refreshplan.parse_args()
+                try:
+                    plan = tsa.cache_refresh_plan(
+                        args.name,
+                        names=args.names,
+                        initial_revdate=args.initial_revdate,
+                        revdate_rule=args.revdate_rule,
+                        final_revdate=args.final_revdate
+                    )
+                except ValueError as err:
+                    api.abort(409, str(err))
+                for step in plan:
+                    step['from'] = step['from'].isoformat()
+                    step['to'] = step['to'].isoformat()
+                return plan
+
         @nsc.route('/refresh-policy-now')
         class refresh_policy_now(Resource):
 
@@ -280,6 +418,28 @@ class refinery_httpclient(xl_httpclient):
     def __repr__(self):
         return f"refinery-http-client(uri='{self.uri}')"
 
+    @unwraperror
+    def get_batch(self, names,
+                  revision_date=None,
+                  from_value_date=None,
+                  to_value_date=None):
+        query = {
+            'names': json.dumps(names),
+            'revision_date': strft(revision_date) if revision_date else None,
+            'from_value_date': strft(from_value_date) if from_value_date else None,
+            'to_value_date': strft(to_value_date) if to_value_date else None
+        }
+        res = self.session.post(f'{self.uri}/series/batch', data=query)
+        if res.status_code == 200:
+            series = {name: None for name in names}
+            series.update(
+                (ts.name, ts)
+                for ts in unpack_many_series(res.content)
+            )
+            return series
+
+        return res
+
     @unwraperror
     def new_cache_policy(
             self,
@@ -433,3 +593,46 @@ class refinery_httpclient(xl_httpclient):
             return res.json()
 
         return res
+
+    @unwraperror
+    def cache_refresh_log(self, names=None, policyname=None,
+                          from_date=None, to_date=None, limit=None):
+        query = {
+            'names': json.dumps(names) if names is not None else None,
+            'policyname': policyname,
+            'from_date': strft(from_date) if from_date else None,
+            'to_date': strft(to_date) if to_date else None,
+            'limit': limit
+        }
+        res = self.session.get(f'{self.uri}/cache/refresh-log', params=query)
+        if res.status_code == 200:
+            log = res.json()
+            for entry in log:
+                entry['started'] = pd.Timestamp(entry['started'])
+            return log
+
+        return res
+
+    @unwraperror
+    def cache_refresh_plan(self, policyname, names=None,
+                           initial_revdate=None, revdate_rule=None,
+                           final_revdate=None):
+        query = {
+            'name': policyname,
+            'names': json.dumps(names) if names is not None else None,
+            'initial_revdate': initial_revdate,
+            'revdate_rule': revdate_rule,
+            'final_revdate': strft(final_revdate) if final_revdate else None
+        }
+        res = self.session.get(f'{self.uri}/cache/refresh-plan', params=query)
+        if res.status_code == 409:
+            raise ValueError(res.json()['message'])
+
+        if res.status_code == 200:
+            plan = res.json()
+            for step in plan:
+                step['from'] = pd.Timestamp(step['from'])
+                step['to'] = pd.Timestamp(step['to'])
+            return plan
+
+        return res
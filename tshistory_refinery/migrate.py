@@ -19,6 +19,144 @@ class Migrator(_Migrator):
         fix_user_metadata(self.engine, f'{self.namespace}-cache', self.interactive)
 
 
+@version('tshistory-refinery', '0.10.0')
+def migrate_cache_refresh_tables(engine, namespace, interactive):
+    migrate_refresh_checkpoint(engine, namespace)
+    migrate_cache_summary(engine, namespace)
+    migrate_cache_head(engine, namespace)
+    migrate_cache_dirty(engine, namespace)
+    migrate_cache_refresh_log(engine, namespace)
+    migrate_cache_refresh_failure(engine, namespace)
+
+
+def migrate_refresh_checkpoint(engine, namespace):
+    sql = (
+        f'create table if not exists "{namespace}".cache_refresh_checkpoint ('
+        f'  series_id int unique not null '
+        f'    references "{namespace}-cache".registry on delete cascade,'
+        f'  revdate timestamptz not null,'
+        f'  watermark timestamptz,'
+        f'  stale_after timestamptz'
+        f')'
+    )
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
+def migrate_cache_summary(engine, namespace):
+    from tshistory_refinery.tsio import cachets
+
+    sql = (
+        f'create table if not exists "{namespace}-cache".summary ('
+        f'  series_id int unique not null '
+        f'    references "{namespace}-cache".registry on delete cascade,'
+        f'  first_idate timestamptz not null,'
+        f'  last_idate timestamptz not null,'
+        f'  revisions int not null,'
+        f'  freq interval,'
+        f'  tzaware bool not null,'
+        f'  tsstart timestamp,'
+        f'  tsend timestamp,'
+        f'  head bool not null default false,'
+        f'  outdated bool not null default false'
+        f')'
+    )
+    tsh = cachets(namespace=f'{namespace}-cache')
+    with engine.begin() as cn:
+        cn.execute(sql)
+        names = [
+            name for name, in cn.execute(
+                f'select name from "{namespace}-cache".registry'
+            ).fetchall()
+        ]
+        print(f'building the summary of {len(names)} caches')
+        for name in names:
+            tsh._update_summary(cn, name)
+
+
+def migrate_cache_head(engine, namespace):
+    sql = (
+        f'create table if not exists "{namespace}-cache".head ('
+        f'  series_id int not null '
+        f'    references "{namespace}-cache".registry on delete cascade,'
+        f'  value_date timestamp not null,'
+        f'  value double precision not null,'
+        f'  primary key (series_id, value_date)'
+        f')'
+    )
+    # the heads are built on the next write of each cache
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
+def migrate_cache_dirty(engine, namespace):
+    sql = (
+        f'create table if not exists "{namespace}".cache_input ('
+        f'  series_id int not null '
+        f'    references "{namespace}".registry on delete cascade,'
+        f'  input_id int not null '
+        f'    references "{namespace}".registry on delete cascade,'
+        f'  primary key (series_id, input_id)'
+        f');'
+        f'create index if not exists cache_input_input_id_idx '
+        f'on "{namespace}".cache_input (input_id);'
+        f'create table if not exists "{namespace}".cache_dirty ('
+        f'  series_id int primary key '
+        f'    references "{namespace}".registry on delete cascade,'
+        f'  dirty_since timestamptz not null default \'-infinity\''
+        f')'
+    )
+    # the inputs are unknown until the next refresh
+    dirty = (
+        f'insert into "{namespace}".cache_dirty (series_id) '
+        f'select series_id from "{namespace}".cache_policy_series '
+        f'on conflict do nothing'
+    )
+    with engine.begin() as cn:
+        cn.execute(sql)
+        cn.execute(dirty)
+
+
+def migrate_cache_refresh_log(engine, namespace):
+    sql = (
+        f'create table if not exists "{namespace}".cache_refresh_log ('
+        f'  id serial primary key,'
+        f'  series_id int not null '
+        f'    references "{namespace}".registry on delete cascade,'
+        f'  started timestamptz not null,'
+        f'  wall_time double precision not null,'
+        f'  idates_time double precision not null,'
+        f'  eval_time double precision not null,'
+        f'  write_time double precision not null,'
+        f'  revisions int not null,'
+        f'  points int not null,'
+        f'  outcome text not null,'
+        f'  error text'
+        f');'
+        f'create index if not exists cache_refresh_log_series_id_started_idx '
+        f'on "{namespace}".cache_refresh_log (series_id, started);'
+        f'create index if not exists cache_refresh_log_started_idx '
+        f'on "{namespace}".cache_refresh_log (started)'
+    )
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
+def migrate_cache_refresh_failure(engine, namespace):
+    sql = (
+        f'create table if not exists "{namespace}".cache_refresh_failure ('
+        f'  series_id int primary key '
+        f'    references "{namespace}".registry on delete cascade,'
+        f'  failures int not null,'
+        f'  last_failure timestamptz not null,'
+        f'  retry_after timestamptz not null,'
+        f'  error text'
+        f')'
+    )
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
 @version('tshistory-refinery', '0.9.1')
 def migrate_drop_ready(engine, namespace, interactive):
     sql = (
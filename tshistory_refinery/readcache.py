@@ -0,0 +1,135 @@
+from collections import (
+    defaultdict,
+    OrderedDict
+)
+import select
+import threading
+import time
+import traceback
+
+
+class readcache:
+    """ A bounded (in number of items and bytes) in-process LRU cache
+    of the cached formula reads.
+
+    The entries of a series are dropped when a cache write is notified
+    on the postgres channel of the cache namespace (see
+    `cachets._notify_write`). Nothing is cached while the listening
+    connection is not established.
+    """
+
+    def __init__(self, engine, namespace, maxitems=1000, maxbytes=2 ** 28):
+        self.engine = engine
+        self.channel = f'{namespace}-writes'
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self.items = OrderedDict()
+        self.keys = defaultdict(set)
+        self.generation = defaultdict(int)
+        self.epoch = 0
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+        self.listener = threading.Thread(
+            target=self._listen,
+            name=f'readcache-{namespace}',
+            daemon=True
+        )
+        self.listener.start()
+
+    def get(self, name, kw, read):
+        """ Return the `read()` result for the series `name` read with
+        the `kw` query arguments, possibly from memory """
+        try:
+            key = (name, tuple(sorted(kw.items())))
+            hash(key)
+        except TypeError:
+            return read()
+
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+                return entry[0].copy()
+            generation = self.epoch, self.generation[name]
+
+        ts = read()
+        size = int(ts.memory_usage(index=True, deep=True))
+        with self.lock:
+            # a write may have happened while we were reading
+            if (self.listening.is_set() and
+                generation == (self.epoch, self.generation[name]) and
+                size <= self.maxbytes):
+                self._put(key, ts.copy(), size)
+        return ts
+
+    def _put(self, key, ts, size):
+        if key in self.items:
+            self._drop(key)
+        self.items[key] = ts, size
+        self.keys[key[0]].add(key)
+        self.nbytes += size
+        while (len(self.items) > self.maxitems or
+               self.nbytes > self.maxbytes):
+            self._drop(next(iter(self.items)))
+
+    def _drop(self, key):
+        _, size = self.items.pop(key)
+        self.nbytes -= size
+        names = self.keys[key[0]]
+        names.discard(key)
+        if not names:
+            del self.keys[key[0]]
+
+    def invalidate(self, name=None):
+        """ Forget the reads of a series (or all of them) """
+        with self.lock:
+            if name is None:
+                self.epoch += 1
+                self.items.clear()
+                self.keys.clear()
+                self.nbytes = 0
+                return
+            self.generation[name] += 1
+            for key in list(self.keys.get(name, ())):
+                self._drop(key)
+
+    def stop(self):
+        self.stopped.set()
+        self.listener.join()
+
+    # notifications
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            try:
+                self._listen_once()
+            except Exception:
+                traceback.print_exc()
+            # we may have missed some notifications
+            self.listening.clear()
+            self.invalidate()
+            if not self.stopped.is_set():
+                time.sleep(1)
+
+    def _listen_once(self):
+        # a dedicated connection, out of the pool
+        fairy = self.engine.raw_connection()
+        fairy.detach()
+        cn = fairy.connection
+        try:
+            cn.autocommit = True
+            with cn.cursor() as cursor:
+                cursor.execute(f'listen "{self.channel}"')
+            self.listening.set()
+            while not self.stopped.is_set():
+                if select.select([cn], [], [], .5) == ([], [], []):
+                    continue
+                cn.poll()
+                while cn.notifies:
+                    notification = cn.notifies.pop(0)
+                    self.invalidate(notification.payload)
+        finally:
+            self.listening.clear()
+            cn.close()
@@ -25,7 +25,8 @@ class refinery_schema(supervision_schema, formula_schema):
         for store_ns in ('dashboards', 'balances'):
             stores_schema.init(engine, ns=store_ns, drop=reset)
 
+        # the cache policy tables refer to the cache registry
+        tsschema(f'{self.namespace}-cache').create(engine)
+
         with engine.begin() as cn:
             cn.execute(sqlfile(CACHE_POLICY, ns=self.namespace))
-
-        tsschema(f'{self.namespace}-cache').create(engine)
@@ -35,3 +35,94 @@ create table "{ns}".cache_policy_series (
 
 create index on "{ns}".cache_policy_series (cache_policy_id);
 create index on "{ns}".cache_policy_series (series_id);
+
+
+-- primary series read by the cached formulas
+-- (only for formulas with no other source of change)
+
+create table "{ns}".cache_input (
+  series_id int not null references "{ns}".registry on delete cascade,
+  input_id int not null references "{ns}".registry on delete cascade,
+  primary key (series_id, input_id)
+);
+
+create index on "{ns}".cache_input (input_id);
+
+
+-- cached formulas needing a refresh
+
+create table "{ns}".cache_dirty (
+  series_id int primary key references "{ns}".registry on delete cascade,
+  -- insertion date of the latest upstream write
+  dirty_since timestamptz not null default '-infinity'
+);
+
+
+create table "{ns}".cache_refresh_checkpoint (
+  series_id int unique not null references "{ns}-cache".registry on delete cascade,
+  revdate timestamptz not null,
+  watermark timestamptz,
+  stale_after timestamptz
+);
+
+
+-- series whose refresh fails, retried after an exponential backoff
+
+create table "{ns}".cache_refresh_failure (
+  series_id int primary key references "{ns}".registry on delete cascade,
+  failures int not null,
+  last_failure timestamptz not null,
+  retry_after timestamptz not null,
+  error text
+);
+
+
+-- one row per series refresh, timings in seconds
+
+create table "{ns}".cache_refresh_log (
+  id serial primary key,
+  series_id int not null references "{ns}".registry on delete cascade,
+  started timestamptz not null,
+  wall_time double precision not null,
+  idates_time double precision not null,
+  eval_time double precision not null,
+  write_time double precision not null,
+  revisions int not null,
+  points int not null,
+  -- done, nothing, skipped or failed
+  outcome text not null,
+  error text
+);
+
+create index on "{ns}".cache_refresh_log (series_id, started);
+create index on "{ns}".cache_refresh_log (started);
+
+
+-- cache series summary, maintained on cache writes
+
+create table "{ns}-cache".summary (
+  series_id int unique not null references "{ns}-cache".registry on delete cascade,
+  first_idate timestamptz not null,
+  last_idate timestamptz not null,
+  revisions int not null,
+  -- inferred from the latest insertion dates
+  freq interval,
+  tzaware bool not null,
+  -- value interval of the last revision
+  tsstart timestamp,
+  tsend timestamp,
+  -- the latest revision is materialized in the head table
+  head bool not null default false,
+  -- computed from an obsolete formula, a rebuild is pending
+  outdated bool not null default false
+);
+
+
+-- latest revision of the cache series, one row per point
+
+create table "{ns}-cache".head (
+  series_id int not null references "{ns}-cache".registry on delete cascade,
+  value_date timestamp not null,
+  value double precision not null,
+  primary key (series_id, value_date)
+);
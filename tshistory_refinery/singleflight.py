@@ -0,0 +1,46 @@
+from concurrent.futures import Future
+import threading
+
+
+class singleflight:
+    """ Share one in-flight computation between the concurrent callers
+    asking for the same key (within a process).
+
+    The first caller computes, the others wait for its result (or
+    exception). Nothing is kept once the computation is over.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        """ Return `func()`, or the result of the identical call in
+        flight, with a flag telling if it was shared """
+        try:
+            hash(key)
+        except TypeError:
+            return func(), False
+
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                shared = True
+            else:
+                shared = False
+                call = self.calls[key] = Future()
+
+        if shared:
+            return call.result(), True
+
+        try:
+            result = func()
+        except BaseException as err:
+            call.set_exception(err)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result, False
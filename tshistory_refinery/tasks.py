@@ -1,5 +1,6 @@
 import json
 
+import pandas as pd
 from rework.api import task
 import rework.io as rio
 
@@ -17,14 +18,94 @@ from tshistory_refinery import (
     domain='timeseries',
     inputs=(
         rio.string('policy', required=True),
+        rio.number('workers', default=1),
+        rio.string(
+            'pool',
+            choices=('thread', 'process', 'rework'),
+            default='thread'
+        ),
+        rio.boolean('incremental'),
+        rio.boolean('full'),
+        rio.boolean('cooperative')
     )
 )
 def refresh_formula_cache(task):
     tsa = timeseries()
-    policy = task.input['policy']
+    inputs = task.input
+    policy = inputs['policy']
+
+    with task.capturelogs(std=True):
+        if inputs.get('cooperative'):
+            # several such tasks can drain the same policy
+            cache.refresh_policy_cooperative(
+                tsa,
+                policy,
+                incremental=bool(inputs.get('incremental')),
+                dirty_only=not inputs.get('full')
+            )
+            return
+
+        cache.refresh_policy(
+            tsa,
+            policy,
+            workers=int(inputs.get('workers') or 1),
+            pool=inputs.get('pool') or 'thread',
+            incremental=bool(inputs.get('incremental')),
+            # the scheduled refreshes skip the series whose
+            # inputs have not been written since the last refresh
+            dirty_only=not inputs.get('full')
+        )
+
+
+@task(
+    domain='timeseries',
+    inputs=(
+        rio.string('name', required=True),
+        rio.datetime('final_revdate'),
+        rio.boolean('checkhash'),
+        rio.boolean('incremental')
+    )
+)
+def refresh_formula_cache_series(task):
+    # one series of a policy refresh (see `cache.level_runner`)
+    tsa = timeseries()
+    inputs = task.input
+    final_revdate = inputs.get('final_revdate')
 
     with task.capturelogs(std=True):
-        cache.refresh_policy(tsa, policy)
+        ok = cache._refresh_series_safely(
+            tsa,
+            inputs['name'],
+            final_revdate and pd.Timestamp(final_revdate),
+            bool(inputs.get('checkhash')),
+            bool(inputs.get('incremental'))
+        )
+        if ok is None:
+            # waiting for its retry (see `cache.level_runner`)
+            task.save_output('skipped')
+        elif not ok:
+            raise Exception(f'failed series on refresh: {inputs["name"]}')
+
+
+@task(
+    domain='timeseries',
+    inputs=(
+        rio.string('policy', required=True),
+        rio.number('debounce', default=5),
+        rio.number('window', default=60)
+    )
+)
+def listen_formula_cache(task):
+    tsa = timeseries()
+    inputs = task.input
+
+    with task.capturelogs(std=True):
+        cache.refresh_listener(
+            tsa,
+            inputs['policy'],
+            debounce=float(inputs.get('debounce') or 5),
+            window=float(inputs.get('window') or 60)
+        ).run()
 
 
 @task(
@@ -1,34 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
+from sqlalchemy.engine import Engine
 from sqlhelp import select
 
+from tshistory.storage import Postgres
 from tshistory.util import (
     compatible_date,
+    diff,
+    empty_series,
+    guard_insert,
     patch,
+    start_end,
     tx
 )
 from tshistory.tsio import timeseries as basets
 from tshistory_xl.tsio import timeseries as xlts
 
 from tshistory_refinery import cache
+from tshistory_refinery.readcache import readcache
+from tshistory_refinery.singleflight import singleflight
 from tshistory_refinery import api  # trigger registration  # noqa: F401
 
 
 class name_stopper:
-    __slots__ = 'cn', 'tsh', 'names'
+    """ Stop the formula expansion at the cached formulas
+
+    The names of the cached formulas are fetched once (at the first
+    lookup) rather than for each checked name.
+    """
+    __slots__ = 'cn', 'tsh', 'names', 'cached'
 
     def __init__(self, cn, tsh, stopnames=()):
         self.cn = cn
         self.tsh = tsh
         self.names = stopnames
+        self.cached = None
+
+    def cached_formulas(self):
+        if self.cached is None:
+            ns = self.tsh.namespace
+            self.cached = {
+                name for name, in self.cn.execute(
+                    f'select f.name '
+                    f'from "{ns}".registry as f '
+                    f'join "{ns}-cache".registry as c on c.name = f.name '
+                    f'where f.internal_metadata->\'formula\' is not null'
+                ).fetchall()
+            }
+        return self.cached
 
     def __contains__(self, name):
         if name in self.names:
             return True
-        tsh = self.tsh
-        if tsh.type(self.cn, name) == 'formula':
-            if tsh.cache.exists(self.cn, name):
-                return True
-        return False
+        return name in self.cached_formulas()
 
 
 def utcnow():
@@ -45,20 +71,582 @@ def infer_freq(idates):
     return freq, conform_intervals / len(deltas)
 
 
+class chainedstorage(Postgres):
+    """ A snapshot storage for a single writer chaining several
+    updates: the head chunk is tracked in memory rather than read back
+    from the revision table each time """
+    __slots__ = ('head',)
+
+    def update(self, series_diff):
+        diffstart = series_diff.index.min()
+        rawchunks = self.rawchunks(self.head, diffstart)
+        cid, parent, _ = rawchunks[0]
+        oldsnapshot = self._chunks_to_ts(row[2] for row in rawchunks)
+
+        if diffstart > oldsnapshot.index.max():
+            newsnapshot = series_diff
+            parent = cid
+        else:
+            newsnapshot = patch(oldsnapshot, series_diff)
+
+        self.head = self.insert_buckets(parent, newsnapshot)
+        return self.head
+
+
+# number of latest insertion dates used to infer the cache frequency
+SUMMARY_FREQ_TAIL = 64
+
+
+class cachets(basets):
+    """ The storage of the formula caches
+
+    A summary row per series (see `summary`) is maintained on every
+    write.
+
+    The latest revision of the numeric series is also materialized as
+    one row per point (the "head"), patched with the diff of every
+    write: latest revision reads do not walk the snapshot chunks.
+    """
+
+    @tx
+    def summary(self, cn, name):
+        """ Return a dict with the first/last insertion dates, the
+        number of revisions, inferred insertion frequency, tzaware flag,
+        value interval and outdated flag of a cache series (or None if
+        the cache does not exist) """
+        tablename = self._series_to_tablename(cn, name)
+        if tablename is None:
+            return
+
+        sql = (
+            f'select s.first_idate, s.last_idate, s.revisions, s.freq, '
+            f'       s.tzaware, s.tsstart, s.tsend, s.outdated '
+            f'from "{self.namespace}".summary as s, '
+            f'     "{self.namespace}".registry as r '
+            f'where r.name = %(name)s and '
+            f'      s.series_id = r.id'
+        )
+        row = cn.execute(sql, name=name).fetchone()
+        if row is None:
+            # not built yet: computed (the reads do not write, the row
+            # comes with the migration or the next write)
+            row = self._build_summary(cn, name)
+            if row is None:
+                return
+        else:
+            row = dict(row)
+
+        tz = 'UTC' if row['tzaware'] else None
+        return {
+            'first_idate': pd.Timestamp(row['first_idate']).tz_convert('UTC'),
+            'last_idate': pd.Timestamp(row['last_idate']).tz_convert('UTC'),
+            'revisions': row['revisions'],
+            'freq': None if row['freq'] is None else pd.Timedelta(row['freq']),
+            'tzaware': row['tzaware'],
+            'interval': pd.Interval(
+                left=pd.Timestamp(row['tsstart'], tz=tz),
+                right=pd.Timestamp(row['tsend'], tz=tz),
+                closed='both'
+            ),
+            'outdated': row['outdated']
+        }
+
+    @tx
+    def set_outdated(self, cn, name):
+        """ Flag a cache as computed from an obsolete formula """
+        if not self.exists(cn, name):
+            return
+        if self._head_state(cn, name) is None:
+            # not built yet
+            self._update_summary(cn, name)
+        cn.execute(
+            f'update "{self.namespace}".summary as s '
+            f'set outdated = true '
+            f'from "{self.namespace}".registry as r '
+            f'where r.name = %(name)s and '
+            f'      s.series_id = r.id',
+            name=name
+        )
+        self._notify_write(cn, name)
+
+    def _summary_tail(self, cn, tablename):
+        """ Return the last insertion date and inferred insertion
+        frequency of a revision table (or None if empty) """
+        tail = [
+            pd.Timestamp(idate)
+            for idate, in cn.execute(
+                f'select insertion_date '
+                f'from "{self.namespace}.revision"."{tablename}" '
+                f'order by id desc limit {SUMMARY_FREQ_TAIL}'
+            ).fetchall()
+        ]
+        if not tail:
+            return
+        tail.reverse()
+        freq = None
+        if len(tail) > 1:
+            freq, _ = infer_freq(tail)
+            freq = freq.to_pytimedelta()
+        return tail[-1], freq
+
+    def _build_summary(self, cn, name):
+        """ Compute the summary row of a series from its revision table
+        (or None if it has no revision) """
+        tablename = self._series_to_tablename(cn, name)
+        tail = self._summary_tail(cn, tablename)
+        if tail is None:
+            return
+        last, freq = tail
+        rev = cn.execute(
+            f'select min(insertion_date) as first, count(*) as revisions, '
+            f'       (select tsstart '
+            f'        from "{self.namespace}.revision"."{tablename}" '
+            f'        order by id desc limit 1) as tsstart, '
+            f'       (select tsend '
+            f'        from "{self.namespace}.revision"."{tablename}" '
+            f'        order by id desc limit 1) as tsend '
+            f'from "{self.namespace}.revision"."{tablename}"'
+        ).fetchone()
+        return {
+            'first_idate': rev.first,
+            'last_idate': last,
+            'revisions': rev.revisions,
+            'freq': freq,
+            'tzaware': self.tzaware(cn, name),
+            'tsstart': rev.tsstart,
+            'tsend': rev.tsend,
+            'outdated': False
+        }
+
+    def _update_summary(self, cn, name, revisions=None):
+        """ Maintain the summary row of a series after the write of
+        `revisions` new revisions (or rebuild it when None) """
+        if revisions is not None:
+            tablename = self._series_to_tablename(cn, name)
+            tail = self._summary_tail(cn, tablename)
+            if tail is None:
+                return
+            last, freq = tail
+            updated = cn.execute(
+                f'update "{self.namespace}".summary as s '
+                f'set last_idate = %(last)s, '
+                f'    revisions = s.revisions + %(revisions)s, '
+                f'    freq = %(freq)s, '
+                f'    tsstart = rev.tsstart, '
+                f'    tsend = rev.tsend '
+                f'from "{self.namespace}".registry as r, '
+                f'     (select tsstart, tsend '
+                f'      from "{self.namespace}.revision"."{tablename}" '
+                f'      order by id desc limit 1) as rev '
+                f'where r.name = %(name)s and '
+                f'      s.series_id = r.id '
+                f'returning s.series_id',
+                name=name,
+                last=last,
+                revisions=revisions,
+                freq=freq
+            ).scalar()
+            if updated is not None:
+                return
+
+        summary = self._build_summary(cn, name)
+        if summary is None:
+            return
+        # the flag survives the rebuilds
+        summary.pop('outdated')
+        cn.execute(
+            f'insert into "{self.namespace}".summary '
+            f'(series_id, first_idate, last_idate, revisions, freq, '
+            f' tzaware, tsstart, tsend) '
+            f'select r.id, %(first_idate)s, %(last_idate)s, %(revisions)s, '
+            f'       %(freq)s, %(tzaware)s, %(tsstart)s, %(tsend)s '
+            f'from "{self.namespace}".registry as r '
+            f'where r.name = %(name)s '
+            f'on conflict (series_id) do update set '
+            f'  first_idate = excluded.first_idate, '
+            f'  last_idate = excluded.last_idate, '
+            f'  revisions = excluded.revisions, '
+            f'  freq = excluded.freq, '
+            f'  tzaware = excluded.tzaware, '
+            f'  tsstart = excluded.tsstart, '
+            f'  tsend = excluded.tsend',
+            name=name,
+            **summary
+        )
+
+    def _head_state(self, cn, name):
+        return cn.execute(
+            f'select s.series_id, s.head, s.tzaware '
+            f'from "{self.namespace}".summary as s, '
+            f'     "{self.namespace}".registry as r '
+            f'where r.name = %(name)s and '
+            f'      s.series_id = r.id',
+            name=name
+        ).fetchone()
+
+    @staticmethod
+    def _head_stamps(index):
+        if index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        return index.to_pydatetime().tolist()
+
+    def _write_head(self, cn, name, series_diff):
+        """ Patch the head of a series with a diff (nans are erasures)
+        or build it if needed """
+        state = self._head_state(cn, name)
+        if state is None:
+            return
+        if not state.head:
+            self._build_head(cn, name, state.series_id)
+            return
+
+        erased = series_diff.isnull()
+        if erased.any():
+            cn.execute(
+                f'delete from "{self.namespace}".head '
+                f'where series_id = %(sid)s and '
+                f'      value_date = any(%(dates)s::timestamp[])',
+                sid=state.series_id,
+                dates=self._head_stamps(series_diff.index[erased])
+            )
+        self._insert_head(cn, state.series_id, series_diff[~erased])
+
+    def _insert_head(self, cn, sid, ts):
+        if not len(ts):
+            return
+        cn.execute(
+            f'insert into "{self.namespace}".head '
+            f'(series_id, value_date, value) '
+            f'select %(sid)s, t.value_date, t.value '
+            f'from unnest(%(dates)s::timestamp[], %(values)s::float8[]) '
+            f'     as t(value_date, value) '
+            f'on conflict (series_id, value_date) do update '
+            f'set value = excluded.value',
+            sid=sid,
+            dates=self._head_stamps(ts.index),
+            values=ts.values.astype('float64').tolist()
+        )
+
+    def _build_head(self, cn, name, sid):
+        cn.execute(
+            f'delete from "{self.namespace}".head '
+            f'where series_id = %(sid)s',
+            sid=sid
+        )
+        if self.internal_metadata(cn, name)['value_type'] != 'float64':
+            # only the numeric series have a materialized head
+            return
+        self._insert_head(cn, sid, super().get(cn, name))
+        cn.execute(
+            f'update "{self.namespace}".summary '
+            f'set head = true '
+            f'where series_id = %(sid)s',
+            sid=sid
+        )
+
+    def _read_head(self, cn, name, from_value_date, to_value_date):
+        """ Return the latest revision of a series from its head (or
+        None if it is not materialized) """
+        state = self._head_state(cn, name)
+        if state is None or not state.head:
+            return
+
+        return self.read_heads(
+            cn,
+            [(state.series_id, name, state.tzaware)],
+            from_value_date,
+            to_value_date
+        )[name]
+
+    def read_heads(self, cn, series, from_value_date, to_value_date):
+        """ Return a dict of the latest revisions, read from the heads,
+        of a list of (series id, name, tzaware) materialized series """
+        out = {}
+        for tzaware in (False, True):
+            group = {
+                sid: name
+                for sid, name, aware in series
+                if aware == tzaware
+            }
+            if not group:
+                continue
+
+            sql = (
+                f'select series_id, value_date, value '
+                f'from "{self.namespace}".head '
+                f'where series_id = any(%(sids)s)'
+            )
+            bounds = {}
+            for op, key, date in (('>=', 'fvd', from_value_date),
+                                  ('<=', 'tvd', to_value_date)):
+                if date is None:
+                    continue
+                date = pd.Timestamp(compatible_date(tzaware, date))
+                if tzaware:
+                    date = date.tz_convert('UTC').tz_localize(None)
+                sql += f' and value_date {op} %({key})s'
+                bounds[key] = date
+            rows = cn.execute(
+                sql + ' order by series_id, value_date',
+                sids=list(group),
+                **bounds
+            ).fetchall()
+
+            for name in group.values():
+                out[name] = empty_series(tzaware, name=name)
+            if not rows:
+                continue
+
+            sids, dates, values = zip(*rows)
+            sids = np.array(sids)
+            index = pd.DatetimeIndex(dates)
+            if tzaware:
+                index = index.tz_localize('UTC')
+            values = np.array(values, dtype='float64')
+            # the rows come ordered by series
+            bounds = np.flatnonzero(np.diff(sids)) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [len(sids)]))
+            for start, end in zip(starts, ends):
+                name = group[sids[start]]
+                out[name] = pd.Series(
+                    values[start:end],
+                    index=index[start:end],
+                    name=name
+                )
+        return out
+
+    @tx
+    def get(self, cn, name, revision_date=None,
+            from_value_date=None, to_value_date=None,
+            _keep_nans=False, **kw):
+        if revision_date is None and not _keep_nans:
+            ts = self._read_head(cn, name, from_value_date, to_value_date)
+            if ts is not None:
+                return ts
+        return super().get(
+            cn, name,
+            revision_date=revision_date,
+            from_value_date=from_value_date,
+            to_value_date=to_value_date,
+            _keep_nans=_keep_nans,
+            **kw
+        )
+
+    def _create(self, cn, newts, name, *a, **kw):
+        created = super()._create(cn, newts, name, *a, **kw)
+        if created is not None:
+            self._write_head(cn, name, created)
+        return created
+
+    def _update(self, cn, newts, name, *a, **kw):
+        series_diff = super()._update(cn, newts, name, *a, **kw)
+        if len(series_diff):
+            self._write_head(cn, name, series_diff)
+        return series_diff
+
+    def _notify_write(self, cn, name):
+        # the in-process read caches listen to this (see readcache)
+        cn.execute(
+            'select pg_notify(%(channel)s, %(name)s)',
+            channel=f'{self.namespace}-writes',
+            name=name
+        )
+
+    def _flag_dependents(self, cn, name, insertion_date=None):
+        # the cached formulas computed from this cache must see the
+        # new revision (see `cache.mark_dependents_dirty`)
+        cache.mark_dependents_dirty(
+            cn, name, insertion_date,
+            namespace=self.namespace[:-len('-cache')]
+        )
+
+    def _new_revision(self, cn, name, head, tsstart, tsend,
+                      diffstart, diffend,
+                      author, insertion_date, metadata):
+        super()._new_revision(
+            cn, name, head, tsstart, tsend, diffstart, diffend,
+            author, insertion_date, metadata
+        )
+        self._update_summary(cn, name, 1)
+        self._notify_write(cn, name)
+        self._flag_dependents(cn, name, insertion_date)
+
+    @tx
+    def replace(self, cn, newts, name, author, **kw):
+        replaced = super().replace(cn, newts, name, author, **kw)
+        state = self._head_state(cn, name)
+        if state is not None:
+            self._build_head(cn, name, state.series_id)
+        return replaced
+
+    @tx
+    def strip(self, cn, name, csid):
+        super().strip(cn, name, csid)
+        self._update_summary(cn, name)
+        state = self._head_state(cn, name)
+        if state is not None:
+            self._build_head(cn, name, state.series_id)
+        self._notify_write(cn, name)
+
+    @tx
+    def delete(self, cn, name):
+        super().delete(cn, name)
+        self._notify_write(cn, name)
+
+    @tx
+    def update_many(self, cn, name, revisions, author):
+        """ Write an ordered batch of (insertion_date, series) update
+        revisions of a series in one pass.
+
+        The current state of the series is read once and maintained in
+        memory, the snapshot chunks are chained without reading back
+        the revision table and all the revision rows are inserted with
+        a single statement.
+
+        Returns the number of written revisions.
+        """
+        revisions = [
+            (idate, guard_insert(ts, name, author, None, idate).dropna())
+            for idate, ts in revisions
+        ]
+        revisions = [
+            (idate, ts) for idate, ts in revisions
+            if len(ts)
+        ]
+        if not revisions:
+            return 0
+
+        written = 0
+        if not self.exists(cn, name):
+            idate, ts = revisions.pop(0)
+            self.update(cn, ts, name, author, insertion_date=idate)
+            written += 1
+            if not revisions:
+                return written
+
+        tablename = self._series_to_tablename(cn, name)
+        storage = chainedstorage(cn, self, name)
+        storage.head = cn.execute(
+            f'select snapshot '
+            f'from "{self.namespace}.revision"."{tablename}" '
+            f'order by id desc limit 1'
+        ).scalar()
+        current = storage.chunk(
+            storage.head,
+            min(ts.index[0] for _, ts in revisions),
+            max(ts.index[-1] for _, ts in revisions)
+        )
+        ival = self.interval(cn, name, notz=True)
+        start, end = ival.left, ival.right
+        latest_idate = self.latest_insertion_date(cn, name)
+
+        rows = []
+        diffs = []
+        for idate, ts in revisions:
+            assert idate.tzinfo is not None, (
+                f'for "{name}", the specified revision date '
+                f'"{idate}" must be tzaware'
+            )
+            idate = pd.Timestamp(idate)
+            assert idate > latest_idate, (
+                f'"{name}" already has a newer revision than "{idate}"'
+            )
+            self._validate(cn, ts, name)
+            ts.name = name
+
+            series_diff = diff(current, ts)
+            if not len(series_diff):
+                continue
+            current = patch(current, series_diff)
+            diffs.append(series_diff)
+
+            tsstart, tsend = start_end(series_diff)
+            start = min(tsstart, start)
+            end = max(tsend, end)
+            rows.append({
+                'snapshot': storage.update(series_diff),
+                'tsstart': start,
+                'tsend': end,
+                'diffstart': series_diff.index[0],
+                'diffend': series_diff.index[-1],
+                'author': author,
+                'insertion_date': idate
+            })
+            latest_idate = idate
+
+        if not rows:
+            return written
+
+        columns = list(rows[0])
+        values = []
+        params = {}
+        for idx, row in enumerate(rows):
+            values.append(
+                '(' + ', '.join(f'%({col}_{idx})s' for col in columns) + ')'
+            )
+            params.update({
+                f'{col}_{idx}': value
+                for col, value in row.items()
+            })
+        cn.execute(
+            f'insert into "{self.namespace}.revision"."{tablename}" '
+            f'({", ".join(columns)}) '
+            f'values {", ".join(values)}',
+            **params
+        )
+        self._update_summary(cn, name, len(rows))
+        merged = pd.concat(diffs)
+        self._write_head(
+            cn, name,
+            merged[~merged.index.duplicated(keep='last')].sort_index()
+        )
+        self._notify_write(cn, name)
+        self._flag_dependents(cn, name, latest_idate)
+        return written + len(rows)
+
 
 class timeseries(xlts):
     index = 3
+    readcache = None
 
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
-        self.cache = basets(namespace=f'{self.namespace}-cache')
+        self.cache = cachets(namespace=f'{self.namespace}-cache')
+        self.inflight = singleflight()
+
+    def enable_read_cache(self, engine, maxitems=1000, maxbytes=2 ** 28):
+        """ Keep the cached formula reads in memory (up to `maxitems`
+        reads and `maxbytes` bytes), until the next cache write """
+        self.disable_read_cache()
+        self.readcache = readcache(
+            engine,
+            self.cache.namespace,
+            maxitems=maxitems,
+            maxbytes=maxbytes
+        )
+
+    def disable_read_cache(self):
+        if self.readcache is not None:
+            self.readcache.stop()
+            self.readcache = None
+
+    def _cached_read(self, cn, name, kw):
+        if self.readcache is None:
+            return self.cache.get(cn, name, **kw)
+        return self.readcache.get(
+            name,
+            kw,
+            lambda: self.cache.get(cn, name, **kw)
+        )
 
     def _expanded_formula(self, cn, formula, stopnames=(), level=-1,
                           display=True, remote=True, qargs=None):
         # stopnames dynamic lookup for series that have a cache
         # (we won't expand them since we can litterally stop at them)
         if qargs is not None and (not qargs.get('live') and not qargs.get('nocache')):
-            stopnames = name_stopper(cn, self, stopnames)
+            if not (isinstance(stopnames, name_stopper) and stopnames.cn is cn):
+                stopnames = name_stopper(cn, self, stopnames)
         return super()._expanded_formula(
             cn, formula,
             stopnames=stopnames,
@@ -68,51 +656,157 @@ class timeseries(xlts):
             qargs=qargs
         )
 
-    @tx
     def get(self, cn, name, nocache=False, live=False, **kw):
+        # a read given an engine has no pending writes to see: its live
+        # part can run on a connection of its own (see `_get_live`)
+        return self._get(
+            cn, name,
+            nocache=nocache,
+            live=live,
+            concurrent=isinstance(cn, Engine),
+            **kw
+        )
+
+    @tx
+    def _get(self, cn, name, nocache, live, concurrent, **kw):
         if self.type(cn, name) != 'formula':
             return super().get(cn, name, **kw)
 
         if nocache or not self.cache.exists(cn, name):
-            return super().get(cn, name, nocache=nocache, live=live, **kw)
+            return self._evaluate(
+                cn, name, concurrent, nocache=nocache, live=live, **kw
+            )
 
         # there is a cache and we want hard to use it ...
         # what if it is stale or old or just initially building ?
-        # we try an heuristics based on regularity of the cache insertion dates
-        # -> if they are regular and we are missing at least two revisions
-        # we do a live query ...
-
-        # asking all cache idates is not a too expensive operation at
-        # this point
-        cacheidates = self.cache.insertion_dates(cn, name)
-        if len(cacheidates) > 1:
-            freq, _ = infer_freq(cacheidates)
-            now = utcnow()
-            lag = now - cacheidates[-1]
-            live = lag / freq > 2
+        # the cache policy tells when the next revision is due: if the
+        # refresh scheduled after it (plus one) has not happened, the
+        # cache is stale and we do a live query ...
+        # (unless it only holds its initial import)
+        # an outdated cache (being rebuilt) gets the same treatment
+        summary = self.cache.summary(cn, name)
+        if summary['outdated']:
+            live = True
+        elif summary['revisions'] > 1:
+            stale = self._stale_after(cn, name, summary['last_idate'])
+            if stale is not None:
+                live = utcnow() > stale
 
-        cached = self.cache.get(cn, name, **kw)
-        if len(cached):
-            if live:
-                return self._get_live(cn, name, cached, cacheidates, kw)
-
-            return cached
+        if live:
+            cached, ts = self._get_live(
+                cn, name, summary['last_idate'], kw, concurrent
+            )
+            if len(cached):
+                return ts
+        else:
+            cached = self._cached_read(cn, name, kw)
+            if len(cached):
+                return cached
 
         # cached is empty -- here we see if we are asked some old uncached
         # revision and serve it if available
 
         revdate = kw.get('revision_date')
-        if revdate is None or revdate >= self.cache.first_insertion_date(cn, name):
+        if revdate is None or revdate >= summary['first_idate']:
             return cached
 
-        return super().get(cn, name, nocache=nocache, live=live, **kw)
+        return self._evaluate(
+            cn, name, concurrent, nocache=nocache, live=live, **kw
+        )
+
+    def _evaluate(self, cn, name, concurrent, **kw):
+        """ Evaluate a formula, sharing the identical evaluations
+        running concurrently in the process unless the caller reads
+        within its own transaction (`concurrent` being false) """
+        if not concurrent:
+            return super(timeseries, self).get(cn, name, **kw)
+        ts, _ = self.inflight.do(
+            (name, tuple(sorted(kw.items()))),
+            lambda: super(timeseries, self).get(cn, name, **kw)
+        )
+        if ts is not None:
+            # the callers must not see each other mutations
+            ts = ts.copy()
+        return ts
+
+    @tx
+    def get_batch(self, cn, names, revision_date=None,
+                  from_value_date=None, to_value_date=None):
+        """ Return a dict of the series of a list of names (None for
+        the unknown names).
+
+        The cache status of all the series is resolved with one query
+        and the fresh caches are read in bulk from their heads: only
+        the other series (primaries, uncached or stale formulas,
+        revision date queries) go through `get`.
+        """
+        names = list(dict.fromkeys(names))
+        hits = []
+        if revision_date is None:
+            ns = self.namespace
+            rows = cn.execute(
+                f'select n.name, s.series_id, s.tzaware, s.revisions, '
+                f'       s.last_idate, cp.stale_after '
+                f'from unnest(%(names)s::text[]) as n(name) '
+                f'join "{ns}".registry as f '
+                f'  on f.name = n.name and '
+                f'     f.internal_metadata->\'formula\' is not null '
+                f'join "{ns}-cache".registry as c on c.name = n.name '
+                f'join "{ns}-cache".summary as s '
+                f'  on s.series_id = c.id and s.head and not s.outdated '
+                f'left join "{ns}".cache_refresh_checkpoint as cp '
+                f'  on cp.series_id = c.id',
+                names=names
+            ).fetchall()
+            now = utcnow()
+            for row in rows:
+                if row.revisions > 1:
+                    stale = row.stale_after or self._stale_after(
+                        cn, row.name, row.last_idate
+                    )
+                    if stale is not None and now > stale:
+                        # will go live
+                        continue
+                hits.append((row.series_id, row.name, row.tzaware))
+
+        cached = self.cache.read_heads(
+            cn, hits, from_value_date, to_value_date
+        )
+        return {
+            name: cached[name] if name in cached else self.get(
+                cn, name,
+                revision_date=revision_date,
+                from_value_date=from_value_date,
+                to_value_date=to_value_date
+            )
+            for name in names
+        }
+
+    def _stale_after(self, cn, name, last_idate):
+        stale = cache.series_stale_after(cn, name, namespace=self.namespace)
+        if stale is not None:
+            return stale
+        # no refresh recorded its watermark yet
+        policy = cache.series_policy(cn, name, namespace=self.namespace)
+        if policy is None:
+            return None
+        return cache.stale_after(policy, last_idate)
+
+    def _get_live(self, cn, name, last_idate, kw, concurrent=False):
+        """ Return the cache read and the cache patched with a live
+        evaluation over the policy window
 
-    def _get_live(self, cn, name, cached, idates, kw):
+        With `concurrent`, the live evaluation runs on its own
+        connection, concurrently with the cache read (otherwise it
+        sees the uncommitted writes of the transaction of `cn`).
+        """
         tzaware = self.tzaware(cn, name)
 
         # save for later use
+        kw = dict(kw)
         fvd = kw.pop('from_value_date', None)
         tvd = kw.pop('to_value_date', None)
+        cachekw = dict(kw, from_value_date=fvd, to_value_date=tvd)
         if fvd:
             fvd = compatible_date(tzaware, fvd)
         if tvd:
@@ -123,7 +817,7 @@ class timeseries(xlts):
         policy = cache.series_policy(cn, name, namespace=self.namespace)
         now = (
             kw.get('revision_date') or
-            (idates and idates[-1]) or
+            last_idate or
             utcnow()
         )
         # we use the look before date span from the cache policy
@@ -142,8 +836,22 @@ class timeseries(xlts):
             la = compatible_date(tzaware, la)
             la = max(tvd, la)
         kw['to_value_date'] = la
-        livets = super().get(cn, name, live=True, **kw)
-        return patch(cached, livets).loc[fvd:tvd]
+
+        if concurrent:
+            with ThreadPoolExecutor(1) as executor:
+                livets = executor.submit(self._live_tail, cn.engine, name, kw)
+                cached = self._cached_read(cn, name, cachekw)
+                livets = livets.result()
+        else:
+            cached = self._cached_read(cn, name, cachekw)
+            livets = self._evaluate(cn, name, False, live=True, **kw)
+        if not len(cached):
+            return cached, cached
+        return cached, patch(cached, livets).loc[fvd:tvd]
+
+    def _live_tail(self, engine, name, kw):
+        with engine.begin() as cn:
+            return self._evaluate(cn, name, True, live=True, **kw)
 
     @tx
     def insertion_dates(self, cn, name,
@@ -163,7 +871,10 @@ class timeseries(xlts):
                 **kw
             )
 
-        if not nocache and self.cache.exists(cn, name):
+        # the revisions of an outdated cache are those of the obsolete
+        # formula
+        summary = None if nocache else self.cache.summary(cn, name)
+        if summary is not None and not summary['outdated']:
             idates = self.cache.insertion_dates(
                 cn, name,
                 from_insertion_date=from_insertion_date,
@@ -224,6 +935,7 @@ class timeseries(xlts):
     @tx
     def rename(self, cn, oldname, newname, propagate=True):
         if self.type(cn, oldname) == 'formula':
+            self._delete_shadow(cn, oldname)
             self.cache.rename(cn, oldname, newname, propagate=propagate)
 
         return super().rename(cn, oldname, newname, propagate=propagate)
@@ -231,18 +943,52 @@ class timeseries(xlts):
     @tx
     def delete(self, cn, name):
         if self.type(cn, name) == 'formula':
+            self._delete_shadow(cn, name)
             self.cache.delete(cn, name)
 
         return super().delete(cn, name)
 
     @tx
     def invalidate_cache(self, cn, name):
+        self._delete_shadow(cn, name)
         if self.cache.exists(cn, name):
             self.cache.delete(cn, name)
 
+    @tx
+    def outdate_cache(self, cn, name):
+        """ Flag the cache of a formula as outdated: it is served
+        patched with a live evaluation over the policy window until a
+        refresh rebuilds it (in a shadow series, swapped in at the
+        end) """
+        self._delete_shadow(cn, name)
+        self.cache.set_outdated(cn, name)
+        cache.mark_dirty(cn, [name], self.namespace)
+
+    def _new_revision(self, cn, name, head, tsstart, tsend,
+                      diffstart, diffend,
+                      author, insertion_date, metadata):
+        super()._new_revision(
+            cn, name, head, tsstart, tsend, diffstart, diffend,
+            author, insertion_date, metadata
+        )
+        cache.mark_dependents_dirty(
+            cn, name, insertion_date, namespace=self.namespace
+        )
+
+    @tx
+    def strip(self, cn, name, csid):
+        super().strip(cn, name, csid)
+        cache.mark_dependents_dirty(cn, name, namespace=self.namespace)
+
+    def _delete_shadow(self, cn, name):
+        shadow = cache.shadow_name(name)
+        if self.cache.exists(cn, shadow):
+            self.cache.delete(cn, shadow)
+
     @tx
     def unset_cache_policy(self, cn, name):
         cache.unset_policy(cn, name, namespace=self.namespace)
+        self._delete_shadow(cn, name)
         self.cache.delete(cn, name)
 
     @tx
@@ -275,6 +1021,8 @@ class timeseries(xlts):
             reject_unknown=reject_unknown
         )
         if prevch != self.content_hash(cn, name):
-            self.invalidate_cache(cn, name)
-            for name in self.dependents(cn, name):
-                self.invalidate_cache(cn, name)
+            names = [name] + list(self.dependents(cn, name))
+            for name in names:
+                self.outdate_cache(cn, name)
+            # a failing refresh deserves a new try
+            cache.clear_failures(cn, names, self.namespace)
@@ -33,7 +33,8 @@ class httpapi(http.refinery_httpapi,
 
 class AppMaker:
 
-    def __init__(self, dburi=None, sources=None, more_sections=None):
+    def __init__(self, dburi=None, sources=None, more_sections=None,
+                 readcache=None):
         if dburi:
             # that will typically for the tests
             # or someone doing something fancy
@@ -47,6 +48,9 @@ class AppMaker:
         self.sources = sources
         self.more_sections = more_sections
         self.engine = create_engine(dburi)
+        if readcache is not None:
+            # e.g. {'maxitems': 1000, 'maxbytes': 2 ** 28}
+            self.tsa.tsh.enable_read_cache(self.engine, **readcache)
 
     def app(self):
         app = Flask('refinery')